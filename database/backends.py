@@ -0,0 +1,121 @@
+'''Storage backends the app can run on, picked with the DATABASE_BACKEND environment variable:
+    mysql   the MySQL database on AWS RDS (the default)
+    sqlite  an embedded sqlite file, for single node deployments and local development
+    duckdb  an embedded duckdb file, for running the analytics pages locally. Needs the duckdb-engine package
+The embedded backends store their file at DATABASE_PATH and create the schema the first time they are used.'''
+import os
+
+from sqlalchemy import create_engine, event, ForeignKeyConstraint
+from sqlalchemy.engine import Engine, URL
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import AddConstraint
+
+from secrets_provider import secret_provider
+from database.sqlalchemy_model import Base
+
+DATABASE_BACKEND = os.environ.get('DATABASE_BACKEND', 'mysql').lower()
+SUPPORTED_BACKENDS = ['mysql', 'sqlite', 'duckdb']
+
+# Connection pool settings for the database engine. Every streamlit session and ingestion job in the server process
+# shares the same pool, so pool size + max overflow is the most connections the app will open to the database at once
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+# Seconds to wait for a connection to be returned to the pool before raising an error
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+# Connections are replaced after this many seconds, well before mysql's wait_timeout closes idle connections on its end
+DB_POOL_RECYCLE_SECONDS = int(os.environ.get('DB_POOL_RECYCLE_SECONDS', 1800))
+
+DEFAULT_DATABASE_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.data')
+
+def get_database_path(backend:str) -> str:
+    return os.environ.get('DATABASE_PATH', os.path.join(DEFAULT_DATABASE_DIRECTORY, f'spotify.{backend}'))
+
+RDS_SECRET_NAME = 'rds!db-60329a4c-380a-4809-bcf5-2689a1a604c0'
+# mysql's error code for a rejected username or password
+MYSQL_ACCESS_DENIED = 1045
+
+def create_mysql_engine() -> Engine:
+    '''Connects to the mysql database on RDS, looking up the credentials in secrets manager.
+    RDS rotates the password, so it is not part of the url: every new connection reads it from the secret provider,
+    and if the database turns it down the cached secret is dropped and the connection tried once more with a fresh one'''
+    url = URL.create('mysql+pymysql',
+                     username=secret_provider.get(RDS_SECRET_NAME)['username'],
+                     host='streamlit-spotify-db.cv2w6ig8qy6y.us-east-2.rds.amazonaws.com',
+                     database='spotify_db')
+    engine = create_engine(url,
+                           poolclass=QueuePool,
+                           pool_size=DB_POOL_SIZE,
+                           max_overflow=DB_MAX_OVERFLOW,
+                           pool_timeout=DB_POOL_TIMEOUT,
+                           pool_recycle=DB_POOL_RECYCLE_SECONDS,
+                           # test each connection as it is checked out so one dropped by the database is replaced
+                           # instead of failing the query
+                           pool_pre_ping=True)
+
+    @event.listens_for(engine, 'do_connect')
+    def connect_with_current_password(dialect, connection_record, cargs, cparams):
+        database_credentials = secret_provider.get(RDS_SECRET_NAME)
+        cparams['user'] = database_credentials['username']
+        cparams['password'] = database_credentials['password']
+        try:
+            return dialect.loaded_dbapi.connect(*cargs, **cparams)
+        except dialect.loaded_dbapi.OperationalError as e:
+            if not e.args or e.args[0] != MYSQL_ACCESS_DENIED:
+                raise
+            # the password was probably rotated since it was cached
+            secret_provider.invalidate(RDS_SECRET_NAME)
+            database_credentials = secret_provider.get(RDS_SECRET_NAME)
+            cparams['user'] = database_credentials['username']
+            cparams['password'] = database_credentials['password']
+            return dialect.loaded_dbapi.connect(*cargs, **cparams)
+    return engine
+
+def create_sqlite_engine(path:str) -> Engine:
+    '''Opens an embedded sqlite database file'''
+    engine = create_engine(f'sqlite:///{path}', poolclass=QueuePool, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                           pool_timeout=DB_POOL_TIMEOUT,
+                           # connections are handed between the streamlit threads and the ingestion threads
+                           connect_args={'check_same_thread': False, 'timeout': DB_POOL_TIMEOUT})
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL lets the pages read while an ingest is writing
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+    return engine
+
+def create_duckdb_engine(path:str) -> Engine:
+    '''Opens an embedded duckdb database file. Every connection in the process shares the same database instance'''
+    return create_engine(f'duckdb:///{path}', poolclass=QueuePool, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                         pool_timeout=DB_POOL_TIMEOUT)
+
+# DuckDB does not support ON DELETE CASCADE, or updating rows that other tables reference, so on duckdb the tables
+# are created without foreign keys. delete_playlist_data deletes the dependent rows itself, so nothing relies on them
+@compiles(ForeignKeyConstraint, 'duckdb')
+def skip_foreign_key_on_duckdb(constraint, compiler, **kw):
+    return None
+
+@compiles(AddConstraint, 'duckdb')
+def skip_add_foreign_key_on_duckdb(create, compiler, **kw):
+    if isinstance(create.element, ForeignKeyConstraint):
+        return ''
+    return compiler.visit_add_constraint(create, **kw)
+
+def create_database_engine(backend:str=DATABASE_BACKEND) -> Engine:
+    '''Creates the engine for the given backend. The embedded backends get their tables created if they do not exist yet,
+    the mysql schema is managed with mysql_schema.sql and the migrations in migrations.py'''
+    if backend == 'mysql':
+        return create_mysql_engine()
+    if backend not in SUPPORTED_BACKENDS:
+        raise ValueError(f"Unknown database backend {backend}, expected one of {', '.join(SUPPORTED_BACKENDS)}")
+    path = get_database_path(backend)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    engine = create_sqlite_engine(path) if backend == 'sqlite' else create_duckdb_engine(path)
+    Base.metadata.create_all(engine)
+    return engine
@@ -0,0 +1,157 @@
+'''Materialized per playlist feature statistics. For every playlist and song feature the playlist_feature_stats table holds
+the count, sum and sum of squares of the feature over the playlist's songs along with a fixed range histogram. The
+histograms of every playlist use the same bins for a feature, so quantiles can be estimated from them without going
+back to the songs. Ingestion refreshes the rows of the playlists it changes, and
+the playlist feature report reads them instead of averaging the raw playlist_songs and songs join.'''
+import json
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text, bindparam
+from sqlalchemy.orm import Session
+
+from database.sqlalchemy_model import PlaylistFeatureStats, IngestCheckpoint
+
+# Range of the histogram of each feature. Values outside of the range are counted in the first or last bin
+FEATURE_RANGES = {
+    'popularity': (0.0, 100.0),
+    'acousticness': (0.0, 1.0),
+    'danceability': (0.0, 1.0),
+    'energy': (0.0, 1.0),
+    'instrumentalness': (0.0, 1.0),
+    'liveness': (0.0, 1.0),
+    'loudness': (-60.0, 5.0),
+    'speechiness': (0.0, 1.0),
+    'tempo': (0.0, 250.0),
+    'valence': (0.0, 1.0),
+    'duration_seconds': (0.0, 1200.0),
+}
+HISTOGRAM_BINS = 50
+
+def get_histogram_edges(feature:str, bins:int=HISTOGRAM_BINS) -> np.ndarray:
+    low, high = FEATURE_RANGES[feature]
+    return np.linspace(low, high, bins + 1)
+
+def build_histogram(feature:str, values:np.ndarray, bins:int=HISTOGRAM_BINS) -> np.ndarray:
+    '''Counts the values into the fixed bins of the feature'''
+    low, high = FEATURE_RANGES[feature]
+    counts, _ = np.histogram(np.clip(values, low, high), bins=get_histogram_edges(feature, bins))
+    return counts
+
+def estimate_order_statistic(edges:np.ndarray, histogram:np.ndarray, k:int) -> float:
+    '''Estimates the k-th smallest value (from 0), placing the values of each bin evenly across it'''
+    cumulative = np.cumsum(histogram)
+    bin_index = int(np.searchsorted(cumulative, k, side='right'))
+    rank_in_bin = k - (cumulative[bin_index] - histogram[bin_index])
+    return float(edges[bin_index] + (rank_in_bin + 0.5) / histogram[bin_index] * (edges[bin_index + 1] - edges[bin_index]))
+
+def estimate_quantile(feature:str, histogram:np.ndarray, q:float) -> Optional[float]:
+    '''Estimates a quantile of the feature from its histogram the same way np.quantile interpolates between the two
+    nearest values. Each of those values is estimated within its bin, so the estimate is off by at most one bin width'''
+    histogram = np.asarray(histogram, dtype=float)
+    n = int(histogram.sum())
+    if n == 0:
+        return None
+    # the number of bins is read from the histogram, so this works for histograms built with any bin count
+    edges = get_histogram_edges(feature, histogram.size)
+    position = (n - 1) * q
+    lower = estimate_order_statistic(edges, histogram, int(np.floor(position)))
+    upper = estimate_order_statistic(edges, histogram, int(np.ceil(position)))
+    return lower + (position - np.floor(position)) * (upper - lower)
+
+def get_feature_values(session:Session, playlist_id_list:List[str]) -> pd.DataFrame:
+    '''Gets the feature values of every song on the given playlists'''
+    query = text('''
+    SELECT ps.playlist_id, s.popularity, s.acousticness, s.danceability, s.energy, s.instrumentalness, s.liveness,
+           s.loudness, s.speechiness, s.tempo, s.valence, s.duration_ms / 1000.0 AS duration_seconds
+    FROM playlist_songs AS ps
+    JOIN songs AS s ON ps.song_id=s.song_id
+    WHERE ps.playlist_id IN :playlist_ids
+    ''').bindparams(bindparam('playlist_ids', expanding=True))
+    result = session.execute(query, {'playlist_ids': playlist_id_list})
+    return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+def compute_playlist_feature_stats(feature_values_df:pd.DataFrame) -> List[Dict]:
+    '''Computes the stats rows of every playlist in the dataframe returned by get_feature_values'''
+    updated_at = datetime.now()
+    stats_rows = []
+    for playlist_id, playlist_df in feature_values_df.groupby('playlist_id'):
+        for feature in FEATURE_RANGES:
+            values = pd.to_numeric(playlist_df[feature], errors='coerce').to_numpy(dtype=float)
+            # like AVG, songs missing the feature are left out
+            values = values[~np.isnan(values)]
+            stats_rows.append({
+                'playlist_id': playlist_id,
+                'feature': feature,
+                'n': int(values.size),
+                'total': float(values.sum()),
+                'total_sq': float(np.square(values).sum()),
+                'histogram': json.dumps(build_histogram(feature, values).tolist()),
+                'updated_at': updated_at,
+            })
+    return stats_rows
+
+def refresh_playlist_feature_stats(session:Session, playlist_id_list:List[str], chunk_size:int=200) -> None:
+    '''Recomputes the stats of the given playlists from their songs, committing after each chunk of playlists'''
+    for i in range(0, len(playlist_id_list), chunk_size):
+        chunk = playlist_id_list[i:i + chunk_size]
+        stats_rows = compute_playlist_feature_stats(get_feature_values(session, chunk))
+        session.query(PlaylistFeatureStats).filter(PlaylistFeatureStats.playlist_id.in_(chunk)).delete(synchronize_session=False)
+        if stats_rows:
+            session.execute(PlaylistFeatureStats.__table__.insert(), stats_rows)
+        session.commit()
+
+def get_playlists_needing_stats(session:Session, checkpoint:IngestCheckpoint) -> List[str]:
+    '''Gets the playlists whose stats are out of date after a refresh: the playlists loaded during the refresh,
+    every playlist (of any user) holding a song whose audio features were filled in during the refresh, and any of
+    the user's playlists with songs that do not have stats yet. A playlist without songs never gets stats, so it is
+    only picked up when a refresh loads it'''
+    query = text('''
+    SELECT playlist_id
+    FROM ingest_checkpoint_playlists
+    WHERE run_id = :run_id
+    UNION
+    SELECT ps.playlist_id
+    FROM songs AS s
+    JOIN playlist_songs AS ps ON s.song_id=ps.song_id
+    WHERE s.features_fetched_at >= :started_at
+    UNION
+    SELECT p.playlist_id
+    FROM playlists AS p
+    LEFT JOIN playlist_feature_stats AS st ON p.playlist_id=st.playlist_id
+    WHERE p.app_user_id = :app_user_id AND st.playlist_id IS NULL
+    AND EXISTS (SELECT 1 FROM playlist_songs AS ps WHERE ps.playlist_id=p.playlist_id)
+    ''')
+    result = session.execute(query, {'run_id': checkpoint.run_id, 'started_at': checkpoint.started_at,
+                                     'app_user_id': checkpoint.app_user_id})
+    return [row[0] for row in result.fetchall()]
+
+# the count and sum of every feature for each of the user's playlists, also written to the user's snapshot
+USER_PLAYLIST_STATS_QUERY = '''
+    SELECT p.name AS playlist_name, st.playlist_id, st.feature, st.n, st.total
+    FROM playlists AS p
+    JOIN playlist_feature_stats AS st ON p.playlist_id=st.playlist_id
+    WHERE p.app_user_id = :app_user_id
+'''
+
+def compute_playlist_feature_averages(stats_df:pd.DataFrame) -> pd.DataFrame:
+    '''Computes the average of every feature for each playlist from the rows of USER_PLAYLIST_STATS_QUERY, in the
+    same format as the report's raw query'''
+    # a playlist where no song has the feature has no average, AVG returns NULL for it
+    stats_df = stats_df.assign(average=stats_df['total'] / stats_df['n'].replace(0, np.nan))
+    averages_df = stats_df.pivot(index=['playlist_id', 'playlist_name'], columns='feature', values='average')
+    averages_df = averages_df.reindex(columns=list(FEATURE_RANGES)).add_prefix('average_').reset_index()
+    averages_df = averages_df.drop(columns='playlist_id')
+    averages_df.columns.name = None
+    return averages_df
+
+def get_playlist_feature_averages(session:Session, app_user_id:str) -> Optional[pd.DataFrame]:
+    '''Gets the average of every feature for each of the user's playlists from the stats table. Returns None if the
+    user's playlists do not have stats yet'''
+    result = session.execute(text(USER_PLAYLIST_STATS_QUERY), {'app_user_id': app_user_id})
+    stats_df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+    if stats_df.empty:
+        return None
+    return compute_playlist_feature_averages(stats_df)
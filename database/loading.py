@@ -1,4 +1,7 @@
-from sqlalchemy import create_engine, or_, text
+from sqlalchemy import create_engine, or_, text, bindparam, update, select, func, Table
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import IntegrityError
@@ -6,223 +9,299 @@ from sqlalchemy.exc import IntegrityError
 from streamlit_utils import create_sqlalchemy_session
 
 import os
+import uuid
 import numpy as np 
+from datetime import datetime, date
 import streamlit as st
 
-from database.sqlalchemy_model import Playlist, Songs, PlaylistSongs, Artist, ArtistGenre, SongArtist
+from database.sqlalchemy_model import Playlist, Songs, PlaylistSongs, Artist, ArtistGenre, SongArtist, IngestCheckpoint, IngestCheckpointPlaylist, PlaylistFeatureStats, FeatureRollup
+from database.snapshots import invalidate_user_snapshot
+from database.query_cache import bump_data_generation
 from sqlalchemy.orm import Session
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable, Iterator, Tuple
+from collections import deque
 
 # Note that in many of these functions the sqlalchemy session is not closed at the end
 # this is intentional, as when these functions are called it is many times in sequence of one another 
 # This means we do not have to constantly close and open the sqlalchemy session
 
+# The load functions below also do not commit. They write in multi row statements of LOAD_BATCH_SIZE rows, 
+# and the caller commits once all of the writes for a unit of work (like a page of a playlist) are done, 
+# so that unit is stored in a single transaction instead of one commit per row
+
+# Number of rows written by each multi row insert statement
+LOAD_BATCH_SIZE = int(os.environ.get('LOAD_BATCH_SIZE', 500))
+
+def chunk_list(items:List, chunk_size:int) -> List[List]:
+    '''Chop a list into chunks of at most chunk_size items'''
+    n_chunks = (len(items) + chunk_size -1) // chunk_size
+    return [items[i*chunk_size:(i+1)*chunk_size] for i in range(n_chunks)]
+
+def dict_of_lists_to_rows(data:Dict[str, List]) -> List[Dict[str, Any]]:
+    '''Converts the dictionary of lists format used by the extract functions into a list of row dictionaries'''
+    return [
+        dict(zip(data.keys(), values))
+        for values in zip(*data.values())
+    ]
+
+def insert_ignore(session:Session, table:Table, rows:List[Dict[str, Any]], batch_size:int=LOAD_BATCH_SIZE) -> None:
+    '''Inserts the rows in multi row statements, skipping rows whose primary key is already in the table. 
+    This is INSERT IGNORE on mysql and INSERT ... ON CONFLICT DO NOTHING on sqlite and postgres style databases'''
+    dialect = session.get_bind().dialect.name
+    for batch in chunk_list(rows, batch_size):
+        if dialect == 'mysql':
+            statement = mysql_insert(table).values(batch).prefix_with('IGNORE')
+        elif dialect == 'sqlite':
+            statement = sqlite_insert(table).values(batch).on_conflict_do_nothing()
+        else:
+            statement = postgresql_insert(table).values(batch).on_conflict_do_nothing()
+        session.execute(statement)
+
+def update_rows(session:Session, table:Table, key_column:str, rows:List[Dict[str, Any]]) -> None:
+    '''Updates existing rows matched on key_column with the other values in each row dictionary. 
+    The rows are sent as a single executemany of one UPDATE statement'''
+    if not rows:
+        return
+    value_columns = [column for column in rows[0] if column != key_column]
+    statement = (update(table)
+                 .where(table.c[key_column] == bindparam(f'b_{key_column}'))
+                 .values({column: bindparam(f'b_{column}') for column in value_columns}))
+    session.execute(statement, [{f'b_{column}': value for column, value in row.items()} for row in rows])
 
 def load_playlists_data(session:Session, playlists_data:Dict) -> None:
-    '''Loads data into the playlists table using sqlalchemy'''
+    '''Loads data into the playlists table using sqlalchemy. Playlists that are already stored are left as they are'''
     n_playlists = len(playlists_data['playlist_id'])
-    for i in range(n_playlists):
-        new_playlist = Playlist(playlist_id=playlists_data['playlist_id'][i], name=playlists_data['name'][i], 
-                                owner_id=playlists_data['owner_id'][i], is_collaborative=playlists_data['is_collaborative'][i], 
-                                app_user_id=playlists_data['app_user_id'][i])
-        session.add(new_playlist)
-        try:
-            session.commit()
-        except IntegrityError:
-            session.rollback()  # Rollback in case of an error
+    playlists = [dict(playlist_id=playlists_data['playlist_id'][i], name=playlists_data['name'][i], 
+                      owner_id=playlists_data['owner_id'][i], is_collaborative=playlists_data['is_collaborative'][i], 
+                      app_user_id=playlists_data['app_user_id'][i]) 
+                 for i in range(n_playlists)]
+    insert_ignore(session, Playlist.__table__, playlists)
     
 
 def load_song_data(session:Session, song_data:Dict) -> None:
     '''Loads data into the songs table using sqlalchemy'''
-    songs = [
-        dict(zip(song_data.keys(), values))
-        for values in zip(*song_data.values())
-    ]
-    for song in songs: 
-        new_song = Songs(**song)
-        if not song['song_id']:
-            continue
-        session.add(new_song)
-        try:
-            session.commit()
-    
-        except IntegrityError:
-            session.rollback() # Rollback in case of an error
+    songs = [song for song in dict_of_lists_to_rows(song_data) if song['song_id']]
+    for song in songs:
+        # release dates are formatted as YYYY-MM-DD strings, which mysql accepts but sqlite and duckdb need as dates
+        if isinstance(song.get('release_date'), str):
+            song['release_date'] = date.fromisoformat(song['release_date'])
+    insert_ignore(session, Songs.__table__, songs)
             
 def load_playlists_songs_data(session:Session, song_playlist_data:Dict) -> None:
     '''Loads data into the playlist songs table using sqlalchemy'''
-    playlist_songs = [
-        dict(zip(song_playlist_data.keys(), values))
-        for values in zip(*song_playlist_data.values())
-    ]
-    for playlist_song in playlist_songs: 
+    playlist_songs = [playlist_song for playlist_song in dict_of_lists_to_rows(song_playlist_data) if playlist_song['song_id']]
+    insert_ignore(session, PlaylistSongs.__table__, playlist_songs)
+
 
-        if not playlist_song['song_id']:
-            continue
+def get_added_date_range(session:Session, playlist_id:str) -> Tuple[Optional[datetime], Optional[datetime]]:
+    '''Gets the first and last dates that the songs stored for the playlist were added, or None and None if it has none'''
+    return tuple(session.query(func.min(PlaylistSongs.added_date), func.max(PlaylistSongs.added_date))
+                 .filter(PlaylistSongs.playlist_id == playlist_id).one())
 
-        new_song = PlaylistSongs(**playlist_song)
-        session.add(new_song)
-        try:
-            session.commit()
-        except IntegrityError:
-            session.rollback() # Rollback in case of an error
+def delete_removed_playlist_songs(session:Session, playlist_id:str, song_id_set:set) -> None:
+    '''Deletes the playlist's songs that are not in song_id_set, the songs found by downloading the whole playlist
+    again. The loaders only ever insert, so this is what drops the songs that were taken off the playlist on spotify'''
+    stored_song_ids = [row[0] for row in session.query(PlaylistSongs.song_id).filter(PlaylistSongs.playlist_id == playlist_id).all()]
+    removed_song_ids = [song_id for song_id in stored_song_ids if song_id not in song_id_set]
+    for chunk in chunk_list(removed_song_ids, LOAD_BATCH_SIZE):
+        (session.query(PlaylistSongs)
+         .filter(PlaylistSongs.playlist_id == playlist_id, PlaylistSongs.song_id.in_(chunk))
+         .delete(synchronize_session=False))
 
+def update_playlist_dates(session:Session, playlist_id:str, created_date:datetime, last_updated:datetime) -> None:
+    '''Updates the playlist table with the dates the first and last songs were added to the playlist'''
+    session.query(Playlist).filter(Playlist.playlist_id == playlist_id).update(
+        {Playlist.created_date: created_date, Playlist.last_updated: last_updated}, synchronize_session=False)
 
 def update_playlist_songs_dates(session:Session, playlist_id, song_playlist_data) -> None:
     '''Updates the playlist table with timestamped information obtained through the songs endpoint'''
     created_date = np.min(song_playlist_data['added_date'])
     last_updated = np.max(song_playlist_data['added_date'])
-    updated_playlist = Playlist(playlist_id=playlist_id, created_date=created_date, last_updated=last_updated)
-    session.merge(updated_playlist)
-    try:
-        session.commit()
-    except IntegrityError:
-        session.rollback()  # Rollback in case of an error
-
-def get_song_ids_with_nulls(session:Session, playlist_id:str, chunk_size=100) -> List:
-    '''Gets song ids that are missing data from the audio features endpoint. 
-    Returns a list of lists with max  len of 100, since the api endpoint 
-    the song ids will be passed to only accepts 100 ids per request'''
-    query = f"""
-        SELECT s.song_id 
-        FROM songs AS s 
-        JOIN playlist_songs AS ps ON s.song_id=ps.song_id
-        WHERE ps.playlist_id='{playlist_id}' AND 
-        s.song_id IS NOT NULL AND
-        (acousticness IS NULL 
-        OR danceability IS NULL 
-        OR energy IS NULL 
-        OR instrumentalness IS NULL 
-        OR liveness IS NULL 
-        OR loudness IS NULL 
-        OR speechiness IS NULL 
-        OR tempo IS NULL 
-        OR valence IS NULL);
-    """
-    # Execute the raw SQL query
-    result = session.execute(text(query))
-    # Fetch all results
-    null_song_ids = result.fetchall()
-    # put the results in a list for easy loopin 
-    null_song_ids = [row[0] for row in null_song_ids]
-    null_song_ids_chunked = []
-    # Chop the results ito chunks 
-    n_chunks = (len(null_song_ids) + chunk_size -1) // chunk_size
-    for i in range(n_chunks):
-        start_index = i*chunk_size 
-        end_index = start_index + chunk_size
-        chunk = null_song_ids[start_index:end_index]
-        null_song_ids_chunked.append(chunk)    
-    return null_song_ids_chunked
-
-def get_artists_with_nulls(session:Session, chunk_size = 50) -> List:
-    '''Gets aretist ids where there is no genre information filled in. Returns 
-    ids in chunks of specified size since only 50 artist ids can be passed to 
-    the endpoint in a single request'''
-    query = """
-    SELECT a.artist_id 
-    FROM artists AS a
-    LEFT JOIN artist_genres AS g ON a.artist_id=g.artist_id
-    WHERE a.popularity IS NULL
-    OR g.genre IS NULL;
-    """
-    result = session.execute(text(query))
-    null_artist_ids = result.fetchall()
-    null_artist_ids = [row[0] for row in null_artist_ids]
-    # Divide into chunks of specified size 
-    null_artist_ids_chunked = []
-    n_chunks = (len(null_artist_ids) + chunk_size -1) // chunk_size
-    for i in range(n_chunks):
-        start_index = i*chunk_size 
-        end_index = start_index + chunk_size
-        chunk = null_artist_ids[start_index:end_index]
-        null_artist_ids_chunked.append(chunk)
-    return null_artist_ids_chunked
+    update_playlist_dates(session, playlist_id, created_date, last_updated)
+
+def get_playlist_snapshots(session:Session, playlist_id_list:List[str]) -> Dict[str, Optional[str]]:
+    '''Gets the stored snapshot id for each of the given playlists. Playlists that are not in the database yet are left out'''
+    if not playlist_id_list:
+        return {}
+    rows = session.query(Playlist.playlist_id, Playlist.snapshot_id).filter(Playlist.playlist_id.in_(playlist_id_list)).all()
+    return {playlist_id: snapshot_id for playlist_id, snapshot_id in rows}
+
+def update_playlist_snapshot(session:Session, playlist_id:str, snapshot_id:Optional[str]) -> None:
+    '''Stores the snapshot id of a playlist. This should only be committed along with the rest of the playlist's data, 
+    otherwise a failed refresh could cause the playlist to be skipped next time'''
+    session.query(Playlist).filter(Playlist.playlist_id == playlist_id).update({Playlist.snapshot_id: snapshot_id}, synchronize_session=False)
+
+# Songs and artists are inserted with an enrichment status of pending. The backfill reads the pending ones through the 
+# status index and marks each one as fetched, or failed if spotify has no data for it, so nothing is requested twice
+ENRICHMENT_PENDING = 'pending'
+ENRICHMENT_FETCHED = 'fetched'
+ENRICHMENT_FAILED = 'failed'
+
+# module level so that the check command in database/migrations.py can EXPLAIN them
+PENDING_SONGS_QUERY = select(Songs.song_id).where(Songs.features_status == ENRICHMENT_PENDING)
+PENDING_ARTISTS_QUERY = select(Artist.artist_id).where(Artist.enrichment_status == ENRICHMENT_PENDING)
+
+def get_pending_song_ids(session:Session) -> List[str]:
+    '''Gets every song that has not had its audio features requested yet'''
+    rows = session.execute(PENDING_SONGS_QUERY).fetchall()
+    return [row[0] for row in rows]
+
+def get_pending_artist_ids(session:Session) -> List[str]:
+    '''Gets every artist that has not had its genres and popularity requested yet'''
+    rows = session.execute(PENDING_ARTISTS_QUERY).fetchall()
+    return [row[0] for row in rows]
+
+def filter_pending_song_ids(session:Session, song_id_list:List[str], lookup_size:int=1000) -> List[str]:
+    '''Returns the song ids from the given list that are still waiting on the audio features endpoint. 
+    The ids are returned in the same order they were given in'''
+    pending_song_ids = set()
+    # Look the ids up in chunks so a large library does not create one giant IN clause
+    for chunk in chunk_list(song_id_list, lookup_size):
+        rows = session.query(Songs.song_id).filter(Songs.song_id.in_(chunk), Songs.features_status == ENRICHMENT_PENDING).all()
+        pending_song_ids.update(row[0] for row in rows)
+    return [song_id for song_id in song_id_list if song_id in pending_song_ids]
+
+def filter_pending_artist_ids(session:Session, artist_id_list:List[str], lookup_size:int=1000) -> List[str]:
+    '''Returns the artist ids from the given list that are still waiting on the artists endpoint.
+    The ids are returned in the same order they were given in'''
+    pending_artist_ids = set()
+    for chunk in chunk_list(artist_id_list, lookup_size):
+        rows = session.query(Artist.artist_id).filter(Artist.artist_id.in_(chunk), Artist.enrichment_status == ENRICHMENT_PENDING).all()
+        pending_artist_ids.update(row[0] for row in rows)
+    return [artist_id for artist_id in artist_id_list if artist_id in pending_artist_ids]
+
+def iter_backfill_batches(candidate_ids:List[str], batch_size:int, filter_missing:Callable[[List[str]], List[str]]) -> Iterator[List[str]]:
+    '''Yields completely full batches of ids that are still missing data, followed by one final partial batch.
+    Each batch is checked with filter_missing right before it is yielded, so ids that have been filled in since the 
+    candidates were collected (for example by another user's ingest) are dropped and replaced with the next candidates. 
+    Since this is a generator the check for a batch runs after the previous batch has been loaded.'''
+    # de-duplicate while keeping the original order
+    remaining = deque(dict.fromkeys(candidate_ids))
+    batch = []
+    while remaining:
+        while remaining and len(batch) < batch_size:
+            batch.append(remaining.popleft())
+        batch = filter_missing(batch)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 def load_song_features_data(session:Session, song_features_data:Dict) -> None:
     '''Updates the songs table with data obtained through the audio features endpoint'''
-    n_songs = len(song_features_data['song_id'])
-    for i in range(n_songs):
-        # check edge case of song id being null (this rarely happens with songs still on playlists that have been removed from spotify)
-        if not song_features_data['song_id'][i]:
-            continue
-        song = Songs(song_id=song_features_data['song_id'][i], danceability=song_features_data['danceability'][i],
-                     acousticness=song_features_data['acousticness'][i], energy=song_features_data['energy'][i],
-                     instrumentalness=song_features_data['instrumentalness'][i], liveness=song_features_data['liveness'][i],
-                      loudness=song_features_data['loudness'][i], speechiness=song_features_data['speechiness'][i],
-                       tempo=song_features_data['tempo'][i], valence=song_features_data['valence'][i] )
-        session.merge(song)
-        try:
-            session.commit()
-        except IntegrityError:
-            session.rollback() # Rollback in case of an error
+    # check edge case of song id being null (this rarely happens with songs still on playlists that have been removed from spotify)
+    song_features = [song for song in dict_of_lists_to_rows(song_features_data) if song['song_id']]
+    fetched_at = datetime.now()
+    for song in song_features:
+        song['features_status'] = ENRICHMENT_FETCHED
+        song['features_fetched_at'] = fetched_at
+    update_rows(session, Songs.__table__, 'song_id', song_features)
+
+def mark_song_features_failed(session:Session, song_id_list:List[str]) -> None:
+    '''Marks songs that spotify has no audio features for, so they are not requested again on every refresh'''
+    fetched_at = datetime.now()
+    update_rows(session, Songs.__table__, 'song_id', 
+                [dict(song_id=song_id, features_status=ENRICHMENT_FAILED, features_fetched_at=fetched_at) for song_id in song_id_list])
 
 def load_artist_data(session:Session, artist_data:Dict) -> None:
     '''Loads artist id and name into the artists table using sqlalchemy'''
-
-    n_artists = len(artist_data['artist_id'])
-    for i in range(n_artists):
-        new_artist = Artist(artist_id=artist_data['artist_id'][i], name=artist_data['name'][i])
-        if not artist_data['artist_id'][i]:
-            continue
-        session.add(new_artist)
-        try:
-            session.commit()
-        except IntegrityError:
-            session.rollback()  # Rollback in case of an error
+    artists = [dict(artist_id=artist_id, name=name) 
+               for artist_id, name in zip(artist_data['artist_id'], artist_data['name']) if artist_id]
+    insert_ignore(session, Artist.__table__, artists)
 
 def update_artist_popularity(session:Session, artist_genre_popularity_data:Dict) -> None:
     '''Load the artist popularity data into the artists table'''
-    n_artists = len(artist_genre_popularity_data['artist_id'])
-    for i in range(n_artists):
-        if not artist_genre_popularity_data['artist_id'][i]:
-            continue
-        updated_artist = Artist(artist_id=artist_genre_popularity_data['artist_id'][i], popularity=artist_genre_popularity_data['popularity'][i])
-        session.merge(updated_artist)
-        try:
-            session.commit()
-        except IntegrityError:
-            session.rollback()  # Rollback in case of an error
+    # artists without any genres are marked as fetched too, so they are not requested again on every refresh
+    enriched_at = datetime.now()
+    artists = [dict(artist_id=artist_id, popularity=popularity, enrichment_status=ENRICHMENT_FETCHED, enriched_at=enriched_at) 
+               for artist_id, popularity in zip(artist_genre_popularity_data['artist_id'], artist_genre_popularity_data['popularity']) 
+               if artist_id]
+    update_rows(session, Artist.__table__, 'artist_id', artists)
+
+def mark_artist_enrichment_failed(session:Session, artist_id_list:List[str]) -> None:
+    '''Marks artists that spotify returned no data for'''
+    enriched_at = datetime.now()
+    update_rows(session, Artist.__table__, 'artist_id', 
+                [dict(artist_id=artist_id, enrichment_status=ENRICHMENT_FAILED, enriched_at=enriched_at) for artist_id in artist_id_list])
 
 def load_artist_genre_data(session:Session, artist_genre_popularity_data:Dict) -> None: 
     '''Load artist genre data into the artist genre table'''
-    artist_id_list = artist_genre_popularity_data['artist_id']
-
-    for index, artist_id in enumerate(artist_id_list):
-        # catch artist id = None and skip
-        if not artist_id:
-            continue 
-        genre_list = artist_genre_popularity_data['genre_list'][index]
-        for genre in genre_list:
-            artist_genre_entry = ArtistGenre(artist_id=artist_id, genre=genre)
-            session.add(artist_genre_entry)
-            try:
-                session.commit()
-            except IntegrityError:
-                session.rollback()  # Rollback in case of an error
+    artist_genres = [dict(artist_id=artist_id, genre=genre)
+                     for artist_id, genre_list in zip(artist_genre_popularity_data['artist_id'], artist_genre_popularity_data['genre_list'])
+                     # catch artist id = None and skip
+                     if artist_id
+                     for genre in genre_list]
+    insert_ignore(session, ArtistGenre.__table__, artist_genres)
 
 def load_song_artist_data(session:Session, artist_data:Dict) -> None:
     ''' Load the song artist data  '''
-    n_artists = len(artist_data['artist_id'])
-    for i in range(n_artists):
-        if not artist_data['artist_id'][i]:
-            continue
-        new_song_artist = SongArtist(artist_id=artist_data['artist_id'][i], song_id=artist_data['song_id'][i])
-        session.add(new_song_artist)
-        try:
-            session.commit()
-            # print(f"Artist {artist_data['name'][i]} added.")
-        except IntegrityError:
-            session.rollback()  # Rollback in case of an error
+    song_artists = [dict(artist_id=artist_id, song_id=song_id) 
+                    for artist_id, song_id in zip(artist_data['artist_id'], artist_data['song_id']) if artist_id]
+    insert_ignore(session, SongArtist.__table__, song_artists)
 
 
 def delete_playlist_data(session:Session, app_user_id:str) -> None:
     '''Deletes the playlist data for a given user_id'''
     try:
+        # The rows that depend on the user's playlists are deleted first rather than relying on ON DELETE CASCADE, 
+        # which sqlite only follows with foreign keys turned on and duckdb does not support at all
+        user_playlist_ids = session.query(Playlist.playlist_id).filter(Playlist.app_user_id == app_user_id).scalar_subquery()
+        session.query(PlaylistSongs).filter(PlaylistSongs.playlist_id.in_(user_playlist_ids)).delete(synchronize_session=False)
+        session.query(PlaylistFeatureStats).filter(PlaylistFeatureStats.playlist_id.in_(user_playlist_ids)).delete(synchronize_session=False)
+        user_run_ids = session.query(IngestCheckpoint.run_id).filter(IngestCheckpoint.app_user_id == app_user_id).scalar_subquery()
+        session.query(IngestCheckpointPlaylist).filter(IngestCheckpointPlaylist.run_id.in_(user_run_ids)).delete(synchronize_session=False)
+        session.query(IngestCheckpoint).filter(IngestCheckpoint.app_user_id == app_user_id).delete(synchronize_session=False)
         # Query to delete playlists with the specified app_user_id
         session.query(Playlist).filter(Playlist.app_user_id == app_user_id).delete(synchronize_session=False)
+        session.query(FeatureRollup).filter(FeatureRollup.app_user_id == app_user_id).delete(synchronize_session=False)
         session.commit()  # Commit the transaction
+        # the snapshot still holds the deleted data, so the pages have to stop reading it
+        invalidate_user_snapshot(app_user_id)
+        # and any query results cached for the user are now stale
+        bump_data_generation(app_user_id)
         st.markdown(f"Deleted playlists for app_user_id: {app_user_id}")
     except Exception as e:
         session.rollback()  # Roll back the transaction in case of error
         st.markdown(f"Error occurred: {e}")
+
+
+def get_resumable_checkpoint(session:Session, app_user_id:str) -> Optional[IngestCheckpoint]:
+    '''Gets the most recent refresh for the user that did not finish loading its data, if there is one'''
+    return (session.query(IngestCheckpoint)
+            .filter(IngestCheckpoint.app_user_id == app_user_id, IngestCheckpoint.status.in_(['running', 'failed']))
+            .order_by(IngestCheckpoint.started_at.desc())
+            .first())
+
+def get_checkpoints_with_failed_summaries(session:Session, app_user_id:str) -> List[IngestCheckpoint]:
+    '''Gets the earlier refreshes of the user that loaded their data but failed to update the feature stats or rollups'''
+    return (session.query(IngestCheckpoint)
+            .filter(IngestCheckpoint.app_user_id == app_user_id, IngestCheckpoint.status == 'summaries_failed')
+            .order_by(IngestCheckpoint.started_at)
+            .all())
+
+def create_checkpoint(session:Session, app_user_id:str) -> IngestCheckpoint:
+    '''Creates the checkpoint record for a new refresh'''
+    now = datetime.now()
+    checkpoint = IngestCheckpoint(run_id=uuid.uuid4().hex, app_user_id=app_user_id, status='running', stage='playlists',
+                                  song_feature_batches_done=0, artist_batches_done=0, started_at=now, updated_at=now)
+    session.add(checkpoint)
+    session.commit()
+    return checkpoint
+
+def update_checkpoint(session:Session, checkpoint:IngestCheckpoint, **values) -> None:
+    '''Updates the given columns of a checkpoint, for example the stage or status'''
+    for column, value in values.items():
+        setattr(checkpoint, column, value)
+    checkpoint.updated_at = datetime.now()
+    session.commit()
+
+def mark_checkpoint_playlist_done(session:Session, checkpoint:IngestCheckpoint, playlist_id:str,
+                                  first_added_date:Optional[datetime]=None, last_added_date:Optional[datetime]=None) -> None:
+    '''Records that all of a playlist's data has been loaded during this refresh, along with the range of added dates
+    whose rollups it changed. Like the load functions this does not commit, so it should be committed in the same
+    transaction as the playlist's data'''
+    # ignore the row if the playlist was already marked as done by an earlier attempt of this refresh
+    insert_ignore(session, IngestCheckpointPlaylist.__table__, [dict(run_id=checkpoint.run_id, playlist_id=playlist_id,
+                                                                    first_added_date=first_added_date,
+                                                                    last_added_date=last_added_date)])
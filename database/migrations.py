@@ -0,0 +1,409 @@
+'''Versioned schema migrations. Each migration is a list of operations that check the live schema before changing it,
+so a migration can be applied to a database that was created from an older mysql_schema.sql, one that already has
+some of the changes made by hand, or a brand new empty database. Applied versions are recorded in schema_migrations.
+
+Run from the root of the repo:
+    python -m database.migrations upgrade   apply every migration that has not been applied yet
+    python -m database.migrations status    list the migrations and whether they have been applied
+    python -m database.migrations check     EXPLAIN the hot queries and fail if any of them scans a whole table
+'''
+import argparse
+import re
+import sys
+from datetime import datetime
+from typing import List, Dict, Any, Optional
+
+from sqlalchemy import (Boolean, Column, Date, Float, ForeignKey, Integer, MetaData, PrimaryKeyConstraint, String, Table,
+                        Text, TIMESTAMP, create_engine, inspect, text)
+from sqlalchemy.engine import Connection, Engine
+
+migration_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', migration_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', String(255), nullable=False),
+    Column('applied_at', TIMESTAMP, nullable=True, default=None),
+)
+
+# Each table as it was when the migration that creates it was written. The migrations create the tables from these
+# rather than from the models in sqlalchemy_model.py, so applying them builds the same schema however much the models
+# have changed since. Never edit one, make any change to the table in a new migration
+history_metadata = MetaData()
+
+playlists_v1 = Table(
+    'playlists', history_metadata,
+    Column('playlist_id', String(255), primary_key=True),
+    Column('name', String(255), nullable=False),
+    Column('owner_id', String(255), nullable=False),
+    Column('is_collaborative', Boolean, default=False),
+    Column('created_date', TIMESTAMP, nullable=True, default=None),
+    Column('last_updated', TIMESTAMP, nullable=True, default=None),
+    Column('app_user_id', String(255), nullable=False),
+)
+
+songs_v1 = Table(
+    'songs', history_metadata,
+    Column('song_id', String(255), primary_key=True, unique=True),
+    Column('title', String(255), nullable=False),
+    Column('album_name', String(255)),
+    Column('album_id', String(255)),
+    Column('duration_ms', Float),
+    Column('release_date', Date),
+    Column('popularity', Float),
+    Column('acousticness', Float),
+    Column('danceability', Float),
+    Column('energy', Float),
+    Column('instrumentalness', Float),
+    Column('liveness', Float),
+    Column('loudness', Float),
+    Column('speechiness', Float),
+    Column('tempo', Float),
+    Column('valence', Float),
+)
+
+artists_v1 = Table(
+    'artists', history_metadata,
+    Column('artist_id', String(255), primary_key=True),
+    Column('name', String(255), nullable=False),
+    Column('popularity', Float),
+)
+
+artist_genres_v1 = Table(
+    'artist_genres', history_metadata,
+    Column('artist_id', String(255), ForeignKey('artists.artist_id', ondelete='CASCADE'), nullable=False),
+    Column('genre', String(255), nullable=False),
+    PrimaryKeyConstraint('artist_id', 'genre'),
+)
+
+song_artists_v1 = Table(
+    'song_artists', history_metadata,
+    Column('song_id', String(255), ForeignKey('songs.song_id', ondelete='CASCADE'), nullable=False),
+    Column('artist_id', String(255), ForeignKey('artists.artist_id', ondelete='CASCADE'), nullable=False),
+    PrimaryKeyConstraint('song_id', 'artist_id'),
+)
+
+playlist_songs_v1 = Table(
+    'playlist_songs', history_metadata,
+    Column('playlist_id', String(255), ForeignKey('playlists.playlist_id', ondelete='CASCADE'), nullable=False),
+    Column('song_id', String(255), ForeignKey('songs.song_id', ondelete='CASCADE'), nullable=False),
+    Column('added_date', TIMESTAMP, default=None, nullable=True),
+    Column('added_by', String(255), default=None, nullable=True),
+    PrimaryKeyConstraint('playlist_id', 'song_id'),
+)
+
+ingest_checkpoints_v3 = Table(
+    'ingest_checkpoints', history_metadata,
+    Column('run_id', String(36), primary_key=True),
+    Column('app_user_id', String(255), nullable=False),
+    Column('status', String(16), nullable=False, default='running'),
+    Column('stage', String(32), nullable=False, default='playlists'),
+    Column('song_feature_batches_done', Integer, nullable=False, default=0),
+    Column('artist_batches_done', Integer, nullable=False, default=0),
+    Column('started_at', TIMESTAMP, nullable=True, default=None),
+    Column('updated_at', TIMESTAMP, nullable=True, default=None),
+)
+
+ingest_checkpoint_playlists_v3 = Table(
+    'ingest_checkpoint_playlists', history_metadata,
+    Column('run_id', String(36), ForeignKey('ingest_checkpoints.run_id', ondelete='CASCADE'), nullable=False),
+    Column('playlist_id', String(255), nullable=False),
+    PrimaryKeyConstraint('run_id', 'playlist_id'),
+)
+
+playlist_feature_stats_v6 = Table(
+    'playlist_feature_stats', history_metadata,
+    Column('playlist_id', String(255), ForeignKey('playlists.playlist_id', ondelete='CASCADE'), nullable=False),
+    Column('feature', String(32), nullable=False),
+    Column('n', Integer, nullable=False, default=0),
+    Column('total', Float(precision=53), nullable=False, default=0),
+    Column('total_sq', Float(precision=53), nullable=False, default=0),
+    Column('histogram', Text, nullable=False),
+    Column('updated_at', TIMESTAMP, nullable=True, default=None),
+    PrimaryKeyConstraint('playlist_id', 'feature'),
+)
+
+feature_rollups_v7 = Table(
+    'feature_rollups', history_metadata,
+    Column('app_user_id', String(255), nullable=False),
+    Column('granularity', String(8), nullable=False),
+    Column('feature', String(32), nullable=False),
+    Column('bucket_start', Date, nullable=False),
+    Column('n', Integer, nullable=False, default=0),
+    Column('total', Float(precision=53), nullable=False, default=0),
+    Column('histogram', Text, nullable=False),
+    Column('updated_at', TIMESTAMP, nullable=True, default=None),
+    PrimaryKeyConstraint('app_user_id', 'granularity', 'feature', 'bucket_start'),
+)
+
+class CreateTable:
+    '''Creates a table from one of the definitions above if it does not exist yet'''
+    def __init__(self, table:Table) -> None:
+        self.table = table
+
+    def describe(self) -> str:
+        return f'create table {self.table.name}'
+
+    def apply(self, connection:Connection) -> bool:
+        if inspect(connection).has_table(self.table.name):
+            return False
+        self.table.create(connection)
+        return True
+
+class AddColumn:
+    '''Adds a column to an existing table if it is not there yet. ddl is the column definition after the name,
+    for example "VARCHAR(255) DEFAULT NULL"'''
+    def __init__(self, table_name:str, column_name:str, ddl:str) -> None:
+        self.table_name = table_name
+        self.column_name = column_name
+        self.ddl = ddl
+
+    def describe(self) -> str:
+        return f'add column {self.table_name}.{self.column_name}'
+
+    def apply(self, connection:Connection) -> bool:
+        existing_columns = [column['name'] for column in inspect(connection).get_columns(self.table_name)]
+        if self.column_name in existing_columns:
+            return False
+        connection.execute(text(f'ALTER TABLE {self.table_name} ADD COLUMN {self.column_name} {self.ddl}'))
+        return True
+
+class CreateIndex:
+    '''Creates an index if the table does not already have one with the same name or the same columns.
+    Checking the columns matters on mysql, which creates an index for each foreign key on its own'''
+    def __init__(self, index_name:str, table_name:str, column_names:List[str]) -> None:
+        self.index_name = index_name
+        self.table_name = table_name
+        self.column_names = column_names
+
+    def describe(self) -> str:
+        return f"create index {self.index_name} on {self.table_name} ({', '.join(self.column_names)})"
+
+    def apply(self, connection:Connection) -> bool:
+        for index in inspect(connection).get_indexes(self.table_name):
+            if index['name'] == self.index_name or index['column_names'] == self.column_names:
+                return False
+        connection.execute(text(f"CREATE INDEX {self.index_name} ON {self.table_name} ({', '.join(self.column_names)})"))
+        return True
+
+class RunSQL:
+    '''Runs a statement as is. It has to be safe to run more than once, since a migration is
+    run again from the start if it fails partway through'''
+    def __init__(self, sql:str, description:str) -> None:
+        self.sql = sql
+        self.description = description
+
+    def describe(self) -> str:
+        return self.description
+
+    def apply(self, connection:Connection) -> bool:
+        connection.execute(text(self.sql))
+        return True
+
+class Migration:
+    def __init__(self, version:int, name:str, operations:List) -> None:
+        self.version = version
+        self.name = name
+        self.operations = operations
+
+# Never edit a migration once it has been applied somewhere, add a new one to the end instead
+MIGRATIONS = [
+    Migration(1, 'initial schema', [
+        CreateTable(playlists_v1),
+        CreateTable(songs_v1),
+        CreateTable(artists_v1),
+        CreateTable(artist_genres_v1),
+        CreateTable(song_artists_v1),
+        CreateTable(playlist_songs_v1),
+    ]),
+    Migration(2, 'playlist snapshot ids', [
+        AddColumn('playlists', 'snapshot_id', 'VARCHAR(255) DEFAULT NULL'),
+    ]),
+    Migration(3, 'ingest checkpoints', [
+        CreateTable(ingest_checkpoints_v3),
+        CreateTable(ingest_checkpoint_playlists_v3),
+    ]),
+    Migration(4, 'secondary indexes for hot queries', [
+        # the playlist selector filters on app_user_id and sorts by last_updated
+        CreateIndex('ix_playlists_app_user_id_last_updated', 'playlists', ['app_user_id', 'last_updated']),
+        CreateIndex('ix_playlists_owner_id', 'playlists', ['owner_id']),
+        # the primary keys of these tables start with the other column, so they do not help lookups by song or artist
+        CreateIndex('ix_playlist_songs_song_id', 'playlist_songs', ['song_id']),
+        CreateIndex('ix_song_artists_artist_id', 'song_artists', ['artist_id']),
+        CreateIndex('ix_ingest_checkpoints_app_user_id_started_at', 'ingest_checkpoints', ['app_user_id', 'started_at']),
+    ]),
+    Migration(5, 'enrichment status', [
+        AddColumn('songs', 'features_status', "VARCHAR(16) NOT NULL DEFAULT 'pending'"),
+        AddColumn('songs', 'features_fetched_at', 'TIMESTAMP NULL DEFAULT NULL'),
+        AddColumn('artists', 'enrichment_status', "VARCHAR(16) NOT NULL DEFAULT 'pending'"),
+        AddColumn('artists', 'enriched_at', 'TIMESTAMP NULL DEFAULT NULL'),
+        # Existing rows that already have their data filled in were fetched before the status existed
+        RunSQL('''
+            UPDATE songs SET features_status = 'fetched'
+            WHERE features_status = 'pending'
+            AND acousticness IS NOT NULL AND danceability IS NOT NULL AND energy IS NOT NULL
+            AND instrumentalness IS NOT NULL AND liveness IS NOT NULL AND loudness IS NOT NULL
+            AND speechiness IS NOT NULL AND tempo IS NOT NULL AND valence IS NOT NULL''',
+            'mark songs with audio features as fetched'),
+        # popularity is set whenever the artists endpoint was called, even for artists without any genres
+        RunSQL('''
+            UPDATE artists SET enrichment_status = 'fetched'
+            WHERE enrichment_status = 'pending' AND popularity IS NOT NULL''',
+            'mark artists with a popularity as fetched'),
+        CreateIndex('ix_songs_features_status', 'songs', ['features_status']),
+        CreateIndex('ix_artists_enrichment_status', 'artists', ['enrichment_status']),
+    ]),
+    Migration(6, 'playlist feature stats', [
+        CreateTable(playlist_feature_stats_v6),
+        # finds the playlists whose stats changed when audio features are filled in
+        CreateIndex('ix_songs_features_fetched_at', 'songs', ['features_fetched_at']),
+    ]),
+    Migration(7, 'feature rollups', [
+        CreateTable(feature_rollups_v7),
+    ]),
+    Migration(8, 'checkpoint playlist added date ranges', [
+        AddColumn('ingest_checkpoint_playlists', 'first_added_date', 'TIMESTAMP NULL DEFAULT NULL'),
+        AddColumn('ingest_checkpoint_playlists', 'last_added_date', 'TIMESTAMP NULL DEFAULT NULL'),
+    ]),
+]
+
+def get_applied_versions(engine:Engine) -> Dict[int, Any]:
+    '''Returns the time each applied migration was applied, keyed by version'''
+    migration_metadata.create_all(engine, tables=[schema_migrations])
+    with engine.connect() as connection:
+        rows = connection.execute(schema_migrations.select()).fetchall()
+    return {row.version: row.applied_at for row in rows}
+
+def apply_migrations(engine:Engine, target_version:Optional[int]=None) -> List[int]:
+    '''Applies every migration up to target_version (or all of them) that has not been applied yet, in order.
+    Returns the versions that were applied'''
+    applied_versions = get_applied_versions(engine)
+    newly_applied = []
+    for migration in MIGRATIONS:
+        if migration.version in applied_versions or (target_version is not None and migration.version > target_version):
+            continue
+        # mysql commits after every DDL statement, so a migration that fails partway through cannot be rolled back.
+        # The operations check the schema before changing it, so running the migration again finishes the job
+        with engine.begin() as connection:
+            for operation in migration.operations:
+                changed = operation.apply(connection)
+                print(f"  {'applied' if changed else 'skipped'}: {operation.describe()}")
+            connection.execute(schema_migrations.insert().values(version=migration.version, name=migration.name,
+                                                                 applied_at=datetime.now()))
+        print(f'Applied migration {migration.version}: {migration.name}')
+        newly_applied.append(migration.version)
+    return newly_applied
+
+def get_hot_queries() -> Dict[str, tuple]:
+    '''Queries run on most page loads, with example parameters. Each one should be answered from an index,
+    check_hot_queries fails if any of them makes the database read every row of a table. The SQL is taken from the
+    helpers that run it so the check can not drift from the pages. They are imported here rather than at the top of
+    the module since they pull in streamlit'''
+    from streamlit_utils import USER_PLAYLISTS_QUERY, USER_EXISTS_QUERY
+    from database.loading import PENDING_SONGS_QUERY, PENDING_ARTISTS_QUERY
+    from database.rollups import get_feature_rollups_query
+    from pages.heardle import OWNED_SONGS_QUERY, MATCHING_PLAYLISTS_QUERY
+    from pages.playlist_feature_comparison import get_feature_query
+    from pages.artist_genre import get_artist_genres_query
+    playlist_set_params = {'app_user_id': 'user', 'playlist_id': 'playlist'}
+    return {
+        'user playlists': (USER_PLAYLISTS_QUERY, {'app_user_id': 'user'}),
+        'user exists': (USER_EXISTS_QUERY, {'app_user_id': 'user'}),
+        'owned playlist songs': (OWNED_SONGS_QUERY, {'app_user_id': 'user'}),
+        'playlists containing a song': (MATCHING_PLAYLISTS_QUERY, {'app_user_id': 'user', 'song_id': 'song'}),
+        'songs waiting on audio features': (PENDING_SONGS_QUERY, {}),
+        'artists waiting on genres': (PENDING_ARTISTS_QUERY, {}),
+        'feature rollups in a window': (get_feature_rollups_query(windowed=True),
+                                        {'app_user_id': 'user', 'granularity': 'day', 'feature': 'energy', 'start_date': '2024-01-01'}),
+        'features of a playlist': (get_feature_query('energy'), playlist_set_params),
+        'features of the other playlists': (get_feature_query('energy', exclude=True), playlist_set_params),
+        'genres of a playlist': (get_artist_genres_query(), playlist_set_params),
+        'genres of the other playlists': (get_artist_genres_query(exclude=True), playlist_set_params),
+    }
+
+# the dialects find_full_scans can read query plans from
+EXPLAIN_DIALECTS = ['mysql', 'sqlite']
+
+# FROM or JOIN, a table and its alias, e.g. FROM playlists AS p. The lookahead stops the keyword after a table that has
+# no alias from being read as one
+TABLE_ALIAS_PATTERN = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?(?!(?:WHERE|JOIN|ON|LEFT|RIGHT|INNER|OUTER|CROSS'
+                                 r'|GROUP|ORDER|LIMIT|UNION|HAVING)\b)(\w+)', re.IGNORECASE)
+
+def get_table_aliases(query:str) -> Dict[str, str]:
+    '''Maps every alias given to a table in the query back to the table's name'''
+    return {alias: table for table, alias in TABLE_ALIAS_PATTERN.findall(query)}
+
+def find_full_scans(connection:Connection, query, params:Dict[str, Any]) -> List[str]:
+    '''Runs EXPLAIN on the query, either SQL text or a sqlalchemy select, and returns the tables that the plan reads
+    in full'''
+    dialect = connection.dialect.name
+    if not isinstance(query, str):
+        query = str(query.compile(connection, compile_kwargs={'literal_binds': True}))
+    # both databases name a table by its alias in the plan when the query gives it one
+    aliases = get_table_aliases(query)
+    if dialect == 'mysql':
+        result = connection.execute(text('EXPLAIN ' + query), params)
+        # type ALL is a full table scan, anything else (ref, range, index lookups) is fine
+        return [aliases.get(row['table'], row['table']) for row in result.mappings() if row['type'] == 'ALL']
+    if dialect == 'sqlite':
+        result = connection.execute(text('EXPLAIN QUERY PLAN ' + query), params)
+        # sqlite describes each step as either SEARCH <table> USING INDEX ... or SCAN <table>, with older versions
+        # writing SCAN TABLE <table>. Scans of a constant row or of a subquery's results do not read a table
+        scanned_tables = []
+        for row in result:
+            if not row.detail.startswith('SCAN ') or row.detail.startswith(('SCAN CONSTANT', 'SCAN SUBQUERY', 'SCAN (')):
+                continue
+            scanned = row.detail[len('SCAN '):]
+            if scanned.startswith('TABLE '):
+                scanned = scanned[len('TABLE '):]
+            scanned = scanned.split()[0]
+            scanned_tables.append(aliases.get(scanned, scanned))
+        return scanned_tables
+    raise NotImplementedError(f'Checking query plans is not supported on {dialect}')
+
+def check_hot_queries(engine:Engine, hot_queries:Dict[str, tuple]) -> Dict[str, List[str]]:
+    '''Returns the tables scanned in full by each hot query, leaving out the queries that only use indexes'''
+    problems = {}
+    with engine.connect() as connection:
+        for query_name, (query, params) in hot_queries.items():
+            scanned_tables = find_full_scans(connection, query, params)
+            if scanned_tables:
+                problems[query_name] = scanned_tables
+    return problems
+
+def main(argv:Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description='Manage the database schema')
+    parser.add_argument('command', choices=['upgrade', 'status', 'check'])
+    parser.add_argument('--url', help='database url to use instead of the app database, e.g. sqlite:///local.sqlite')
+    parser.add_argument('--target', type=int, help='only upgrade up to this version')
+    args = parser.parse_args(argv)
+
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        from streamlit_utils import get_sqlalchemy_engine
+        engine = get_sqlalchemy_engine()
+
+    if args.command == 'upgrade':
+        newly_applied = apply_migrations(engine, target_version=args.target)
+        if not newly_applied:
+            print('The database is already up to date')
+    elif args.command == 'status':
+        applied_versions = get_applied_versions(engine)
+        for migration in MIGRATIONS:
+            applied_at = applied_versions.get(migration.version)
+            print(f"{migration.version:>4}  {migration.name:<40} {f'applied {applied_at}' if applied_at else 'pending'}")
+    elif args.command == 'check':
+        if engine.dialect.name not in EXPLAIN_DIALECTS:
+            print(f"Skipping the check, reading query plans is only supported on {' and '.join(EXPLAIN_DIALECTS)}, not {engine.dialect.name}")
+            return 0
+        hot_queries = get_hot_queries()
+        problems = check_hot_queries(engine, hot_queries)
+        for query_name, scanned_tables in problems.items():
+            print(f"FULL SCAN: {query_name} reads every row of {', '.join(scanned_tables)}")
+        if problems:
+            return 1
+        print(f'All {len(hot_queries)} hot queries use indexes')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,7 +8,10 @@ USE spotify_db;
 CREATE TABLE artists (
     artist_id VARCHAR(255) PRIMARY KEY, 
     name VARCHAR(255) NOT NULL,
-    popularity FLOAT
+    popularity FLOAT,
+    -- pending until the artists endpoint has been called for the artist, then fetched or failed
+    enrichment_status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    enriched_at TIMESTAMP NULL DEFAULT NULL
 );
 
 CREATE TABLE artist_genres (
@@ -36,7 +39,10 @@ CREATE TABLE songs (
     loudness FLOAT, 
     speechiness FLOAT, 
     tempo FLOAT, 
-    valence FLOAT
+    valence FLOAT,
+    -- pending until the audio features endpoint has been called for the song, then fetched or failed
+    features_status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    features_fetched_at TIMESTAMP NULL DEFAULT NULL
                     
 );
 
@@ -57,8 +63,11 @@ CREATE TABLE playlists (
     is_collaborative TINYINT(1),
     created_date TIMESTAMP DEFAULT NULL,  
     last_updated TIMESTAMP DEFAULT NULL,
-    app_user_id VARCHAR(255)
+    app_user_id VARCHAR(255),
+    snapshot_id VARCHAR(255) DEFAULT NULL
 );
+-- For a database created from an older version of this script run python -m database.migrations upgrade,
+-- which adds snapshot_id, the checkpoint tables and the indexes below to the existing tables
 -- Create `playlist_songs` Table
 CREATE TABLE playlist_songs (
     playlist_id VARCHAR(255),
@@ -68,4 +77,84 @@ CREATE TABLE playlist_songs (
     PRIMARY KEY (playlist_id, song_id),
     FOREIGN KEY (playlist_id) REFERENCES playlists(playlist_id) ON DELETE CASCADE,
     FOREIGN KEY (song_id) REFERENCES songs(song_id) ON DELETE CASCADE
-);
\ No newline at end of file
+);
+
+-- Create `ingest_checkpoints` Table
+-- Tracks the progress of each refresh so a failed refresh can pick up where it left off
+CREATE TABLE ingest_checkpoints (
+    run_id VARCHAR(36) PRIMARY KEY,
+    app_user_id VARCHAR(255) NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'running',
+    stage VARCHAR(32) NOT NULL DEFAULT 'playlists',
+    song_feature_batches_done INT NOT NULL DEFAULT 0,
+    artist_batches_done INT NOT NULL DEFAULT 0,
+    started_at TIMESTAMP NULL DEFAULT NULL,
+    updated_at TIMESTAMP NULL DEFAULT NULL
+);
+
+-- Create `ingest_checkpoint_playlists` Table
+-- The playlists that have been completely loaded during a refresh
+CREATE TABLE ingest_checkpoint_playlists (
+    run_id VARCHAR(36),
+    playlist_id VARCHAR(255),
+    -- first and last added dates of the playlist's songs before and after it was loaded
+    first_added_date TIMESTAMP NULL DEFAULT NULL,
+    last_added_date TIMESTAMP NULL DEFAULT NULL,
+    PRIMARY KEY (run_id, playlist_id),
+    FOREIGN KEY (run_id) REFERENCES ingest_checkpoints(run_id) ON DELETE CASCADE
+);
+
+-- Create `playlist_feature_stats` Table
+-- Count, sum, sum of squares and histogram of each song feature for every playlist, kept up to date by ingestion
+CREATE TABLE playlist_feature_stats (
+    playlist_id VARCHAR(255),
+    feature VARCHAR(32),
+    n INT NOT NULL DEFAULT 0,
+    total DOUBLE NOT NULL DEFAULT 0,
+    total_sq DOUBLE NOT NULL DEFAULT 0,
+    histogram TEXT NOT NULL,
+    updated_at TIMESTAMP NULL DEFAULT NULL,
+    PRIMARY KEY (playlist_id, feature),
+    FOREIGN KEY (playlist_id) REFERENCES playlists(playlist_id) ON DELETE CASCADE
+);
+
+-- Create `feature_rollups` Table
+-- Daily and monthly counts and histograms of the features of the songs each user added to their own playlists
+CREATE TABLE feature_rollups (
+    app_user_id VARCHAR(255),
+    granularity VARCHAR(8),
+    feature VARCHAR(32),
+    bucket_start DATE,
+    n INT NOT NULL DEFAULT 0,
+    total DOUBLE NOT NULL DEFAULT 0,
+    histogram TEXT NOT NULL,
+    updated_at TIMESTAMP NULL DEFAULT NULL,
+    PRIMARY KEY (app_user_id, granularity, feature, bucket_start)
+);
+
+-- Secondary indexes for the queries run on most page loads
+CREATE INDEX ix_playlists_app_user_id_last_updated ON playlists (app_user_id, last_updated);
+CREATE INDEX ix_playlists_owner_id ON playlists (owner_id);
+CREATE INDEX ix_playlist_songs_song_id ON playlist_songs (song_id);
+CREATE INDEX ix_song_artists_artist_id ON song_artists (artist_id);
+CREATE INDEX ix_ingest_checkpoints_app_user_id_started_at ON ingest_checkpoints (app_user_id, started_at);
+CREATE INDEX ix_songs_features_status ON songs (features_status);
+CREATE INDEX ix_artists_enrichment_status ON artists (enrichment_status);
+CREATE INDEX ix_songs_features_fetched_at ON songs (features_fetched_at);
+
+-- Tracks which migrations in database/migrations.py have been applied. A database created by this script
+-- already has everything up to version 8
+CREATE TABLE schema_migrations (
+    version INT PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    applied_at TIMESTAMP NULL DEFAULT NULL
+);
+INSERT INTO schema_migrations (version, name) VALUES
+    (1, 'initial schema'),
+    (2, 'playlist snapshot ids'),
+    (3, 'ingest checkpoints'),
+    (4, 'secondary indexes for hot queries'),
+    (5, 'enrichment status'),
+    (6, 'playlist feature stats'),
+    (7, 'feature rollups'),
+    (8, 'checkpoint playlist added date ranges');
@@ -0,0 +1,139 @@
+'''In process cache for the query helpers the analysis pages call on every rerun. Results are keyed by the function,
+its arguments and the current data generation, so a result is only ever reused while the data it was read from is
+unchanged. There are two generation counters: one per user, bumped when an ingest finishes or the user deletes their
+data, and a global one for the shared songs and artists tables, bumped when an ingest fills in song features or
+artist genres that any user's playlists may hold. Bumping a counter does not remove anything, old entries are just
+never looked up again and fall off the end of the LRU.
+
+The counters live in memory, which is enough since ingestion runs in the same process as the pages.'''
+import functools
+import inspect
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+class QueryCache:
+    '''Size bounded LRU of query results. Results are copied on the way in and out, so callers can modify the
+    dataframes they get back without changing the cached copy'''
+    def __init__(self, max_entries:int) -> None:
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._global_generation = 0
+        # app user id -> generation of the user's data
+        self._user_generations = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._uncacheable = 0
+
+    def get_generation(self, app_user_id:Optional[str]=None) -> tuple:
+        with self._lock:
+            return (self._global_generation, self._user_generations.get(app_user_id, 0) if app_user_id is not None else None)
+
+    def bump_generation(self, app_user_id:Optional[str]=None, shared:bool=False) -> None:
+        '''Marks the user's cached results as stale, and every user's results as well if shared is set'''
+        with self._lock:
+            if app_user_id is not None:
+                self._user_generations[app_user_id] = self._user_generations.get(app_user_id, 0) + 1
+            if shared:
+                self._global_generation += 1
+
+    def get(self, key:tuple) -> Any:
+        '''Returns a copy of the cached result, or raises KeyError if there is none'''
+        with self._lock:
+            try:
+                result = self._entries[key]
+            except KeyError:
+                self._misses += 1
+                raise
+            self._entries.move_to_end(key)
+            self._hits += 1
+        return copy_result(result)
+
+    def put(self, key:tuple, result:Any) -> None:
+        result = copy_result(result)
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def record_uncacheable(self) -> None:
+        with self._lock:
+            self._uncacheable += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else None,
+                'evictions': self._evictions,
+                'uncacheable_calls': self._uncacheable,
+                'global_generation': self._global_generation,
+            }
+
+def copy_result(result:Any) -> Any:
+    # dataframes and lists both have a copy method, anything else the helpers return is immutable
+    return result.copy() if hasattr(result, 'copy') else result
+
+def freeze(value:Any) -> Any:
+    '''Turns an argument into something hashable for the cache key'''
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    hash(value)
+    return value
+
+# Shared by every streamlit session in the server process
+query_cache = QueryCache(max_entries=int(os.environ.get('QUERY_CACHE_MAX_ENTRIES', 256)))
+
+def cached_query(user_argument:Optional[str]=None) -> Callable:
+    '''Caches the results of a query helper. The session argument is left out of the key. user_argument names the
+    argument holding the app user id, for helpers that only read that user's data. Calls given a snapshot are not
+    cached, the snapshot is already in memory'''
+    def decorator(function:Callable) -> Callable:
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = {name: value for name, value in bound.arguments.items() if name not in ('session', 'snapshot')}
+            if bound.arguments.get('snapshot') is not None:
+                return function(*args, **kwargs)
+            try:
+                frozen_arguments = tuple((name, freeze(value)) for name, value in arguments.items())
+            except TypeError:
+                query_cache.record_uncacheable()
+                return function(*args, **kwargs)
+            # read the generation before running the query, so a result that races with an ingest is stored under
+            # the generation that ingest is about to replace
+            generation = query_cache.get_generation(arguments.get(user_argument) if user_argument else None)
+            key = (function.__module__, function.__qualname__, generation, frozen_arguments)
+            try:
+                return query_cache.get(key)
+            except KeyError:
+                pass
+            result = function(*args, **kwargs)
+            query_cache.put(key, result)
+            return result
+        return wrapper
+    return decorator
+
+def bump_data_generation(app_user_id:Optional[str]=None, shared:bool=False) -> None:
+    query_cache.bump_generation(app_user_id, shared=shared)
+
+def get_query_cache_metrics() -> Dict[str, Any]:
+    return query_cache.get_metrics()
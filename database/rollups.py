@@ -0,0 +1,197 @@
+'''Daily and monthly rollups of the songs each user added to the playlists they own, for the historical song data
+page. For every user, bucket and feature the feature_rollups table holds the number of songs added in the bucket,
+the sum of their values and a histogram over the feature's fixed range from feature_stats.py. Histograms with the
+same bins can be added together, so the page builds weekly buckets out of daily ones and estimates the median of
+any bucket without reading the songs. At the end of every refresh ingestion rebuilds the months of a user's rollups
+that the refresh changed, see get_changed_rollup_months.
+
+The histograms use more bins than the playlist stats since the medians are read straight off them, and are stored
+sparsely as {bin index: count} because most bins of a single day are empty.'''
+import json
+from datetime import datetime, date
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from database.sqlalchemy_model import FeatureRollup, IngestCheckpoint
+from database.feature_stats import FEATURE_RANGES, estimate_quantile
+
+ROLLUP_HISTOGRAM_BINS = 200
+GRANULARITIES = ['day', 'month']
+
+def get_owned_song_features(session:Session, app_user_id:str, start_date:Optional[date]=None,
+                            end_date:Optional[date]=None) -> pd.DataFrame:
+    '''Gets when each song was added to a playlist the user owns along with its features, only for the songs added
+    from start_date up to but not including end_date if they are given'''
+    query = '''
+    SELECT ps.added_date, s.popularity, s.acousticness, s.danceability, s.energy, s.instrumentalness, s.liveness,
+           s.loudness, s.speechiness, s.tempo, s.valence, s.duration_ms / 1000.0 AS duration_seconds
+    FROM playlists AS p
+    JOIN playlist_songs AS ps ON p.playlist_id=ps.playlist_id
+    JOIN songs AS s ON ps.song_id=s.song_id
+    WHERE p.app_user_id = :app_user_id AND p.owner_id = :app_user_id AND ps.added_date IS NOT NULL
+    '''
+    params = {'app_user_id': app_user_id}
+    if start_date is not None:
+        query += ' AND ps.added_date >= :start_date AND ps.added_date < :end_date'
+        params.update(start_date=start_date, end_date=end_date)
+    result = session.execute(text(query), params)
+    return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+def get_bucket_start(added_dates:pd.Series, granularity:str) -> pd.Series:
+    if granularity == 'day':
+        return added_dates.dt.floor('D').dt.date
+    return added_dates.dt.to_period('M').dt.to_timestamp().dt.date
+
+def compute_feature_rollups(app_user_id:str, song_features_df:pd.DataFrame) -> List[Dict]:
+    '''Computes the rollup rows of every bucket and feature from the dataframe returned by get_owned_song_features'''
+    if song_features_df.empty:
+        return []
+    updated_at = datetime.now()
+    added_dates = pd.to_datetime(song_features_df['added_date'])
+    rollup_rows = []
+    for feature, (low, high) in FEATURE_RANGES.items():
+        values = pd.to_numeric(song_features_df[feature], errors='coerce').to_numpy(dtype=float)
+        has_value = ~np.isnan(values)
+        # the bin of each value, computed for every song at once rather than one histogram call per bucket
+        bin_width = (high - low) / ROLLUP_HISTOGRAM_BINS
+        bins = np.clip(np.floor((values[has_value] - low) / bin_width), 0, ROLLUP_HISTOGRAM_BINS - 1).astype(np.int64)
+        for granularity in GRANULARITIES:
+            binned_df = pd.DataFrame({
+                'bucket_start': get_bucket_start(added_dates[has_value], granularity).to_numpy(),
+                'bin': bins,
+                'value': values[has_value],
+            })
+            bin_counts = binned_df.groupby(['bucket_start', 'bin']).size()
+            totals = binned_df.groupby('bucket_start')['value'].agg(['size', 'sum'])
+            for bucket_start, bucket_counts in bin_counts.groupby(level='bucket_start'):
+                histogram = {int(bin_index): int(count) for (_, bin_index), count in bucket_counts.items()}
+                rollup_rows.append({
+                    'app_user_id': app_user_id,
+                    'granularity': granularity,
+                    'feature': feature,
+                    'bucket_start': bucket_start,
+                    'n': int(totals.at[bucket_start, 'size']),
+                    'total': float(totals.at[bucket_start, 'sum']),
+                    'histogram': json.dumps(histogram),
+                    'updated_at': updated_at,
+                })
+    return rollup_rows
+
+def has_feature_rollups(session:Session, app_user_id:str) -> bool:
+    '''Checks if the user has any rollups at all'''
+    result = session.execute(text('SELECT 1 FROM feature_rollups WHERE app_user_id = :app_user_id LIMIT 1'),
+                             {'app_user_id': app_user_id})
+    return result.fetchone() is not None
+
+def refresh_feature_rollups(session:Session, app_user_id:str, month_ranges:Optional[List[Tuple[date, date]]]=None,
+                            batch_size:int=1000) -> None:
+    '''Rebuilds the user's rollups in each of the [start, end) month ranges from their songs. Every rollup is rebuilt
+    when month_ranges is None or the user has no rollups yet. The day and month buckets of a month always lie in
+    the same range, so the rebuilt rows replace exactly the ones deleted'''
+    if month_ranges is None or not has_feature_rollups(session, app_user_id):
+        rollup_rows = compute_feature_rollups(app_user_id, get_owned_song_features(session, app_user_id))
+        session.query(FeatureRollup).filter(FeatureRollup.app_user_id == app_user_id).delete(synchronize_session=False)
+        month_ranges = []
+    else:
+        rollup_rows = []
+    for start_date, end_date in month_ranges:
+        song_features_df = get_owned_song_features(session, app_user_id, start_date, end_date)
+        rollup_rows += compute_feature_rollups(app_user_id, song_features_df)
+        (session.query(FeatureRollup)
+         .filter(FeatureRollup.app_user_id == app_user_id,
+                 FeatureRollup.bucket_start >= start_date, FeatureRollup.bucket_start < end_date)
+         .delete(synchronize_session=False))
+    for i in range(0, len(rollup_rows), batch_size):
+        session.execute(FeatureRollup.__table__.insert(), rollup_rows[i:i + batch_size])
+    session.commit()
+
+def get_users_needing_rollups(session:Session, checkpoint:IngestCheckpoint) -> List[str]:
+    '''The user of the refresh, and every user who owns a playlist holding a song whose audio features were filled
+    in during the refresh'''
+    query = text('''
+    SELECT DISTINCT p.app_user_id
+    FROM songs AS s
+    JOIN playlist_songs AS ps ON s.song_id=ps.song_id
+    JOIN playlists AS p ON ps.playlist_id=p.playlist_id
+    WHERE s.features_fetched_at >= :started_at AND p.owner_id = p.app_user_id
+    ''')
+    result = session.execute(query, {'started_at': checkpoint.started_at})
+    other_users = [row[0] for row in result.fetchall() if row[0] != checkpoint.app_user_id]
+    return [checkpoint.app_user_id] + other_users
+
+def get_changed_rollup_months(session:Session, app_user_id:str, checkpoint:IngestCheckpoint) -> List[Tuple[date, date]]:
+    '''The months of the user's rollups that the refresh changed, merged into [start, end) ranges of whole months. These
+    are the months spanned by the added dates of the user's playlists loaded in the refresh, and the months the user
+    added the songs whose audio features were filled in during the refresh'''
+    span_query = text('''
+    SELECT cp.first_added_date, cp.last_added_date
+    FROM ingest_checkpoint_playlists AS cp
+    JOIN playlists AS p ON cp.playlist_id=p.playlist_id
+    WHERE cp.run_id = :run_id AND p.app_user_id = :app_user_id AND p.owner_id = :app_user_id
+          AND cp.first_added_date IS NOT NULL
+    ''')
+    features_query = text('''
+    SELECT DISTINCT ps.added_date
+    FROM songs AS s
+    JOIN playlist_songs AS ps ON s.song_id=ps.song_id
+    JOIN playlists AS p ON ps.playlist_id=p.playlist_id
+    WHERE s.features_fetched_at >= :started_at AND p.app_user_id = :app_user_id AND p.owner_id = :app_user_id
+          AND ps.added_date IS NOT NULL
+    ''')
+    params = {'run_id': checkpoint.run_id, 'app_user_id': app_user_id, 'started_at': checkpoint.started_at}
+    months = set()
+    for first_added_date, last_added_date in session.execute(span_query, params).fetchall():
+        months.update(pd.period_range(pd.Timestamp(first_added_date).to_period('M'),
+                                      pd.Timestamp(last_added_date).to_period('M'), freq='M'))
+    months.update(pd.Timestamp(row[0]).to_period('M') for row in session.execute(features_query, params).fetchall())
+
+    month_ranges = []
+    for month in sorted(months):
+        if month_ranges and month_ranges[-1][1] == month:
+            month_ranges[-1][1] = month + 1
+        else:
+            month_ranges.append([month, month + 1])
+    return [(start.to_timestamp().date(), end.to_timestamp().date()) for start, end in month_ranges]
+
+def get_feature_rollups_query(windowed:bool=False) -> str:
+    '''SQL for one user's rollups of a feature, from :start_date on if windowed'''
+    query = '''
+    SELECT bucket_start, n, histogram
+    FROM feature_rollups
+    WHERE app_user_id = :app_user_id AND granularity = :granularity AND feature = :feature
+    '''
+    if windowed:
+        query += ' AND bucket_start >= :start_date'
+    return query + ' ORDER BY bucket_start'
+
+def get_feature_rollups(session:Session, app_user_id:str, feature:str, granularity:str,
+                        start_date:Optional[date]=None) -> Optional[pd.DataFrame]:
+    '''Gets the user's rollups of the feature from start_date on. Returns None if the user has no rollups at all, which
+    means their last refresh finished before rollups existed'''
+    params = {'app_user_id': app_user_id, 'granularity': granularity, 'feature': feature}
+    if start_date is not None:
+        params['start_date'] = start_date
+    result = session.execute(text(get_feature_rollups_query(windowed=start_date is not None)), params)
+    rollup_df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+    if rollup_df.empty and not has_feature_rollups(session, app_user_id):
+        return None
+    return rollup_df
+
+def merge_rollups(rollup_df:pd.DataFrame, feature:str, bin_freq:str, q:float=0.5) -> pd.DataFrame:
+    '''Merges the rollups into buckets of the given pandas period (D, W or M) and estimates the quantile of each one.
+    Returns a dataframe with a date_bin column and the estimate in a column named after the feature'''
+    if rollup_df.empty:
+        return pd.DataFrame({'date_bin': pd.Series(dtype='datetime64[ns]'), feature: pd.Series(dtype=float)})
+    date_bins = pd.to_datetime(rollup_df['bucket_start']).dt.to_period(bin_freq).dt.to_timestamp()
+    merged_rows = []
+    for date_bin, bucket_histograms in rollup_df.groupby(date_bins)['histogram']:
+        histogram = np.zeros(ROLLUP_HISTOGRAM_BINS, dtype=np.int64)
+        for sparse_histogram in bucket_histograms:
+            for bin_index, count in json.loads(sparse_histogram).items():
+                histogram[int(bin_index)] += count
+        merged_rows.append({'date_bin': date_bin, feature: estimate_quantile(feature, histogram, q)})
+    return pd.DataFrame(merged_rows)
@@ -0,0 +1,246 @@
+'''Per user snapshots of the data the analysis pages read. When an ingest finishes the user's playlists, playlist
+songs, song features, song artists and artist genres are written out as Arrow IPC files, and the pages read those
+instead of querying the database on every rerun. The files are opened with a memory map, so loading them does not
+copy the data, and a snapshot is never changed once written: a new ingest writes a new snapshot next to it and then
+points the user's CURRENT file at it. A failed ingest or deleting the user's data removes the pointer, and the pages
+fall back to the database until the next ingest finishes.
+
+Song features and artist genres are shared between users, so another user's ingest can fill in data a snapshot is
+missing. That ingest removes the snapshots of the users whose songs or artists it changed, see
+get_users_with_changed_shared_data, and those users read the database until their next refresh.'''
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from database.sqlalchemy_model import IngestCheckpoint
+from database.feature_stats import USER_PLAYLIST_STATS_QUERY, compute_playlist_feature_averages
+
+DEFAULT_SNAPSHOT_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.data', 'snapshots')
+SNAPSHOT_DIRECTORY = os.environ.get('SNAPSHOT_DIRECTORY', DEFAULT_SNAPSHOT_DIRECTORY)
+
+FEATURE_COLUMNS = ['popularity', 'acousticness', 'danceability', 'energy', 'instrumentalness', 'liveness', 'loudness',
+                   'speechiness', 'tempo', 'valence']
+
+# songs on any of the user's playlists
+USER_SONGS_SUBQUERY = '''
+    SELECT DISTINCT ps.song_id
+    FROM playlist_songs AS ps
+    JOIN playlists AS p ON ps.playlist_id=p.playlist_id
+    WHERE p.app_user_id = :app_user_id
+'''
+
+SNAPSHOT_QUERIES = {
+    'playlists': '''
+    SELECT playlist_id, name, owner_id, is_collaborative, last_updated
+    FROM playlists
+    WHERE app_user_id = :app_user_id
+    ''',
+    'playlist_songs': '''
+    SELECT ps.playlist_id, ps.song_id, ps.added_date
+    FROM playlist_songs AS ps
+    JOIN playlists AS p ON ps.playlist_id=p.playlist_id
+    WHERE p.app_user_id = :app_user_id
+    ''',
+    'songs': f'''
+    SELECT s.song_id, s.title, s.duration_ms, {', '.join('s.' + column for column in FEATURE_COLUMNS)}
+    FROM songs AS s
+    WHERE s.song_id IN ({USER_SONGS_SUBQUERY})
+    ''',
+    'song_artists': f'''
+    SELECT sa.song_id, sa.artist_id, a.name
+    FROM song_artists AS sa
+    JOIN artists AS a ON sa.artist_id=a.artist_id
+    WHERE sa.song_id IN ({USER_SONGS_SUBQUERY})
+    ''',
+    'artist_genres': f'''
+    SELECT ag.artist_id, ag.genre
+    FROM artist_genres AS ag
+    WHERE ag.artist_id IN (
+        SELECT sa.artist_id
+        FROM song_artists AS sa
+        WHERE sa.song_id IN ({USER_SONGS_SUBQUERY})
+    )
+    ''',
+    'playlist_feature_stats': USER_PLAYLIST_STATS_QUERY,
+}
+
+def get_users_with_changed_shared_data(session:Session, checkpoint:IngestCheckpoint) -> List[str]:
+    '''Every user other than the refresh's own who has a song on one of their playlists whose audio features, or
+    whose artists' genres, were filled in during the refresh'''
+    query = text('''
+    SELECT p.app_user_id
+    FROM songs AS s
+    JOIN playlist_songs AS ps ON s.song_id=ps.song_id
+    JOIN playlists AS p ON ps.playlist_id=p.playlist_id
+    WHERE s.features_fetched_at >= :started_at
+    UNION
+    SELECT p.app_user_id
+    FROM artists AS a
+    JOIN song_artists AS sa ON a.artist_id=sa.artist_id
+    JOIN playlist_songs AS ps ON sa.song_id=ps.song_id
+    JOIN playlists AS p ON ps.playlist_id=p.playlist_id
+    WHERE a.enriched_at >= :started_at
+    ''')
+    result = session.execute(query, {'started_at': checkpoint.started_at})
+    return [row[0] for row in result.fetchall() if row[0] != checkpoint.app_user_id]
+
+def get_user_directory(app_user_id:str) -> str:
+    # spotify user ids can hold characters that are not safe in a path, so the directory is named after a hash
+    return os.path.join(SNAPSHOT_DIRECTORY, hashlib.sha256(app_user_id.encode('utf-8')).hexdigest()[:32])
+
+# app user id -> lock held while the user's snapshot is published or invalidated, so one can not remove the files the
+# other is writing. Ingestion runs in the same process as the pages, so an in process lock is enough
+_user_locks = {}
+_user_locks_lock = threading.Lock()
+
+def get_user_lock(app_user_id:str) -> threading.Lock:
+    with _user_locks_lock:
+        return _user_locks.setdefault(app_user_id, threading.Lock())
+
+def get_current_snapshot_name(app_user_id:str) -> Optional[str]:
+    try:
+        with open(os.path.join(get_user_directory(app_user_id), 'CURRENT')) as current_file:
+            return current_file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def write_arrow_table(path:str, table:pa.Table) -> None:
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+def read_arrow_table(path:str) -> pa.Table:
+    '''Reads an Arrow IPC file through a memory map. The table's buffers point into the mapped file instead of
+    being copied, and keep the map open for as long as the table is alive'''
+    with pa.memory_map(path, 'r') as source:
+        return pa.ipc.open_file(source).read_all()
+
+def publish_user_snapshot(session:Session, app_user_id:str) -> str:
+    '''Writes a new snapshot of the user's data and makes it the current one. Returns the name of the snapshot'''
+    with get_user_lock(app_user_id):
+        user_directory = get_user_directory(app_user_id)
+        snapshot_name = datetime.now().strftime('%Y%m%d%H%M%S') + '-' + uuid.uuid4().hex[:8]
+        # written under a temporary name so a half written snapshot is never picked up
+        temporary_directory = os.path.join(user_directory, snapshot_name + '.tmp')
+        os.makedirs(temporary_directory, exist_ok=True)
+        for table_name, query in SNAPSHOT_QUERIES.items():
+            result = session.execute(text(query), {'app_user_id': app_user_id})
+            df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+            write_arrow_table(os.path.join(temporary_directory, f'{table_name}.arrow'), pa.Table.from_pandas(df, preserve_index=False))
+        os.rename(temporary_directory, os.path.join(user_directory, snapshot_name))
+        current_path = os.path.join(user_directory, 'CURRENT')
+        with open(current_path + '.tmp', 'w') as current_file:
+            current_file.write(snapshot_name)
+        os.replace(current_path + '.tmp', current_path)
+        # Older snapshots can go now. Pages that still have one mapped keep reading it, the file is only freed once
+        # they let go of it
+        for entry in os.listdir(user_directory):
+            if entry != snapshot_name and os.path.isdir(os.path.join(user_directory, entry)):
+                shutil.rmtree(os.path.join(user_directory, entry), ignore_errors=True)
+        return snapshot_name
+
+def invalidate_user_snapshot(app_user_id:str) -> None:
+    '''Stops the pages from using the user's snapshot, so they read from the database until a new one is published'''
+    with get_user_lock(app_user_id):
+        with _snapshots_lock:
+            _snapshots.pop(app_user_id, None)
+        user_directory = get_user_directory(app_user_id)
+        try:
+            os.remove(os.path.join(user_directory, 'CURRENT'))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(user_directory, ignore_errors=True)
+
+class UserSnapshot:
+    '''One published snapshot of a user's data. Each method returns the same dataframe as the database query it
+    stands in for on the pages'''
+    def __init__(self, app_user_id:str, name:str, tables:Dict[str, pa.Table]) -> None:
+        self.app_user_id = app_user_id
+        self.name = name
+        self.tables = tables
+        self._frames = {}
+        self._lock = threading.Lock()
+
+    def frame(self, table_name:str) -> pd.DataFrame:
+        '''The table as a dataframe. Converted once and shared by every rerun, so callers must not modify it'''
+        with self._lock:
+            if table_name not in self._frames:
+                self._frames[table_name] = self.tables[table_name].to_pandas()
+            return self._frames[table_name]
+
+    def get_playlist_df(self) -> pd.DataFrame:
+        playlists = self.frame('playlists').sort_values('last_updated', ascending=False, na_position='last')
+        return playlists[['playlist_id', 'name', 'owner_id', 'is_collaborative']].reset_index(drop=True)
+
+    def get_playlist_set_song_ids(self, playlist_id:str, exclude:bool=False) -> List[str]:
+        '''The distinct songs of the playlist, or with exclude of every other playlist'''
+        playlist_songs = self.frame('playlist_songs')
+        if exclude:
+            song_ids = playlist_songs.loc[playlist_songs['playlist_id'] != playlist_id, 'song_id']
+        else:
+            song_ids = playlist_songs.loc[playlist_songs['playlist_id'] == playlist_id, 'song_id']
+        return list(pd.unique(song_ids))
+
+    def get_song_features(self, song_id_list:List[str], columns:List[str]) -> pd.DataFrame:
+        songs = self.frame('songs')
+        return songs.loc[songs['song_id'].isin(song_id_list), columns].reset_index(drop=True)
+
+    def get_artist_genre_df(self, song_id_list:List[str]) -> pd.DataFrame:
+        song_artists = self.frame('song_artists')
+        song_artists = song_artists[song_artists['song_id'].isin(set(song_id_list))]
+        artist_genre_df = song_artists.merge(self.frame('artist_genres'), on='artist_id')
+        return artist_genre_df[['genre', 'name']].reset_index(drop=True)
+
+    def get_song_df(self) -> pd.DataFrame:
+        '''Songs added to the playlists the user owns along with when they were added, newest first'''
+        playlists = self.frame('playlists')
+        owned_playlist_ids = playlists.loc[playlists['owner_id'] == self.app_user_id, 'playlist_id']
+        playlist_songs = self.frame('playlist_songs')
+        playlist_songs = playlist_songs[playlist_songs['playlist_id'].isin(owned_playlist_ids) & playlist_songs['added_date'].notna()]
+        song_df = playlist_songs[['song_id', 'added_date']].merge(self.frame('songs'), on='song_id')
+        song_df['duration_seconds'] = song_df['duration_ms'] / 1000.0
+        song_df['added_date'] = pd.to_datetime(song_df['added_date'])
+        song_df = song_df.sort_values('added_date', ascending=False).reset_index(drop=True)
+        return song_df[['song_id', 'added_date', 'duration_seconds'] + FEATURE_COLUMNS]
+
+    def get_playlist_averages(self) -> Optional[pd.DataFrame]:
+        '''The average of every feature for each of the user's playlists from their stats, or None if the playlists
+        had no stats when the snapshot was written'''
+        stats = self.frame('playlist_feature_stats')
+        if stats.empty:
+            return None
+        return compute_playlist_feature_averages(stats)
+
+# app user id -> the UserSnapshot loaded by this process
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+def load_user_snapshot(app_user_id:str) -> Optional[UserSnapshot]:
+    '''Returns the user's current snapshot, or None if there is none and the pages should query the database. A
+    snapshot is only read from disk the first time it is used, later reruns get it from memory'''
+    snapshot_name = get_current_snapshot_name(app_user_id)
+    if snapshot_name is None:
+        return None
+    with _snapshots_lock:
+        snapshot = _snapshots.get(app_user_id)
+    if snapshot is None or snapshot.name != snapshot_name:
+        snapshot_directory = os.path.join(get_user_directory(app_user_id), snapshot_name)
+        try:
+            tables = {table_name: read_arrow_table(os.path.join(snapshot_directory, f'{table_name}.arrow'))
+                      for table_name in SNAPSHOT_QUERIES}
+        except (FileNotFoundError, pa.ArrowInvalid):
+            # replaced or invalidated while we were reading it
+            return None
+        snapshot = UserSnapshot(app_user_id, snapshot_name, tables)
+        with _snapshots_lock:
+            _snapshots[app_user_id] = snapshot
+    return snapshot
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, TIMESTAMP, ForeignKey, PrimaryKeyConstraint, Float, Boolean, Date
+from sqlalchemy import Column, String, TIMESTAMP, ForeignKey, PrimaryKeyConstraint, Float, Boolean, Date, Integer, Index, Text
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 
@@ -11,6 +11,14 @@ class Playlist(Base):
     created_date = Column(TIMESTAMP, nullable=True, default=None)
     last_updated = Column(TIMESTAMP, nullable=True, default=None)
     app_user_id = Column(String(255), nullable=False)
+    # snapshot_id from the spotify api, only stored once all of the playlist's songs have been loaded
+    snapshot_id = Column(String(255), nullable=True, default=None)
+
+    # Indexes are added to existing databases by the migrations in migrations.py, keep the two in sync
+    __table_args__ = (
+        Index('ix_playlists_app_user_id_last_updated', 'app_user_id', 'last_updated'),
+        Index('ix_playlists_owner_id', 'owner_id'),
+    )
 
 class Songs(Base):
     __tablename__ = 'songs'
@@ -31,6 +39,14 @@ class Songs(Base):
     speechiness = Column(Float)
     tempo = Column(Float)
     valence = Column(Float)
+    # pending until the audio features endpoint has been called for the song, then fetched or failed
+    features_status = Column(String(16), nullable=False, default='pending', server_default='pending')
+    features_fetched_at = Column(TIMESTAMP, nullable=True, default=None)
+
+    __table_args__ = (
+        Index('ix_songs_features_status', 'features_status'),
+        Index('ix_songs_features_fetched_at', 'features_fetched_at'),
+    )
 
 class PlaylistSongs(Base):
     __tablename__ = 'playlist_songs'
@@ -42,6 +58,7 @@ class PlaylistSongs(Base):
 
     __table_args__ = (
         PrimaryKeyConstraint('playlist_id', 'song_id'),
+        Index('ix_playlist_songs_song_id', 'song_id'),
     )
 
 class Artist(Base):
@@ -50,6 +67,13 @@ class Artist(Base):
     artist_id = Column(String(255), primary_key=True)
     name = Column(String(255), nullable=False)
     popularity = Column(Float)
+    # pending until the artists endpoint has been called for the artist, then fetched or failed
+    enrichment_status = Column(String(16), nullable=False, default='pending', server_default='pending')
+    enriched_at = Column(TIMESTAMP, nullable=True, default=None)
+
+    __table_args__ = (
+        Index('ix_artists_enrichment_status', 'enrichment_status'),
+    )
 
 class ArtistGenre(Base):
     __tablename__ = 'artist_genres'
@@ -69,4 +93,76 @@ class SongArtist(Base):
 
     __table_args__ = (
         PrimaryKeyConstraint('song_id', 'artist_id'),
+        Index('ix_song_artists_artist_id', 'artist_id'),
+    )
+
+class IngestCheckpoint(Base):
+    __tablename__ = 'ingest_checkpoints'
+
+    run_id = Column(String(36), primary_key=True)
+    app_user_id = Column(String(255), nullable=False)
+    # running, failed, complete, or summaries_failed when the data was loaded but the feature stats or rollups
+    # stage failed
+    status = Column(String(16), nullable=False, default='running')
+    # playlists, song_features, artists, feature_stats or rollups
+    stage = Column(String(32), nullable=False, default='playlists')
+    song_feature_batches_done = Column(Integer, nullable=False, default=0)
+    artist_batches_done = Column(Integer, nullable=False, default=0)
+    started_at = Column(TIMESTAMP, nullable=True, default=None)
+    updated_at = Column(TIMESTAMP, nullable=True, default=None)
+
+    __table_args__ = (
+        Index('ix_ingest_checkpoints_app_user_id_started_at', 'app_user_id', 'started_at'),
+    )
+
+class IngestCheckpointPlaylist(Base):
+    __tablename__ = 'ingest_checkpoint_playlists'
+
+    run_id = Column(String(36), ForeignKey('ingest_checkpoints.run_id', ondelete='CASCADE'), nullable=False)
+    playlist_id = Column(String(255), nullable=False)
+    # first and last added dates of the playlist's songs before and after it was loaded, the range of the rollups it changed
+    first_added_date = Column(TIMESTAMP, nullable=True, default=None)
+    last_added_date = Column(TIMESTAMP, nullable=True, default=None)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('run_id', 'playlist_id'),
+    )
+
+class PlaylistFeatureStats(Base):
+    __tablename__ = 'playlist_feature_stats'
+
+    playlist_id = Column(String(255), ForeignKey('playlists.playlist_id', ondelete='CASCADE'), nullable=False)
+    # song feature name, e.g. energy or duration_seconds
+    feature = Column(String(32), nullable=False)
+    # number of songs on the playlist that have the feature, with the sum and sum of squares of their values
+    n = Column(Integer, nullable=False, default=0)
+    total = Column(Float(precision=53), nullable=False, default=0)
+    total_sq = Column(Float(precision=53), nullable=False, default=0)
+    # json list of counts over the fixed bins of the feature in database/feature_stats.py
+    histogram = Column(Text, nullable=False)
+    updated_at = Column(TIMESTAMP, nullable=True, default=None)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('playlist_id', 'feature'),
+    )
+
+class FeatureRollup(Base):
+    __tablename__ = 'feature_rollups'
+
+    app_user_id = Column(String(255), nullable=False)
+    # day or month
+    granularity = Column(String(8), nullable=False)
+    feature = Column(String(32), nullable=False)
+    # first day of the bucket
+    bucket_start = Column(Date, nullable=False)
+    # number of songs added in the bucket that have the feature, and the sum of their values
+    n = Column(Integer, nullable=False, default=0)
+    total = Column(Float(precision=53), nullable=False, default=0)
+    # sparse json histogram over the fixed range of the feature, see database/rollups.py
+    histogram = Column(Text, nullable=False)
+    updated_at = Column(TIMESTAMP, nullable=True, default=None)
+
+    # the page reads one user, granularity and feature over a range of buckets, which is a prefix of the key
+    __table_args__ = (
+        PrimaryKeyConstraint('app_user_id', 'granularity', 'feature', 'bucket_start'),
     )
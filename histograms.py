@@ -0,0 +1,70 @@
+'''Histograms for the analysis pages. The bin edges and counts are worked out here with numpy and the figure only gets
+one bar per bin, so the payload sent to the browser stays the same size however many songs a playlist has, where
+px.histogram would send every value and bin them in the browser.'''
+import os
+import numpy as np
+import plotly.graph_objects as go
+
+from typing import List, Tuple, Union
+
+# Number of bins, or fd to size the bins with the Freedman-Diaconis rule
+HISTOGRAM_BINS = os.environ.get('HISTOGRAM_BINS', '20')
+MAX_HISTOGRAM_BINS = 100
+
+def freedman_diaconis_rule(values:np.ndarray) -> int:
+    '''Number of bins of width 2 * IQR / n^(1/3) that cover the values. Falls back to the square root of the number
+    of values when the IQR is 0, for example when most songs share the same value'''
+    values = values[~np.isnan(values)]
+    if values.size < 2:
+        return 1
+    q25, q75 = np.percentile(values, [25, 75])
+    value_range = values.max() - values.min()
+    bin_width = 2 * (q75 - q25) / np.cbrt(values.size)
+    if bin_width == 0 or value_range == 0:
+        bin_count = int(np.ceil(np.sqrt(values.size)))
+    else:
+        bin_count = int(np.ceil(value_range / bin_width))
+    return max(1, min(bin_count, MAX_HISTOGRAM_BINS))
+
+def get_histogram_edges(value_arrays:List[np.ndarray], bins:Union[int, str]=HISTOGRAM_BINS) -> np.ndarray:
+    '''Bin edges shared by every array, so that the bars of each one line up when they are drawn on top of each other'''
+    values = np.concatenate([np.asarray(value_array, dtype=float) for value_array in value_arrays] or [np.empty(0)])
+    values = values[~np.isnan(values)]
+    if values.size == 0:
+        return np.empty(0)
+    low, high = values.min(), values.max()
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    bin_count = freedman_diaconis_rule(values) if str(bins).lower() == 'fd' else int(bins)
+    return np.linspace(low, high, bin_count + 1)
+
+def compute_histogram(values:np.ndarray, edges:np.ndarray) -> Tuple[np.ndarray, float]:
+    '''Returns the fraction of the values that falls in each bin along with the median of the values. Missing values
+    are left out of both'''
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if values.size == 0 or edges.size == 0:
+        return np.zeros(max(edges.size - 1, 0)), np.nan
+    counts, _ = np.histogram(values, bins=edges)
+    return counts / values.size, float(np.median(values))
+
+def plot_binned_histogram(named_values:List[Tuple[str, np.ndarray]], colors:List[str],
+                          bins:Union[int, str]=HISTOGRAM_BINS) -> Tuple[go.Figure, List[float]]:
+    '''Draws the normalized histogram of each (name, values) pair as pre-binned bars overlaid on one figure.
+    Returns the figure and the median of each set of values'''
+    edges = get_histogram_edges([values for _, values in named_values], bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    fig = go.Figure()
+    medians = []
+    for (name, values), color in zip(named_values, colors):
+        probabilities, median = compute_histogram(values, edges)
+        medians.append(median)
+        fig.add_trace(go.Bar(x=centers, y=probabilities, name=name, marker_color=color,
+                             # the edges of the bin show up when hovering over the bar
+                             customdata=np.stack([edges[:-1], edges[1:]], axis=-1) if edges.size else None,
+                             hovertemplate='%{customdata[0]:.3g} - %{customdata[1]:.3g}: %{y:.1%}'))
+    fig.update_layout(barmode='overlay')
+    if len(named_values) > 1:
+        # see through so the other playlist's bars show under each bar
+        fig.update_traces(opacity=0.6)
+    return fig, medians
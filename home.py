@@ -1,101 +1,50 @@
 import streamlit as st 
 import os
 from spotify_api.api import SpotifyAPI
-from spotify_api.utils import *
-from database.loading import *
-from streamlit_utils import check_if_user_exists
-import time
+from streamlit_utils import get_user_exists, clear_user_exists
+from ingestion import start_ingestion_job, get_ingestion_job
 
-def fetch_and_store_data(spotify:SpotifyAPI, app_user_id:str) -> None:
-    user_playlists = spotify.get_user_playlists()
-    playlist_data = extract_playlist_details(user_playlists, app_user_id)
-    session = create_sqlalchemy_session()
-    # save all user playlist data to the database
-    load_playlists_data(session, playlist_data)
-    playlist_id_list = playlist_data['playlist_id']
-    total_playlists = len(playlist_id_list)
-
-
-    # track_counts = [spotify.get_playlist_track_count(playlist_id) for playlist_id in playlist_id_list]
-    # median_tracks = np.median(track_counts)
-    # Create a status bar and text
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    start_time = time.time()
-    total_playlists = len(playlist_id_list)
-    remaining_time = None
-    for index, playlist_id in enumerate(playlist_id_list):
-        
-        playlist_name = playlist_data['name'][index]        
-        # Update the status text
-        if remaining_time:
-            status_text.text(f"Getting data for playlist: {playlist_name} \n(Estimated time remaining: {int(remaining_time)} seconds)")
+def render_ingestion_status(status:dict) -> None:
+    '''Draws the job status returned by IngestionJob.get_status'''
+    for notice in status['notices']:
+        st.markdown(notice)
+    if status['status'] == 'running':
+        st.progress(status['progress'])
+        if status['remaining_seconds'] is not None:
+            st.text(f"{status['message']} \n(Estimated time remaining: {int(status['remaining_seconds'])} seconds)")
         else:
-            status_text.text(f"Getting data for playlist: {playlist_name}")
-        playlist_items = spotify.get_playlist_items(playlist_id)
-        # if a playlist has no songs on it, skip it
-        if len(playlist_items) == 0:
-            continue
-        # call the api for song data and store in the database
-
-        song_data = extract_song_data(playlist_items)
-        load_song_data(session, song_data)
-
-        # Load data into the playlist songs table
-        # Playlist songs links together the relationship between a playlist and the songs on it
-        # This is a many to many relationship as one song can be on multiple playlists, and one playlist can have multiple songs
-
-        song_playlist_data = extract_song_playlist_data(playlist_id, playlist_items)
-        update_playlist_songs_dates(session, playlist_id,song_playlist_data)
-        load_playlists_songs_data(session,  song_playlist_data)
-
-        # Since some song feature data is located at a different endpoint in the spotify api, it must be collected seprately
-        # First I check the database to see if the data we need is already in the database 
+            st.text(status['message'])
+        st.markdown('Feel free to move on to an analysis page while your data loads, it will keep going in the background')
+    elif status['status'] == 'complete':
+        st.success("Data processing complete!")
+    else:
+        st.error(f"Something went wrong while getting your data: {status['error']}. Press the button to try again")
 
-        null_song_ids_chunked = get_song_ids_with_nulls(session, playlist_id)        
-        for chunk in null_song_ids_chunked:
-            song_features = spotify.get_audio_features(chunk)
-            song_feature_data = extract_song_features_data(song_features)
-            load_song_features_data(session, song_feature_data)
-        # Get the artist data for each song and upload it to the database
+@st.fragment(run_every=2)
+def poll_ingestion_status(app_user_id:str) -> None:
+    '''Shows the progress of a running job. This fragment reruns every couple of seconds on its own, so it polls the
+    job without rerunning the rest of the page. Once the job has finished the whole page is rerun, which draws the
+    final status without the fragment so the polling stops'''
+    job = get_ingestion_job(app_user_id)
+    status = job.get_status() if job is not None else None
+    if status is None or status['status'] != 'running':
+        st.rerun()
+    render_ingestion_status(status)
 
-        artist_data = extract_artist_data(playlist_items)
-        load_artist_data(session, artist_data)
-        load_song_artist_data(session, artist_data)
-        # Update progress bar
-        progress = (index + 1) / total_playlists
-        progress_bar.progress(progress)
-        # Estimate time remaining
-        elapsed_time = time.time() - start_time
-        estimated_total_time = elapsed_time / (index + 1) * total_playlists
-        remaining_time = estimated_total_time - elapsed_time
-    status_text.text('Finished processing playlist data, filling in artist genre data now...')
-    progress_bar = st.progress(0)
-    # Processeach playlist
-    start_time = time.time()
-    # Get artists without data associated with them yet to be filled in
-    null_artist_ids_chunked = get_artists_with_nulls(session)
-    n_chunks = len(null_artist_ids_chunked)
-    remaining_time = None
-    for index, chunk in enumerate(null_artist_ids_chunked):
-        if remaining_time:
-            status_text.text(f"Filling in artist genre data \n(Estimated time remaining: {int(remaining_time)} seconds)")
-        else:
-            status_text.text(f"Filling in artist genre data")
-        artist_genres = spotify.get_artist_genre(chunk)
-        artist_genre_popularity_data = extract_artist_genre_popularity_data(artist_genres)
-        update_artist_popularity(session, artist_genre_popularity_data)
-        load_artist_genre_data(session, artist_genre_popularity_data)
-        # Update progress bar
-        progress = (index + 1) / n_chunks
-        progress_bar.progress(progress)
-        # Estimate time remaining
-        elapsed_time = time.time() - start_time
-        estimated_total_time = elapsed_time / (index + 1) * n_chunks
-        remaining_time = estimated_total_time - elapsed_time
-    session.close()
-    # Completion message
-    st.success("Data processing complete!")
+def display_ingestion_status(app_user_id:str) -> None:
+    '''Shows the status of the user's ingestion job, polling it only while it is running'''
+    job = get_ingestion_job(app_user_id)
+    if job is None:
+        return
+    status = job.get_status()
+    if status['status'] == 'running':
+        poll_ingestion_status(app_user_id)
+        return
+    render_ingestion_status(status)
+    # The job finished on another thread, so clear the cached database lookup here once we see it
+    if st.session_state.get('seen_finished_job') != status['job_id']:
+        st.session_state['seen_finished_job'] = status['job_id']
+        clear_user_exists()
 
 def main():
     
@@ -113,16 +62,17 @@ def main():
         st.session_state['access_token'] = spotify_api.access_token
         
         status_text = st.markdown('Searching for you in the database...')
-        session = create_sqlalchemy_session()
-        user_exists = check_if_user_exists(session, spotify_api.user_id)
-        session.close()
+        user_exists = get_user_exists(spotify_api.user_id)
         # function returns a bool of if the user is in db or not
         if user_exists:
             status_text.markdown('You are in the database! Feel free to update your data by pressing the button below \n or move on to an analysis page on the sidebar!')
         else:
             status_text.markdown('No data found for you, please press the button below!')
-        if st.button('Fetch Playlist data!'):
-            fetch_and_store_data(spotify=spotify_api, app_user_id=st.session_state['user_id'])
+        job = get_ingestion_job(spotify_api.user_id)
+        job_running = job is not None and job.status == 'running'
+        if st.button('Fetch Playlist data!', disabled=job_running):
+            start_ingestion_job(spotify=spotify_api, app_user_id=st.session_state['user_id'])
+        display_ingestion_status(spotify_api.user_id)
         st.markdown('Note that if you refresh or close the page you wil need to reauthenticate with spotify on the main page')
         st.markdown('For more information about how your data is stored and managed, see the data privacy page')
     else:
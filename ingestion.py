@@ -0,0 +1,409 @@
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from spotify_api.api import SpotifyAPI
+from spotify_api.utils import *
+from database.loading import *
+from database.feature_stats import get_playlists_needing_stats, refresh_playlist_feature_stats
+from database.rollups import get_users_needing_rollups, get_changed_rollup_months, refresh_feature_rollups
+from database.snapshots import publish_user_snapshot, invalidate_user_snapshot, get_users_with_changed_shared_data
+from database.query_cache import bump_data_generation
+
+# Number of worker threads used to call the spotify api concurrently while fetching playlist data.
+# Setting this to 1 processes one playlist at a time like the original sequential implementation
+INGESTION_MAX_WORKERS = int(os.environ.get('INGESTION_MAX_WORKERS', 8))
+
+# The audio features endpoint accepts up to 100 song ids per request and the artists endpoint up to 50 artist ids
+AUDIO_FEATURES_BATCH_SIZE = 100
+ARTISTS_BATCH_SIZE = 50
+
+# Most pages of playlist items waiting to be written to the database at once. The download threads wait when it is full
+INGESTION_QUEUE_SIZE = int(os.environ.get('INGESTION_QUEUE_SIZE', 16))
+
+class IngestionJob:
+    '''A refresh of one user's playlist data running on a background thread. The job's progress is kept here rather 
+    than in st.session_state, so it survives streamlit reruns and can be read from any session or page.'''
+    def __init__(self, app_user_id:str) -> None:
+        self.job_id = uuid.uuid4().hex
+        self.app_user_id = app_user_id
+        self.status = 'running'
+        self.stage = 'Starting'
+        self.message = ''
+        self.n_completed = 0
+        self.n_total = 0
+        self.remaining_seconds = None
+        self.notices = []
+        self.error = None
+        self.started_at = datetime.now()
+        self.finished_at = None
+        self._stage_start_time = time.time()
+        self._lock = threading.Lock()
+
+    def start_stage(self, stage:str, n_total:int) -> None:
+        '''Start tracking progress for a new stage of the ingest'''
+        with self._lock:
+            self.stage = stage
+            self.message = stage
+            self.n_completed = 0
+            self.n_total = n_total
+            self.remaining_seconds = None
+            self._stage_start_time = time.time()
+
+    def update(self, n_completed:int, message:Optional[str]=None) -> None:
+        '''Record progress through the current stage along with an estimate of the time remaining'''
+        with self._lock:
+            self.n_completed = n_completed
+            self.message = message or self.stage
+            # Estimate time remaining
+            elapsed_time = time.time() - self._stage_start_time
+            estimated_total_time = elapsed_time / n_completed * self.n_total
+            self.remaining_seconds = max(estimated_total_time - elapsed_time, 0)
+
+    def add_notice(self, notice:str) -> None:
+        with self._lock:
+            self.notices.append(notice)
+
+    def finish(self, error:Optional[str]=None) -> None:
+        with self._lock:
+            self.status = 'failed' if error else 'complete'
+            self.error = error
+            self.finished_at = datetime.now()
+
+    def get_status(self) -> Dict[str, Any]:
+        '''Returns a consistent copy of the job's progress for display'''
+        with self._lock:
+            return {
+                'job_id': self.job_id,
+                'status': self.status,
+                'stage': self.stage,
+                'message': self.message,
+                'progress': min(self.n_completed / self.n_total, 1.0) if self.n_total else 0.0,
+                'remaining_seconds': self.remaining_seconds,
+                'notices': list(self.notices),
+                'error': self.error,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
+
+# Most recent job for each user in this server process
+_jobs: Dict[str, IngestionJob] = {}
+_jobs_lock = threading.Lock()
+
+def get_ingestion_job(app_user_id:str) -> Optional[IngestionJob]:
+    '''Returns the running or most recently finished job for the user, if there is one'''
+    with _jobs_lock:
+        return _jobs.get(app_user_id)
+
+def start_ingestion_job(spotify:SpotifyAPI, app_user_id:str, max_workers:int=INGESTION_MAX_WORKERS) -> IngestionJob:
+    '''Starts refreshing the user's data on a background thread. Only one job runs per user at a time, 
+    so if the user already has a running job that job is returned instead of starting another one'''
+    with _jobs_lock:
+        job = _jobs.get(app_user_id)
+        if job is not None and job.status == 'running':
+            return job
+        job = IngestionJob(app_user_id)
+        _jobs[app_user_id] = job
+    thread = threading.Thread(target=_run_ingestion_job, args=(spotify, job, max_workers), 
+                              name=f'ingestion-{job.job_id}', daemon=True)
+    thread.start()
+    return job
+
+def _run_ingestion_job(spotify:SpotifyAPI, job:IngestionJob, max_workers:int) -> None:
+    try:
+        fetch_and_store_data(spotify, job.app_user_id, job, max_workers=max_workers)
+    except Exception as e:
+        traceback.print_exc()
+        job.finish(error=str(e))
+    else:
+        job.finish()
+
+def run_backfill(executor:ThreadPoolExecutor, batches:Iterator[List[str]], fetch:Callable, load:Callable, max_in_flight:int) -> Iterator[None]:
+    '''Requests the batches concurrently while loading the responses on this thread in order. Only max_in_flight 
+    requests are queued at a time, so each batch is only taken from the generator after the earlier ones have been loaded.
+    load is called with each batch of ids and its response. Yields once for each batch that has been loaded so the 
+    caller can update progress'''
+    in_flight = deque()
+    for batch in batches:
+        in_flight.append((batch, executor.submit(fetch, batch)))
+        if len(in_flight) >= max_in_flight:
+            loaded_batch, future = in_flight.popleft()
+            load(loaded_batch, future.result())
+            yield
+    while in_flight:
+        loaded_batch, future = in_flight.popleft()
+        load(loaded_batch, future.result())
+        yield
+
+def fetch_and_store_data(spotify:SpotifyAPI, app_user_id:str, job:'IngestionJob', max_workers:int=INGESTION_MAX_WORKERS) -> None:
+    '''Downloads the user's playlists from spotify and loads them into the database. This runs on the job's background
+    thread, so instead of drawing streamlit elements it reports progress on the job, which the home page polls.
+    Progress is checkpointed in the database, so if a refresh fails the next one continues where it left off instead of
+    starting over'''
+    # the session is closed when the with block exits, even if the ingest fails partway through
+    with create_sqlalchemy_session() as session:
+        checkpoint = get_resumable_checkpoint(session, app_user_id)
+        if checkpoint is None:
+            checkpoint = create_checkpoint(session, app_user_id)
+        else:
+            job.add_notice('Picking up where your last refresh left off')
+        try:
+            # Every stage runs on a resumed refresh too, since the user's playlists may have changed since it failed.
+            # The work finished by the earlier attempt is not repeated: the playlists it loaded are skipped through
+            # their snapshot ids, and the backfills only request the songs and artists that are still pending
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                update_checkpoint(session, checkpoint, stage='playlists')
+                load_changed_playlists(spotify, session, app_user_id, job, checkpoint, executor)
+                update_checkpoint(session, checkpoint, stage='song_features')
+                backfill_song_features(spotify, session, job, checkpoint, executor, max_workers)
+                update_checkpoint(session, checkpoint, stage='artists')
+                backfill_artists(spotify, session, job, checkpoint, executor, max_workers)
+                update_checkpoint(session, checkpoint, stage='feature_stats')
+        except Exception:
+            session.rollback()
+            update_checkpoint(session, checkpoint, status='failed')
+            # the database now holds part of the new data, so the pages should read it rather than the old snapshot
+            invalidate_user_snapshot(app_user_id)
+            bump_data_generations(app_user_id, checkpoint)
+            invalidate_shared_snapshots(session, checkpoint)
+            raise
+        # earlier refreshes whose summaries failed are retried first, so their stats and rollups catch up
+        for earlier_checkpoint in get_checkpoints_with_failed_summaries(session, app_user_id):
+            refresh_summaries(session, job, earlier_checkpoint)
+        refresh_summaries(session, job, checkpoint)
+        bump_data_generations(app_user_id, checkpoint)
+        invalidate_shared_snapshots(session, checkpoint)
+        publish_snapshot(session, app_user_id, job)
+
+def load_changed_playlists(spotify:SpotifyAPI, session:Session, app_user_id:str, job:IngestionJob, 
+                           checkpoint:IngestCheckpoint, executor:ThreadPoolExecutor) -> None:
+    '''Loads the songs and artists of every playlist that has changed since the last refresh'''
+    user_playlists = spotify.get_user_playlists()
+    playlist_data = extract_playlist_details(user_playlists, app_user_id)
+    # Look up the snapshot ids stored by the last refresh before saving the playlists
+    stored_snapshots = get_playlist_snapshots(session, playlist_data['playlist_id'])
+    # save all user playlist data to the database
+    load_playlists_data(session, playlist_data)
+    session.commit()
+    # Spotify changes a playlist's snapshot id whenever its contents change, so playlists with the same snapshot 
+    # as last time can skip downloading their songs entirely. This is also what skips the playlists that were 
+    # finished before a failed refresh, since their snapshot is saved as soon as they are done
+    changed_indexes = [index for index, playlist_id in enumerate(playlist_data['playlist_id'])
+                       if stored_snapshots.get(playlist_id) is None or stored_snapshots[playlist_id] != playlist_data['snapshot_id'][index]]
+    n_unchanged = len(playlist_data['playlist_id']) - len(changed_indexes)
+    if n_unchanged > 0:
+        job.add_notice(f'{n_unchanged} playlists have not changed since your last refresh and will be skipped')
+    playlist_id_list = [playlist_data['playlist_id'][index] for index in changed_indexes]
+    playlist_name_list = [playlist_data['name'][index] for index in changed_indexes]
+    snapshot_id_list = [playlist_data['snapshot_id'][index] for index in changed_indexes]
+    total_playlists = len(playlist_id_list)
+
+    job.start_stage('Getting playlist data', total_playlists)
+    # The worker threads download each playlist a page at a time and format each page as it arrives, then hand it to 
+    # this thread through a bounded queue. This thread is the writer: the sqlalchemy session is not thread safe, so all 
+    # of the database loads happen here while the workers keep downloading. When the writer falls behind the workers 
+    # block on the full queue, so only a fixed number of pages are held in memory no matter how large the library is
+    page_queue = queue.Queue(maxsize=INGESTION_QUEUE_SIZE)
+    stop = threading.Event()
+    futures = [executor.submit(stream_playlist_pages, spotify, index, playlist_id, page_queue, stop) 
+               for index, playlist_id in enumerate(playlist_id_list)]
+    # first and last added dates of each playlist across all of its pages
+    added_date_ranges = {}
+    # songs found on each playlist so far, anything else stored for the playlist has been removed from it
+    loaded_song_ids = {}
+    n_completed = 0
+    try:
+        while n_completed < total_playlists:
+            kind, index, payload = page_queue.get()
+            playlist_id = playlist_id_list[index]
+            if kind == 'error':
+                raise payload
+            if kind == 'page':
+                page_dates = load_playlist_page(session, playlist_id, payload)
+                loaded_song_ids.setdefault(index, set()).update(song_id for song_id in payload['playlist_songs']['song_id'] if song_id)
+                # Pages of every downloading playlist arrive interleaved, so waiting for a playlist to finish before
+                # committing would keep one transaction open across all of them. Each page is committed on its own
+                # instead, which keeps the transaction and its locks small
+                session.commit()
+                if index in added_date_ranges:
+                    created_date, last_updated = added_date_ranges[index]
+                    page_dates = (min(created_date, page_dates[0]), max(last_updated, page_dates[1]))
+                added_date_ranges[index] = page_dates
+                continue
+            # every page of the playlist has been loaded. If a playlist has no songs on it its dates are left empty
+            if index in added_date_ranges:
+                update_playlist_dates(session, playlist_id, *added_date_ranges.pop(index))
+            # read before the removed songs are deleted, so the range covers the songs that were on the playlist as
+            # well as the ones on it now. The rollups stage only rebuilds the months in this range
+            first_added_date, last_added_date = get_added_date_range(session, playlist_id)
+            delete_removed_playlist_songs(session, playlist_id, loaded_song_ids.pop(index, set()))
+            # Record the playlist in the checkpoint and save its snapshot so the next refresh can skip it. The snapshot is
+            # only saved once every page has been committed, so a refresh that fails partway through a playlist keeps
+            # the pages it loaded but downloads the whole playlist again next time
+            mark_checkpoint_playlist_done(session, checkpoint, playlist_id, first_added_date, last_added_date)
+            update_playlist_snapshot(session, playlist_id, snapshot_id_list[index])
+            session.commit()
+            n_completed += 1
+            job.update(n_completed, f"Getting data for playlist: {playlist_name_list[index]}")
+    finally:
+        # stop the workers if the writer failed, and drop the playlists that have not started downloading yet
+        stop.set()
+        for future in futures:
+            future.cancel()
+
+def put_or_stop(page_queue:queue.Queue, message:tuple, stop:threading.Event) -> bool:
+    '''Puts a message on the queue, waiting for space unless the writer has stopped. Returns False if it stopped'''
+    while not stop.is_set():
+        try:
+            page_queue.put(message, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def stream_playlist_pages(spotify:SpotifyAPI, index:int, playlist_id:str, page_queue:queue.Queue, stop:threading.Event) -> None:
+    '''Runs on a worker thread. Downloads a playlist a page at a time and queues each formatted page for the writer, 
+    followed by a done message once the whole playlist has been queued'''
+    try:
+        for playlist_items in spotify.iter_playlist_item_pages(playlist_id):
+            # skip empty pages, a playlist with no songs only sends the done message
+            if len(playlist_items) > 0:
+                # format the songs, playlist songs and artists of the page in one pass over the items
+                if not put_or_stop(page_queue, ('page', index, extract_playlist_items(playlist_id, playlist_items)), stop):
+                    return
+        put_or_stop(page_queue, ('done', index, None), stop)
+    except Exception as e:
+        # pass the error to the writer so the job fails with it
+        put_or_stop(page_queue, ('error', index, e), stop)
+
+def load_playlist_page(session:Session, playlist_id:str, playlist_columns:Dict[str, Dict]) -> tuple:
+    '''Loads one page of a playlist's songs, playlist songs and artists. Returns the first and last dates that the 
+    songs on the page were added to the playlist'''
+    # store the song data in the database
+    song_data = columns_to_lists(playlist_columns['songs'])
+    load_song_data(session, song_data)
+
+    # Load data into the playlist songs table
+    # Playlist songs links together the relationship between a playlist and the songs on it
+    # This is a many to many relationship as one song can be on multiple playlists, and one playlist can have multiple songs
+
+    song_playlist_data = columns_to_lists(playlist_columns['playlist_songs'])
+    load_playlists_songs_data(session,  song_playlist_data)
+
+    # Get the artist data for each song and upload it to the database
+
+    artist_data = columns_to_lists(playlist_columns['artists'])
+    load_artist_data(session, artist_data)
+    load_song_artist_data(session, artist_data)
+    return min(song_playlist_data['added_date']), max(song_playlist_data['added_date'])
+
+def backfill_song_features(spotify:SpotifyAPI, session:Session, job:IngestionJob, checkpoint:IngestCheckpoint, 
+                           executor:ThreadPoolExecutor, max_workers:int) -> None:
+    '''Fills in the audio features of every song that is still pending'''
+    # Since some song feature data is located at a different endpoint in the spotify api, it must be collected seprately
+    # New songs are stored as pending, so reading the pending songs through the status index picks up everything 
+    # loaded by this refresh (and any earlier refresh that failed) without looking at the songs that are already filled in. 
+    # Collecting them all up front also means small playlists share full batches instead of each sending their own request
+    pending_song_ids = get_pending_song_ids(session)
+    n_batches = (len(pending_song_ids) + AUDIO_FEATURES_BATCH_SIZE - 1) // AUDIO_FEATURES_BATCH_SIZE
+    job.start_stage('Filling in song feature data', n_batches)
+    song_feature_batches = iter_backfill_batches(pending_song_ids, AUDIO_FEATURES_BATCH_SIZE, 
+                                                 lambda song_ids: filter_pending_song_ids(session, song_ids))
+    def load_song_features(song_ids:List[str], song_features:Dict) -> None:
+        song_features_data = extract_song_features_data(song_features)
+        load_song_features_data(session, song_features_data)
+        # spotify returns null for songs it has no features for, mark those so they are not requested again
+        fetched_song_ids = set(song_features_data['song_id'])
+        mark_song_features_failed(session, [song_id for song_id in song_ids if song_id not in fetched_song_ids])
+        update_checkpoint(session, checkpoint, song_feature_batches_done=checkpoint.song_feature_batches_done + 1)
+    for n_completed, _ in enumerate(run_backfill(executor, song_feature_batches, spotify.get_audio_features, 
+                                                 load_song_features, max_workers), start=1):
+        job.update(n_completed)
+
+def backfill_artists(spotify:SpotifyAPI, session:Session, job:IngestionJob, checkpoint:IngestCheckpoint, 
+                     executor:ThreadPoolExecutor, max_workers:int) -> None:
+    '''Fills in the genres and popularity of every artist that is still pending'''
+    pending_artist_ids = get_pending_artist_ids(session)
+    n_batches = (len(pending_artist_ids) + ARTISTS_BATCH_SIZE - 1) // ARTISTS_BATCH_SIZE
+    job.start_stage('Filling in artist genre data', n_batches)
+    artist_batches = iter_backfill_batches(pending_artist_ids, ARTISTS_BATCH_SIZE, 
+                                           lambda artist_ids: filter_pending_artist_ids(session, artist_ids))
+    def load_artist_genres(artist_ids:List[str], artist_genres:Dict) -> None:
+        # unknown artist ids come back as null
+        artist_genres = {'artists': [artist for artist in artist_genres['artists'] if artist]}
+        artist_genre_popularity_data = extract_artist_genre_popularity_data(artist_genres)
+        update_artist_popularity(session, artist_genre_popularity_data)
+        load_artist_genre_data(session, artist_genre_popularity_data)
+        fetched_artist_ids = set(artist_genre_popularity_data['artist_id'])
+        mark_artist_enrichment_failed(session, [artist_id for artist_id in artist_ids if artist_id not in fetched_artist_ids])
+        update_checkpoint(session, checkpoint, artist_batches_done=checkpoint.artist_batches_done + 1)
+    for n_completed, _ in enumerate(run_backfill(executor, artist_batches, spotify.get_artist_genre, 
+                                                 load_artist_genres, max_workers), start=1):
+        job.update(n_completed)
+
+def refresh_summaries(session:Session, job:IngestionJob, checkpoint:IngestCheckpoint) -> None:
+    '''Runs the feature stats and rollups stages of a refresh that has loaded its data. They only summarize data that
+    is already in the database, so a failure here does not fail the refresh or drop the snapshot. The checkpoint is
+    marked summaries_failed instead, and the stages are run again on their own during the user's next refresh'''
+    try:
+        if checkpoint.stage == 'feature_stats':
+            refresh_feature_stats(session, job, checkpoint)
+            update_checkpoint(session, checkpoint, stage='rollups')
+        refresh_rollups(session, job, checkpoint)
+    except Exception:
+        traceback.print_exc()
+        session.rollback()
+        update_checkpoint(session, checkpoint, status='summaries_failed')
+        job.add_notice('Your playlists were refreshed, but summarizing them failed. This will be tried again on your next refresh')
+        return
+    update_checkpoint(session, checkpoint, status='complete')
+
+def refresh_feature_stats(session:Session, job:IngestionJob, checkpoint:IngestCheckpoint) -> None:
+    '''Recomputes the feature stats of the playlists that changed during this refresh'''
+    playlist_id_list = get_playlists_needing_stats(session, checkpoint)
+    job.start_stage('Summarizing playlist features', len(playlist_id_list))
+    refresh_playlist_feature_stats(session, playlist_id_list)
+    if playlist_id_list:
+        job.update(len(playlist_id_list))
+
+def refresh_rollups(session:Session, job:IngestionJob, checkpoint:IngestCheckpoint) -> None:
+    '''Rebuilds the months of daily and monthly rollups that this refresh changed, for the user and for anyone whose
+    songs got their features in this refresh'''
+    app_user_id_list = get_users_needing_rollups(session, checkpoint)
+    job.start_stage('Summarizing your song history', len(app_user_id_list))
+    for i, app_user_id in enumerate(app_user_id_list):
+        refresh_feature_rollups(session, app_user_id, get_changed_rollup_months(session, app_user_id, checkpoint))
+        job.update(i + 1)
+
+def publish_snapshot(session:Session, app_user_id:str, job:IngestionJob) -> None:
+    '''Writes the snapshot of the user's data that the analysis pages read. The ingest itself has already succeeded,
+    so if this fails the pages just keep reading from the database'''
+    job.start_stage('Saving a snapshot of your data', 1)
+    try:
+        publish_user_snapshot(session, app_user_id)
+    except Exception:
+        traceback.print_exc()
+        job.add_notice('Your data was refreshed, but saving a snapshot of it failed, so the pages may load more slowly until your next refresh')
+        invalidate_user_snapshot(app_user_id)
+    job.update(1)
+
+def bump_data_generations(app_user_id:str, checkpoint:IngestCheckpoint) -> None:
+    '''Stops the pages from reusing query results cached before this refresh. Song features and artist genres are
+    shared by every user with the song or artist on a playlist, so if any were fetched every user's results are stale'''
+    fetched_shared_data = checkpoint.song_feature_batches_done > 0 or checkpoint.artist_batches_done > 0
+    bump_data_generation(app_user_id, shared=fetched_shared_data)
+
+def invalidate_shared_snapshots(session:Session, checkpoint:IngestCheckpoint) -> None:
+    '''Removes the snapshots of the other users whose songs got their features, or whose artists got their genres, in
+    this refresh. Their snapshots were written without that data, so their pages read the database until they refresh'''
+    if checkpoint.song_feature_batches_done == 0 and checkpoint.artist_batches_done == 0:
+        return
+    for app_user_id in get_users_with_changed_shared_data(session, checkpoint):
+        invalidate_user_snapshot(app_user_id)
@@ -2,21 +2,25 @@ from streamlit_utils import *
 import plotly.graph_objects as go
 import plotly.express as px
 
-from typing import List
+from typing import List, Optional
 from sqlalchemy.orm import Session
 
 
-def get_artist_genre_df(session:Session, song_id_list:List) -> pd.DataFrame:
-    '''Get the artist genres for all given songs in song_id list'''
-    get_artist_genres_query = '''
+def get_artist_genres_query(exclude:bool=False) -> str:
+    return f'''
     SELECT ag.genre AS genre, a.name AS name
-    FROM songs AS s 
-    JOIN song_artists AS sa ON s.song_id=sa.song_id
+    FROM song_artists AS sa
     JOIN artists AS a ON sa.artist_id=a.artist_id
     JOIN artist_genres AS ag ON  sa.artist_id=ag.artist_id
-    WHERE s.song_id IN :song_ids
+    WHERE sa.song_id IN ({get_playlist_set_subquery(exclude)})
     '''
-    result = session.execute(text(get_artist_genres_query), {'song_ids': tuple(song_id_list)})
+
+@cached_query(user_argument='current_user_id')
+def get_artist_genre_df(session:Session, current_user_id:str, playlist_id:str, exclude:bool=False, snapshot:Optional[UserSnapshot]=None) -> pd.DataFrame:
+    '''Get the artist genres for all songs on the playlist, or with exclude on every other playlist of the user'''
+    if snapshot is not None:
+        return snapshot.get_artist_genre_df(snapshot.get_playlist_set_song_ids(playlist_id, exclude=exclude))
+    result = session.execute(text(get_artist_genres_query(exclude)), {'app_user_id': current_user_id, 'playlist_id': playlist_id})
     rows = result.fetchall()
     artist_genre_df = pd.DataFrame(rows, columns=result.keys())
     return artist_genre_df
@@ -45,21 +49,24 @@ def main():
         st.markdown('# Compare the top artist genres in your playlists!')
         st.markdown(f'Currently logged in as: {st.session_state["display_name"]}')
 
-        session = create_sqlalchemy_session()
+        # read from the snapshot written by the last ingest if there is one, and only open a session if there is not
+        snapshot = load_user_snapshot(current_user_id)
+        session = create_sqlalchemy_session() if snapshot is None else None
         # Get all possible playlists to display
-        playlist_df = get_playlist_df(session, current_user_id)
+        playlist_df = get_playlist_df(session, current_user_id, snapshot=snapshot)
         # display and get results from playlist selector 
         playlist_1_tuple, playlist_2_tuple = display_playlist_selector(playlist_df)
         playlist_id_1, playlist_name_1 = playlist_1_tuple
         playlist_id_2, playlist_name_2 = playlist_2_tuple
-        song_id_list_1 = get_song_id_list(session=session, playlist_id=playlist_id_1, current_user_id=current_user_id)
+        # Get the artist genre data from each selected playlist and plot
+        artist_genre_df_1 = get_artist_genre_df(session, current_user_id, playlist_id_1, snapshot=snapshot)
         if playlist_id_2 == None: # if playlist 2 is none then we are comparing to all other playlists
-            song_id_list_2 = get_song_id_list(session=session, playlist_id=playlist_id_1, current_user_id=current_user_id, exclude=True)
+            artist_genre_df_2 = get_artist_genre_df(session, current_user_id, playlist_id_1, exclude=True, snapshot=snapshot)
         else:
-            song_id_list_2 = get_song_id_list(session=session, playlist_id=playlist_id_2, current_user_id=current_user_id)
-        # Get the artist genre data from each selected playlist and plot
-        artist_genre_df_1 = get_artist_genre_df(session, song_id_list_1)
-        artist_genre_df_2 = get_artist_genre_df(session, song_id_list_2)
+            artist_genre_df_2 = get_artist_genre_df(session, current_user_id, playlist_id_2, snapshot=snapshot)
+        if session is not None:
+            # give the connection back to the pool
+            session.close()
         fig1 = plot_artist_genres(artist_genre_df_1, playlist_title=playlist_name_1)
         st.plotly_chart(fig1, use_container_width=True)
         fig2 = plot_artist_genres(artist_genre_df_2, playlist_title=playlist_name_2)
@@ -1,6 +1,6 @@
 import streamlit as st 
 from database.loading import delete_playlist_data
-from streamlit_utils import create_sqlalchemy_session
+from streamlit_utils import create_sqlalchemy_session, clear_user_exists
 def main():
     st.markdown('All data is collected through the [Spotify Web API](https://developer.spotify.com/documentation/web-api)')
     
@@ -25,6 +25,7 @@ def main():
                 session = create_sqlalchemy_session()
                 delete_playlist_data(session, current_user_id)
                 session.close()
+                clear_user_exists()
                 st.success(f"Data successfully deleted for user: {current_user_display_name}")
                 st.markdown('Feel free to redownload your data on the homepage at any time!')
 
@@ -24,13 +24,13 @@ def display_single_playlist_selector(df:pd.DataFrame) -> tuple[str, str]:
 
 
 def get_specific_playlist_songs(session:Session, playlist_id:str, current_user_id:str) -> List[str]:
-    get_song_list_query = f'''
+    get_song_list_query = '''
         SELECT song_id, p.playlist_id, p.name AS playlist_name
         FROM playlists AS p 
         JOIN playlist_songs AS ps ON p.playlist_id=ps.playlist_id
-        WHERE p.playlist_id = '{playlist_id}' AND p.app_user_id='{current_user_id}';
+        WHERE p.playlist_id = :playlist_id AND p.app_user_id = :app_user_id;
         '''
-    result = session.execute(text(get_song_list_query))
+    result = session.execute(text(get_song_list_query), {'playlist_id': playlist_id, 'app_user_id': current_user_id})
     rows = result.fetchall()
     song_id_list = [row[0] for row in rows]
     session.close()
@@ -38,27 +38,36 @@ def get_specific_playlist_songs(session:Session, playlist_id:str, current_user_i
 
 def get_all_songs(session:Session, current_user_id:str) -> List[str]:
 
-    get_song_list_query = f'''
+    get_song_list_query = '''
         SELECT song_id, p.playlist_id, p.name AS playlist_name
         FROM playlists AS p 
         JOIN playlist_songs AS ps ON p.playlist_id=ps.playlist_id
-        WHERE p.app_user_id='{current_user_id}';
+        WHERE p.app_user_id = :app_user_id;
         '''
-    result = session.execute(text(get_song_list_query))
+    result = session.execute(text(get_song_list_query), {'app_user_id': current_user_id})
     rows = result.fetchall()
     song_id_list = [row[0] for row in rows]
     session.close()
     return song_id_list
 
-def get_all_owned_songs(session:Session, current_user_id:str) -> List[str]:
-
-    get_song_list_query = f'''
+# module level so that the check command in database/migrations.py can EXPLAIN them
+OWNED_SONGS_QUERY = '''
         SELECT song_id, p.playlist_id, p.name AS playlist_name
         FROM playlists AS p 
         JOIN playlist_songs AS ps ON p.playlist_id=ps.playlist_id
-        WHERE p.app_user_id='{current_user_id}' AND p.owner_id='{current_user_id}';
+        WHERE p.app_user_id = :app_user_id AND p.owner_id = :app_user_id
+        '''
+
+MATCHING_PLAYLISTS_QUERY = '''
+        SELECT p.name AS playlist_name, ps.added_date
+        FROM playlists AS p 
+        JOIN playlist_songs AS ps ON p.playlist_id=ps.playlist_id
+        WHERE p.app_user_id = :app_user_id AND ps.song_id = :song_id
         '''
-    result = session.execute(text(get_song_list_query))
+
+def get_all_owned_songs(session:Session, current_user_id:str) -> List[str]:
+
+    result = session.execute(text(OWNED_SONGS_QUERY), {'app_user_id': current_user_id})
     rows = result.fetchall()
     song_id_list = [row[0] for row in rows]
     session.close()
@@ -210,13 +219,7 @@ def highlight_rows(row):
 
 def get_matching_playlists(session:Session, current_user_id:str, song_id:str) -> List[str]:
 
-    get_playlists_query = f'''
-        SELECT p.name AS playlist_name, ps.added_date
-        FROM playlists AS p 
-        JOIN playlist_songs AS ps ON p.playlist_id=ps.playlist_id
-        WHERE p.app_user_id='{current_user_id}' AND ps.song_id='{song_id}';
-        '''
-    result = session.execute(text(get_playlists_query))
+    result = session.execute(text(MATCHING_PLAYLISTS_QUERY), {'app_user_id': current_user_id, 'song_id': song_id})
     rows = result.fetchall()
     playlist_list = [row[0] for row in rows]
 
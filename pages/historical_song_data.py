@@ -2,29 +2,31 @@ from streamlit_utils import *
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 from typing import Optional
 from sqlalchemy.orm import Session
+from database.rollups import get_feature_rollups, merge_rollups
 
 
 
+@cached_query(user_argument='current_user_id')
 def get_song_df(session:Session, current_user_id:str) -> pd.DataFrame:
     '''Get song feature data for playlists created by the current user. 
     For each song also get the timestamp of when the song was added to the playlist.'''
 
-    get_available_playlists_query = f'''
+    get_available_playlists_query = '''
     SELECT s.song_id AS song_id, ps.added_date AS added_date, s.duration_ms / 1000.0 AS duration_seconds, 
     s.popularity, s.acousticness, s.danceability, s.energy, s.instrumentalness,
     s.liveness, s.loudness, s.speechiness, s.tempo, s.valence
     FROM playlists AS p 
     JOIN playlist_songs AS ps ON p.playlist_id=ps.playlist_id
     JOIN songs AS s ON ps.song_id=s.song_id
-    WHERE p.app_user_id = '{current_user_id}' 
-    AND p.owner_id = '{current_user_id}' 
+    WHERE p.app_user_id = :app_user_id 
+    AND p.owner_id = :app_user_id 
     AND ps.added_date IS NOT NULL
     ORDER BY ps.added_date DESC;
     '''
-    result = session.execute(text(get_available_playlists_query))
+    result = session.execute(text(get_available_playlists_query), {'app_user_id': current_user_id})
     rows = result.fetchall()
     playlist_df = pd.DataFrame(rows, columns=result.keys())
     playlist_df['added_date'] = pd.to_datetime(playlist_df['added_date'])
@@ -41,8 +43,8 @@ def filter_data(df:pd.DataFrame, days:Optional[int]) -> pd.DataFrame:
         filtered_df = df  # For "All time"
     return filtered_df
 
-# Function to dynamically bin the dates based on the time range
-def dynamic_bins(df:pd.DataFrame, days:Optional[int]):
+def get_bin_freq(days:Optional[int]) -> str:
+    '''Picks the size of the date bins for the time range'''
     if days is None:  # For "All time"
         bin_freq = 'M'  # Monthly bins
     elif days <= 30:
@@ -55,12 +57,31 @@ def dynamic_bins(df:pd.DataFrame, days:Optional[int]):
         bin_freq = 'M'  # Monthly bins
     else:
         bin_freq = 'M'  # Monthly bins
+    return bin_freq
 
+# Function to dynamically bin the dates based on the time range
+def dynamic_bins(df:pd.DataFrame, days:Optional[int]):
+    bin_freq = get_bin_freq(days)
     # Use .loc[] to avoid the SettingWithCopyWarning
     df_copy = df.copy()  # Avoid changing the original dataframe
     df_copy.loc[:, 'date_bin'] = df_copy['added_date'].dt.to_period(bin_freq).dt.to_timestamp()
     return df_copy
 
+@cached_query(user_argument='current_user_id')
+def get_rollup_median_df(session:Session, current_user_id:str, selected_feature:str, days:Optional[int], today:date) -> Optional[pd.DataFrame]:
+    '''Gets the median of the selected feature in each date bin of the time range from the rollups that ingestion 
+    keeps, so only the buckets in the range are read rather than every song. today is only there so the cached 
+    result moves on with the date. Returns None if the user has no rollups yet'''
+    if days is None:
+        # All time is binned by month, which the monthly rollups already are
+        rollup_df = get_feature_rollups(session, current_user_id, selected_feature, 'month')
+    else:
+        # daily rollups can be merged into days, weeks or months and cut off exactly at the start of the range
+        rollup_df = get_feature_rollups(session, current_user_id, selected_feature, 'day', start_date=today - timedelta(days=days))
+    if rollup_df is None:
+        return None
+    return merge_rollups(rollup_df, selected_feature, get_bin_freq(days))
+
 def calculate_median(df:pd.DataFrame, selected_feature:str) -> pd.DataFrame:
     '''Calculate the median of the selected feature over the given date bins'''
     median_df = df.groupby('date_bin')[selected_feature].median().reset_index()
@@ -90,10 +111,6 @@ def main():
         st.markdown('# See how your playlists have changed over time!')
         st.markdown(f'Currently logged in as: {current_user_display_name}')
 
-        session = create_sqlalchemy_session()
-
-        song_df = get_song_df(session, current_user_id)
-
         selected_feature = draw_feature_selectbox()
 
         display_feature_description(selected_feature)
@@ -109,10 +126,25 @@ def main():
         }
         selected_range = st.selectbox("Select time range:", list(time_range_options.keys()))
         days = time_range_options[selected_range]
-        # Filter and process the data
-        filtered_data = filter_data(song_df, days)
-        binned_data = dynamic_bins(filtered_data, days)
-        median_data = calculate_median(binned_data, selected_feature)
+
+        session = create_sqlalchemy_session()
+        median_data = get_rollup_median_df(session, current_user_id, selected_feature, days, today=date.today())
+        # give the connection back to the pool
+        session.close()
+        if median_data is None:
+            # no rollups until the user's next refresh, so bin the songs here instead
+            # the snapshot written by the last ingest saves going to the database on every rerun
+            snapshot = load_user_snapshot(current_user_id)
+            if snapshot is not None:
+                song_df = snapshot.get_song_df()
+            else:
+                session = create_sqlalchemy_session()
+                song_df = get_song_df(session, current_user_id)
+                session.close()
+            # Filter and process the data
+            filtered_data = filter_data(song_df, days)
+            binned_data = dynamic_bins(filtered_data, days)
+            median_data = calculate_median(binned_data, selected_feature)
         # Plot the result using Plotly
         fig = px.line(median_data, x='date_bin', y=selected_feature,
                     title=f'Median Song {selected_feature} over Time ({selected_range})',
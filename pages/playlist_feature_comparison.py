@@ -8,66 +8,50 @@ from sqlalchemy import text
 from sqlalchemy.orm import Session
 
 import plotly.graph_objects as go
-import plotly.express as px
-
 from streamlit_utils import *
+from histograms import plot_binned_histogram
 
-from typing import List, Tuple
-
-def get_song_feature_df(session:Session, song_id_list:List) -> pd.DataFrame:
-    '''Gets the given song features from a given list of song ids'''
-    get_songs_query = text('''
-
-    SELECT s.song_id, s.title, s.popularity, s.acousticness, s.danceability, 
-                s.energy, s.instrumentalness, s.liveness, s.loudness,
-                s.speechiness, s.tempo, s.valence, s.duration_ms, GROUP_CONCAT(a.name SEPARATOR ', ') AS artists
-    FROM songs AS s 
-    JOIN song_artists AS sa ON s.song_id=sa.song_id
-    JOIN artists AS a ON sa.artist_id=a.artist_id
-    WHERE s.song_id IN :song_ids
-    GROUP BY s.song_id
-    ''')
-    result = session.execute(get_songs_query, {'song_ids': tuple(song_id_list)})
-    rows = result.fetchall()
-    song_df = pd.DataFrame(rows, columns=result.keys())
-    return song_df
+from typing import List, Tuple, Optional
 
-def plot_feature_histogram(session:Session, song_id_list_1: List[str], song_id_list_2: List[str], feature:str, playlist_name_1:str, playlist_name_2:str) -> Tuple[go.Figure, float, float]:
-    '''Creates the figure of the feature histogram for the two given playlists. Also returns the median of the given feature for each playlist'''
-    # Get the selected feature for all songs in each playlist and store in a dataframe
-    get_playlist_1_feature_query = f'''
-    SELECT {feature}
-    FROM songs
-    WHERE song_id IN :song_ids;
+def get_feature_query(feature:str, exclude:bool=False) -> str:
+    return f'''
+    SELECT s.{feature}
+    FROM songs AS s
+    WHERE s.song_id IN ({get_playlist_set_subquery(exclude)})
     '''
-    result = session.execute(text(get_playlist_1_feature_query), {'song_ids': tuple(song_id_list_1)})
-    rows = result.fetchall()
-    playlist_1_df = pd.DataFrame(rows, columns=result.keys())
 
-    playlist_1_df['source'] = playlist_name_1
-    get_playlist_2_feature_query = f'''
-    SELECT {feature}
-    FROM songs
-    WHERE song_id IN :song_ids;
-    '''
-    result = session.execute(text(get_playlist_2_feature_query), {'song_ids': tuple(song_id_list_2)})
+@cached_query(user_argument='current_user_id')
+def get_feature_df(session:Session, current_user_id:str, playlist_id:str, feature:str, exclude:bool=False,
+                   snapshot:Optional[UserSnapshot]=None) -> pd.DataFrame:
+    '''Gets the selected feature for every song on the playlist, or with exclude on every other playlist of the user'''
+    if snapshot is not None:
+        return snapshot.get_song_features(snapshot.get_playlist_set_song_ids(playlist_id, exclude=exclude), [feature])
+    result = session.execute(text(get_feature_query(feature, exclude)), {'app_user_id': current_user_id, 'playlist_id': playlist_id})
     rows = result.fetchall()
-    playlist_2_df = pd.DataFrame(rows, columns=result.keys())
-    playlist_2_df['source'] = playlist_name_2
+    return pd.DataFrame(rows, columns=result.keys())
+
+def plot_feature_histogram(session:Session, current_user_id:str, playlist_id_1:str, playlist_id_2:Optional[str], feature:str,
+                           playlist_name_1:str, playlist_name_2:str, snapshot:Optional[UserSnapshot]=None) -> Tuple[go.Figure, float, float]:
+    '''Creates the figure of the feature histogram for the two given playlists. If playlist_id_2 is None the first playlist 
+    is compared to all of the user's other playlists. Also returns the median of the given feature for each playlist'''
+    # Get the selected feature for all songs in each playlist and store in a dataframe
+    playlist_1_df = get_feature_df(session, current_user_id, playlist_id_1, feature, snapshot=snapshot)
+    if playlist_id_2 is None:
+        playlist_2_df = get_feature_df(session, current_user_id, playlist_id_1, feature, exclude=True, snapshot=snapshot)
+    else:
+        playlist_2_df = get_feature_df(session, current_user_id, playlist_id_2, feature, snapshot=snapshot)
     
     # change ms to s 
     if feature == 'duration_ms':
         playlist_1_df['duration_seconds'] = playlist_1_df['duration_ms'] / 1000.0
         playlist_2_df['duration_seconds'] = playlist_2_df['duration_ms'] / 1000.0
         feature = 'duration_seconds'
-    # concat the dataframes and plot
-    plotting_df = pd.concat([playlist_1_df, playlist_2_df])
-
-    # bin_count = freedman_diaconis_rule(plotting_df[feature])
-    bin_count = 20
-    fig = px.histogram(plotting_df, x=feature, color='source', histnorm='probability',
-                       barmode='overlay', nbins=bin_count,
-                       color_discrete_sequence=['orange', 'blue'])
+
+    # the bins are counted here and only the bars are sent to the browser
+    playlist_1_values = pd.to_numeric(playlist_1_df[feature], errors='coerce').to_numpy(dtype=float)
+    playlist_2_values = pd.to_numeric(playlist_2_df[feature], errors='coerce').to_numpy(dtype=float)
+    fig, (playlist_1_median, playlist_2_median) = plot_binned_histogram([(playlist_name_1, playlist_1_values), (playlist_name_2, playlist_2_values)],
+                                                                        colors=['orange', 'blue'])
     fig.update_layout(
     title=f"Normalized Histogram of {feature}",
     xaxis_title=feature,
@@ -75,8 +59,6 @@ def plot_feature_histogram(session:Session, song_id_list_1: List[str], song_id_l
     bargap=0.1,  # Adjust gap between bars
     template="plotly_white"
     )      
-    playlist_1_median = np.nanmedian(playlist_1_df[feature])
-    playlist_2_median = np.nanmedian(playlist_2_df[feature])
     return fig, playlist_1_median, playlist_2_median
 
 def display_feature_metrics(feature:str, playlist_name_1:str, playlist_name_2:str, playlist_median_1:float, playlist_median_2:float) -> None:
@@ -124,25 +106,24 @@ def main():
         st.markdown('# Compare your playlists!')
         st.markdown(f'Currently logged in as: {current_user_display_name}')
 
-        session = create_sqlalchemy_session()
+        # read from the snapshot written by the last ingest if there is one, and only open a session if there is not
+        snapshot = load_user_snapshot(current_user_id)
+        session = create_sqlalchemy_session() if snapshot is None else None
 
-        
-        playlist_df = get_playlist_df(session, current_user_id)
+        playlist_df = get_playlist_df(session, current_user_id, snapshot=snapshot)
 
         playlist_1_tuple, playlist_2_tuple = display_playlist_selector(playlist_df)
         playlist_id_1, playlist_name_1 = playlist_1_tuple
         playlist_id_2, playlist_name_2 = playlist_2_tuple
-        song_id_list_1 = get_song_id_list(session=session, playlist_id=playlist_id_1, current_user_id=current_user_id)
-        if playlist_id_2 == None:
-            song_id_list_2 = get_song_id_list(session=session, playlist_id=playlist_id_1, current_user_id=current_user_id, exclude=True)
-        else:
-            song_id_list_2 = get_song_id_list(session=session, playlist_id=playlist_id_2, current_user_id=current_user_id)
-
         selected_feature = draw_feature_selectbox()
         display_feature_description(selected_feature)
-        feature_histogram_fig, playlist_median_1, playlist_median_2 = plot_feature_histogram(session, song_id_list_1=song_id_list_1, song_id_list_2=song_id_list_2,
+        feature_histogram_fig, playlist_median_1, playlist_median_2 = plot_feature_histogram(session, current_user_id=current_user_id,
+                                                                                    playlist_id_1=playlist_id_1, playlist_id_2=playlist_id_2,
                                                                                     playlist_name_1=playlist_name_1, playlist_name_2=playlist_name_2, 
-                                                                                    feature=selected_feature)
+                                                                                    feature=selected_feature, snapshot=snapshot)
+        if session is not None:
+            # give the connection back to the pool
+            session.close()
         st.plotly_chart(feature_histogram_fig, use_container_width=True)
         display_feature_metrics(feature=selected_feature, playlist_name_1=playlist_name_1, playlist_name_2=playlist_name_2,  
                                 playlist_median_1=playlist_median_1, playlist_median_2=playlist_median_2)
@@ -1,12 +1,19 @@
 import streamlit as st 
 from streamlit_utils import * 
-import plotly.express as px 
+from histograms import plot_binned_histogram
 import plotly.graph_objects as go
 from sqlalchemy.orm import Session
+from database.feature_stats import get_playlist_feature_averages
 
+@cached_query(user_argument='current_user_id')
 def get_playlist_averages(session:Session,current_user_id:str) -> pd.DataFrame:
     '''Get the average of every song feature found across all playlists for the current user'''
-    get_playlist_averages_query = f'''
+    # ingestion keeps the per playlist stats up to date, so the averages only need to be computed from the songs
+    # for users whose last refresh finished before the stats table existed
+    playlist_averages_df = get_playlist_feature_averages(session, current_user_id)
+    if playlist_averages_df is not None:
+        return playlist_averages_df
+    get_playlist_averages_query = '''
     SELECT p.name AS playlist_name, AVG(s.popularity) AS average_popularity, AVG(s.acousticness) AS average_acousticness, AVG(s.danceability) AS average_danceability, 
                 AVG(s.energy) AS average_energy, AVG(s.instrumentalness) AS average_instrumentalness, AVG(s.liveness) AS average_liveness, AVG(s.loudness) AS average_loudness,
                 AVG(s.speechiness) AS average_speechiness, AVG(s.tempo) AS average_tempo, AVG(s.valence) AS average_valence, AVG(s.duration_ms) / 1000.0 AS average_duration_seconds
@@ -14,10 +21,10 @@ def get_playlist_averages(session:Session,current_user_id:str) -> pd.DataFrame:
     FROM playlists AS p 
     JOIN playlist_songs AS ps ON p.playlist_id=ps.playlist_id
     JOIN songs AS s ON ps.song_id=s.song_id
-    WHERE p.app_user_id = '{current_user_id}'
-    GROUP BY p.playlist_id;
+    WHERE p.app_user_id = :app_user_id
+    GROUP BY p.playlist_id, p.name;
     '''
-    result = session.execute(text(get_playlist_averages_query))
+    result = session.execute(text(get_playlist_averages_query), {'app_user_id': current_user_id})
     rows = result.fetchall()
     df = pd.DataFrame(rows, columns=result.keys())
     return df 
@@ -31,12 +38,9 @@ def get_selected_feature_df(playlist_averages_df:pd.DataFrame, selected_feature:
 
 def display_feature_histogram(selected_feature_df:pd.DataFrame, selected_feature:str) -> go.Figure:
     ''' Display the histogram of the selected feature '''
-    bin_count = 20
     column_name = 'average_' + selected_feature 
-
-    fig = px.histogram(selected_feature_df, x=column_name,  histnorm='probability',
-                       barmode='overlay', nbins=bin_count,
-                       color_discrete_sequence=['blue'])
+    values = pd.to_numeric(selected_feature_df[column_name], errors='coerce').to_numpy(dtype=float)
+    fig, _ = plot_binned_histogram([(column_name, values)], colors=['blue'])
     fig.update_layout(
     title=f"Normalized Histogram of {selected_feature}",
     xaxis_title=selected_feature,
@@ -56,8 +60,14 @@ def main():
         current_user_display_name = st.session_state["display_name"]
         st.markdown('# Playlist Feature report')
         st.markdown(f'Currently logged in as: {current_user_display_name}')
-        session = create_sqlalchemy_session()
-        playlist_averages_df = get_playlist_averages(session, current_user_id)
+        # the snapshot written by the last ingest saves going to the database on every rerun
+        snapshot = load_user_snapshot(current_user_id)
+        playlist_averages_df = snapshot.get_playlist_averages() if snapshot is not None else None
+        if playlist_averages_df is None:
+            session = create_sqlalchemy_session()
+            playlist_averages_df = get_playlist_averages(session, current_user_id)
+            # give the connection back to the pool
+            session.close()
         selected_feature = draw_feature_selectbox()
         display_feature_description(selected_feature)
         if selected_feature == 'duration_ms':
@@ -0,0 +1,201 @@
+import json
+import os
+import re
+import threading
+import time
+
+from typing import Dict, Any, List, Optional
+
+class SecretNotFoundError(Exception):
+    '''Raised when none of the configured backends have the requested secret'''
+    pass
+
+class SecretBackendUnavailable(Exception):
+    '''Raised by a backend that could not be asked for the secret at all, for example because boto3 is not installed
+    or aws can not be reached. The provider moves on to the next backend'''
+    pass
+
+class AWSSecretsBackend:
+    '''Reads secrets from AWS Secrets Manager. The boto3 client is created once and reused for every lookup'''
+    name = 'aws'
+    def __init__(self, region_name:str='us-east-2') -> None:
+        self.region_name = region_name
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        with self._lock:
+            if self._client is None:
+                # boto3 is only imported when the aws backend is used, so the app can run from the env or file backends without it
+                import boto3
+                session = boto3.session.Session()
+                self._client = session.client(service_name='secretsmanager', region_name=self.region_name)
+            return self._client
+
+    def get(self, secret_name:str) -> Dict[str, Any]:
+        try:
+            from botocore.exceptions import BotoCoreError, ClientError
+        except ModuleNotFoundError as e:
+            raise SecretBackendUnavailable(f'boto3 is not installed: {e}') from e
+        try:
+            get_secret_value_response = self._get_client().get_secret_value(SecretId=secret_name)
+        except ClientError as e:
+            # For a list of exceptions thrown, see
+            # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
+            if e.response.get('Error', {}).get('Code') == 'ResourceNotFoundException':
+                raise SecretNotFoundError(secret_name) from e
+            raise SecretBackendUnavailable(str(e)) from e
+        except BotoCoreError as e:
+            # no credentials, no network and the like
+            raise SecretBackendUnavailable(str(e)) from e
+        return json.loads(get_secret_value_response['SecretString'])
+
+class EnvSecretsBackend:
+    '''Reads secrets from environment variables holding the secret's json. The variable name is the secret name in upper
+    case with any other characters replaced by underscores and a prefix, for example spotify_client_secret is read
+    from SECRET_SPOTIFY_CLIENT_SECRET'''
+    name = 'env'
+    def __init__(self, prefix:str='SECRET_') -> None:
+        self.prefix = prefix
+
+    def variable_name(self, secret_name:str) -> str:
+        return self.prefix + re.sub(r'[^A-Za-z0-9]', '_', secret_name).upper()
+
+    def get(self, secret_name:str) -> Dict[str, Any]:
+        value = os.environ.get(self.variable_name(secret_name))
+        if value is None:
+            raise SecretNotFoundError(secret_name)
+        return json.loads(value)
+
+class JSONFileSecretsBackend:
+    '''Reads secrets from a local json file mapping each secret name to its json object. Useful for developing offline.
+    The file is read again whenever it changes'''
+    name = 'file'
+    def __init__(self, path:str) -> None:
+        self.path = path
+        self._secrets = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def get(self, secret_name:str) -> Dict[str, Any]:
+        with self._lock:
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                raise SecretNotFoundError(secret_name)
+            if mtime != self._mtime:
+                with open(self.path) as secrets_file:
+                    self._secrets = json.load(secrets_file)
+                self._mtime = mtime
+            if secret_name not in self._secrets:
+                raise SecretNotFoundError(secret_name)
+            return self._secrets[secret_name]
+
+class SecretProvider:
+    '''In process cache in front of one or more secret backends. Backends are tried in order, so a local file can be
+    listed after aws as a fallback. Each secret is cached for ttl_seconds, and once it is within refresh_ahead_seconds of
+    expiring the next lookup still returns the cached value while a background thread fetches a new one, so callers only
+    wait on the backend the very first time a secret is used. If a background refresh fails the old value is kept.'''
+    def __init__(self, backends:List, ttl_seconds:float, refresh_ahead_seconds:float) -> None:
+        self.backends = backends
+        self.ttl_seconds = ttl_seconds
+        self.refresh_ahead_seconds = refresh_ahead_seconds
+        # secret name -> (secret, time it was fetched)
+        self._cache = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._refreshes = 0
+        self._refresh_failures = 0
+
+    def _fetch(self, secret_name:str) -> Dict[str, Any]:
+        '''Looks the secret up in each backend in order and caches the first one found. A backend that is unavailable
+        is skipped like one that does not have the secret, and only once every backend has been tried is an error
+        raised: SecretBackendUnavailable if any of them could not be asked, since the secret may well be there'''
+        unavailable = []
+        for backend in self.backends:
+            try:
+                secret = backend.get(secret_name)
+            except SecretNotFoundError:
+                continue
+            except SecretBackendUnavailable as e:
+                unavailable.append(f'{backend.name} ({e})')
+                continue
+            with self._lock:
+                self._cache[secret_name] = (secret, time.monotonic())
+            return secret
+        if unavailable:
+            raise SecretBackendUnavailable(f"Secret {secret_name} was not found, and these backends could not be reached: {', '.join(unavailable)}")
+        raise SecretNotFoundError(f"Secret {secret_name} was not found in any of the backends: {', '.join(backend.name for backend in self.backends)}")
+
+    def _refresh(self, secret_name:str) -> None:
+        try:
+            self._fetch(secret_name)
+            with self._lock:
+                self._refreshes += 1
+        except Exception as e:
+            print(f'Could not refresh secret {secret_name}, keeping the cached value: {e}')
+            with self._lock:
+                self._refresh_failures += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(secret_name)
+
+    def get(self, secret_name:str) -> Dict[str, Any]:
+        '''Returns the secret, only calling the backends if it is not cached or has expired'''
+        with self._lock:
+            cached = self._cache.get(secret_name)
+            if cached is not None:
+                secret, fetched_at = cached
+                age = time.monotonic() - fetched_at
+                if age < self.ttl_seconds:
+                    self._hits += 1
+                    if age >= self.ttl_seconds - self.refresh_ahead_seconds and secret_name not in self._refreshing:
+                        self._refreshing.add(secret_name)
+                        threading.Thread(target=self._refresh, args=(secret_name,),
+                                         name=f'secret-refresh-{secret_name}', daemon=True).start()
+                    return dict(secret)
+            self._misses += 1
+        return dict(self._fetch(secret_name))
+
+    def invalidate(self, secret_name:Optional[str]=None) -> None:
+        '''Drops a secret from the cache, or every secret if no name is given. Use this after a secret is rotated'''
+        with self._lock:
+            if secret_name is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(secret_name, None)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'backends': [backend.name for backend in self.backends],
+                'cached_secrets': len(self._cache),
+                'hits': self._hits,
+                'misses': self._misses,
+                'background_refreshes': self._refreshes,
+                'refresh_failures': self._refresh_failures,
+            }
+
+DEFAULT_SECRETS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'secrets.json')
+
+def build_backends(backend_names:str) -> List:
+    '''Builds the backends from a comma separated list of names, for example "aws,file"'''
+    backends = []
+    for backend_name in backend_names.split(','):
+        backend_name = backend_name.strip().lower()
+        if backend_name == 'aws':
+            backends.append(AWSSecretsBackend(region_name=os.environ.get('SECRET_AWS_REGION', 'us-east-2')))
+        elif backend_name == 'env':
+            backends.append(EnvSecretsBackend())
+        elif backend_name == 'file':
+            backends.append(JSONFileSecretsBackend(os.environ.get('SECRETS_FILE', DEFAULT_SECRETS_FILE)))
+        elif backend_name:
+            raise ValueError(f'Unknown secret backend {backend_name}, expected aws, env or file')
+    return backends
+
+# Shared by everything in the server process. SECRET_BACKEND picks where secrets are read from
+secret_provider = SecretProvider(backends=build_backends(os.environ.get('SECRET_BACKEND', 'aws')),
+                                 ttl_seconds=float(os.environ.get('SECRET_TTL_SECONDS', 60 * 60)),
+                                 refresh_ahead_seconds=float(os.environ.get('SECRET_REFRESH_AHEAD_SECONDS', 5 * 60)))
@@ -5,14 +5,27 @@ import base64
 import random
 
 from streamlit_utils import get_secret
-from typing import List, Dict, Any, Optional
+from spotify_api.rate_limit import spotify_rate_limiter
+from spotify_api.transport import spotify_transport
+from spotify_api.cache import catalog_cache
+from spotify_api.utils import PLAYLIST_ITEMS_FIELDS
+from typing import List, Dict, Any, Optional, Iterator
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Maximum number of pages of a single paginated endpoint requested at the same time
+PAGINATION_MAX_WORKERS = 4
+
+def get_client_secret() -> str:
+    '''Gets the spotify client secret. get_secret caches it in the process, so this is cheap to call on every rerun'''
+    return get_secret('spotify_client_secret')['spotify_client_secret']
 
 class SpotifyAPI:
     def __init__(self) -> None:
         '''Initializes the SpotifyAPI class with necessary credentials and prepares for OAuth flow.'''
 
         self.CLIENT_ID = '5ff1fe753a2b4587be0ff3e890cea92f'
-        self.CLIENT_SECRET = get_secret('spotify_client_secret')['spotify_client_secret']
+        self.CLIENT_SECRET = get_client_secret()
 
         # public_ip = get_ec2_public_ip()
         # public_ip = '18.223.158.104'
@@ -69,7 +82,9 @@ class SpotifyAPI:
             'grant_type': 'authorization_code'
         }
 
-        response = requests.post(token_url, headers=headers, data=data)
+        # The accounts service is not part of the web api quota, so this skips the rate limiter. The code can only be
+        # exchanged once, so the request is never retried: a retry after a lost response would be rejected anyway
+        response = spotify_transport.post(token_url, headers=headers, data=data, rate_limit=False, retry=False)
         return response.json()
 
     def handle_callback(self) -> None:
@@ -77,8 +92,13 @@ class SpotifyAPI:
         try:
             code = st.query_params['code']
             # code = st.experimental_get_query_params()['code'][0]
+            # The code stays in the url on every rerun, but it can only be exchanged once. 
+            # If it has already been exchanged the token was picked up from the session state in __init__
+            if self.access_token and st.session_state.get('auth_code') == code:
+                return
             self.access_token = self.exchange_code_for_access(code)['access_token']
             st.session_state['access_token'] = self.access_token
+            st.session_state['auth_code'] = code
         except KeyError:
             st.write('Click the link to log in!')
             # self.start_auth_flow()
@@ -88,49 +108,97 @@ class SpotifyAPI:
         self.base_url = 'https://api.spotify.com/v1/'
         self.headers = {"Authorization": f"Bearer {self.access_token}"}
 
-        self.user_id = self.get_current_user()['id']
-        self.display_name = self.get_current_user()['display_name']
+        # The profile is cached in the session state for the current access token, so reruns do not call /me again.
+        # Logging in again gives a new token which invalidates the cached profile
+        profile = st.session_state.get('user_profile')
+        if not profile or profile['access_token'] != self.access_token:
+            current_user = self.get_current_user()
+            profile = {'access_token': self.access_token, 'id': current_user['id'], 'display_name': current_user['display_name']}
+            st.session_state['user_profile'] = profile
+        self.user_id = profile['id']
+        self.display_name = profile['display_name']
 
     def _make_request(self, endpoint: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         '''Send a request to the api at the given endpoint. Params can contain anything that needs to be 
         passed to the endpoint, like a list of song or artist ids to return data about.'''
         url = self.base_url + endpoint
-        response = requests.get(url, headers=self.headers, params=params)
-
-        if response.status_code == 429:
-            retry_after = int(response.headers.get('Retry-After', 1))
-            print(f'Rate limit exceeded. Retrying after {retry_after} seconds')
-            time.sleep(retry_after)
-            return self._make_request(endpoint, params)
-
+        # The shared transport handles rate limiting, retries with backoff for 5xx responses and connection errors,
+        # and reuses pooled connections. Anything it could not recover from is raised here
+        response = spotify_transport.get(url, headers=self.headers, params=params)
         response.raise_for_status()
         return response.json()
 
-    def _paginate_request(self, endpoint: str, params: Optional[Dict[str, Any]] = None, get_tracks: bool = False) -> List[Dict[str, Any]]:
-        '''Handle pagination for endpoints that may contain larger amounts of paginated data'''
-        all_items = []
+    @staticmethod
+    def _filter_page_items(page: Dict[str, Any], get_tracks: bool, seen_ids: set) -> List[Dict[str, Any]]:
+        '''Drops empty items and items that were already on an earlier page from a page of results'''
+        page_items = []
+        for item in page.get('items', []):
+            # if item is None then skip
+            if not item or (get_tracks and item.get('track') is None):
+                continue
+            item_id = item.get('track', {}).get('id') if get_tracks else item.get('id')
+            if item_id not in seen_ids:
+                page_items.append(item)
+                seen_ids.add(item_id)
+        return page_items
+
+    def _iter_pages(self, endpoint: str, params: Optional[Dict[str, Any]] = None, get_tracks: bool = False,
+                    parallel: bool = True, max_workers: int = PAGINATION_MAX_WORKERS) -> Iterator[List[Dict[str, Any]]]:
+        '''Yields the items of a paginated endpoint one page at a time, in order, as the pages arrive. 
+        The first page includes the total number of items, so when parallel is set the next max_workers offsets are 
+        requested at once on a bounded thread pool instead of following next one page at a time. 
+        Only max_workers pages are held at once, so memory use does not grow with the number of items'''
+        params = dict(params or {})
         seen_ids = set()
-        params = params or {}
-
-        while True:
+        data = self._make_request(endpoint, params)
+        yield self._filter_page_items(data, get_tracks, seen_ids)
+
+        if parallel and data.get('next') and data.get('total') is not None:
+            limit = data.get('limit') or params.get('limit', 20)
+            first_offset = data.get('offset', params.get('offset', 0))
+            offsets = range(first_offset + limit, data['total'], limit)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                in_flight = deque()
+                for offset in offsets:
+                    in_flight.append(executor.submit(self._make_request, endpoint, {**params, 'offset': offset}))
+                    if len(in_flight) >= max_workers:
+                        data = in_flight.popleft().result()
+                        yield self._filter_page_items(data, get_tracks, seen_ids)
+                # the pages are yielded in offset order so the items come back in the same order as the sequential path
+                while in_flight:
+                    data = in_flight.popleft().result()
+                    yield self._filter_page_items(data, get_tracks, seen_ids)
+            # The playlist may have grown while we were fetching it, if so follow next for whatever is left
+            params['offset'] = offsets[-1] if offsets else first_offset
+
+        while data.get('next'):
+            params['offset'] = params.get('offset', 0) + params.get('limit', 20)
             data = self._make_request(endpoint, params)
-            items = data.get('items', [])
+            yield self._filter_page_items(data, get_tracks, seen_ids)
 
-            for item in items:
-                # if item is None then skip
-                if not item or (get_tracks and item.get('track') is None):
-                    continue
-                item_id = item.get('track', {}).get('id') if get_tracks else item.get('id')
-                if item_id not in seen_ids:
-                    all_items.append(item)
-                    seen_ids.add(item_id)
+    def _paginate_request(self, endpoint: str, params: Optional[Dict[str, Any]] = None, get_tracks: bool = False,
+                          parallel: bool = True, max_workers: int = PAGINATION_MAX_WORKERS) -> List[Dict[str, Any]]:
+        '''Handle pagination for endpoints that may contain larger amounts of paginated data. Returns every item at once, 
+        use _iter_pages to process the items a page at a time instead'''
+        all_items = []
+        for page_items in self._iter_pages(endpoint, params, get_tracks=get_tracks, parallel=parallel, max_workers=max_workers):
+            all_items.extend(page_items)
+        return all_items
 
-            if not data.get('next'):
-                break
+    @staticmethod
+    def get_rate_limit_metrics() -> Dict[str, Any]:
+        '''Returns the throttle state of the rate limiter shared by every SpotifyAPI instance'''
+        return spotify_rate_limiter.get_metrics()
 
-            params['offset'] = params.get('offset', 0) + params.get('limit', 20)
+    @staticmethod
+    def get_transport_metrics() -> Dict[str, Any]:
+        '''Returns the circuit breaker state of the shared transport along with the rate limiter metrics'''
+        return spotify_transport.get_metrics()
 
-        return all_items
+    @staticmethod
+    def get_catalog_cache_metrics() -> Dict[str, Any]:
+        '''Returns the hit and miss counts of the catalog cache shared by every SpotifyAPI instance'''
+        return catalog_cache.get_metrics()
 
     def get_current_user(self) -> Dict[str, Any]:
         return self._make_request('me')
@@ -138,18 +206,50 @@ class SpotifyAPI:
     def get_user_playlists(self) -> List[Dict[str, Any]]:
         return self._paginate_request('me/playlists', params={'limit': 50})
 
-    def get_playlist_items(self, playlist_id: str) -> List[Dict[str, Any]]:
-        return self._paginate_request(f'playlists/{playlist_id}/tracks', params={'limit': 50}, get_tracks=True)
+    def get_playlist_items(self, playlist_id: str, fields: Optional[str] = PLAYLIST_ITEMS_FIELDS) -> List[Dict[str, Any]]:
+        '''Gets every item on a playlist. By default only the fields read by extract_playlist_items in utils.py are requested,
+        pass fields=None to get the full track objects'''
+        params = {'limit': 50}
+        if fields:
+            params['fields'] = fields
+        return self._paginate_request(f'playlists/{playlist_id}/tracks', params=params, get_tracks=True)
+
+    def iter_playlist_item_pages(self, playlist_id: str, fields: Optional[str] = PLAYLIST_ITEMS_FIELDS) -> Iterator[List[Dict[str, Any]]]:
+        '''Same as get_playlist_items but yields the items a page at a time as they arrive'''
+        params = {'limit': 50}
+        if fields:
+            params['fields'] = fields
+        return self._iter_pages(f'playlists/{playlist_id}/tracks', params=params, get_tracks=True)
+
+    def _get_cached_batch(self, namespace: str, endpoint: str, response_key: str, ids: List[str]) -> Dict[str, Any]:
+        '''Gets the objects for a batch of ids, reading from the shared catalog cache first and only requesting the 
+        ids that were not cached. Returns the response in the same shape as the endpoint, with None for unknown ids'''
+        found = catalog_cache.get_many(namespace, ids)
+        missing_ids = [id_ for id_ in dict.fromkeys(ids) if id_ not in found]
+        if missing_ids:
+            response = self._make_request(endpoint, params={'ids': ','.join(missing_ids)})
+            fetched = {item['id']: item for item in response[response_key] if item}
+            catalog_cache.put_many(namespace, fetched)
+            found.update(fetched)
+        return {response_key: [found.get(id_) for id_ in ids]}
 
     # No need to paginate these requests since we are passing in a certain number of ids in the params argument
     def get_audio_features(self, song_ids: List[str]) -> Dict[str, Any]:
-        return self._make_request('audio-features', params={'ids': ','.join(song_ids)})
+        return self._get_cached_batch('audio_features', 'audio-features', 'audio_features', song_ids)
 
     def get_artist_genre(self, artist_ids: List[str]) -> Dict[str, Any]:
-        return self._make_request('artists', params={'ids': ','.join(artist_ids)})
+        return self._get_cached_batch('artists', 'artists', 'artists', artist_ids)
 
     def get_track(self, song_id:str) -> Dict[str, Any]:
-        return self._make_request(f'tracks/{song_id}')
+        track = catalog_cache.get('tracks', song_id)
+        if track is None:
+            track = self._make_request(f'tracks/{song_id}')
+            catalog_cache.put('tracks', song_id, track)
+        return track
     
     def get_saved_tracks(self) -> List[Dict[str, Any]]:
-        return self._paginate_request('me/tracks', params={'limit': 50})
\ No newline at end of file
+        return self._paginate_request('me/tracks', params={'limit': 50})
+
+    def iter_saved_track_pages(self) -> Iterator[List[Dict[str, Any]]]:
+        '''Yields the user's saved tracks a page at a time, so a large library never has to be held in memory at once'''
+        return self._iter_pages('me/tracks', params={'limit': 50}, get_tracks=True)
\ No newline at end of file
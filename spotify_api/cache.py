@@ -0,0 +1,134 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from collections import defaultdict
+from typing import Dict, Any, List, Optional
+
+class CatalogCache:
+    '''Persistent cache for spotify catalog responses that are the same for every user, like audio features,
+    artists and tracks. Responses are stored per entity id in a local sqlite file so they survive restarts and are
+    shared by every session on the server. Each namespace (endpoint) has its own time to live, and once the cache
+    holds more than max_entries the least recently used entries are evicted.'''
+    def __init__(self, path:str, ttl_seconds:Dict[str, float], max_entries:int, default_ttl_seconds:float=24 * 60 * 60) -> None:
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.default_ttl_seconds = default_ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._hits = defaultdict(int)
+        self._misses = defaultdict(int)
+        self._evictions = 0
+        self._conn = None
+        self._n_entries = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        '''Opens the cache file the first time it is needed. Must be called with the lock held'''
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # One connection is shared by every thread, access to it is serialized by the lock
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS catalog_cache (
+                    namespace TEXT NOT NULL,
+                    entity_id TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    PRIMARY KEY (namespace, entity_id)
+                )''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_catalog_cache_last_access ON catalog_cache (last_access)')
+            self._n_entries = self._conn.execute('SELECT COUNT(*) FROM catalog_cache').fetchone()[0]
+        return self._conn
+
+    def get_many(self, namespace:str, entity_ids:List[str]) -> Dict[str, Any]:
+        '''Returns the cached responses for the given ids that have not expired, keyed by id. Ids that are
+        missing from the returned dictionary need to be fetched from the api'''
+        unique_ids = list(dict.fromkeys(entity_ids))
+        oldest_allowed = time.time() - self.ttl_seconds.get(namespace, self.default_ttl_seconds)
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            # stay well under the sqlite limit on the number of bound parameters
+            for i in range(0, len(unique_ids), 500):
+                chunk = unique_ids[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(f'''
+                    SELECT entity_id, payload
+                    FROM catalog_cache
+                    WHERE namespace = ? AND stored_at >= ? AND entity_id IN ({placeholders})''', [namespace, oldest_allowed, *chunk])
+                for entity_id, payload in rows:
+                    found[entity_id] = json.loads(payload)
+            if found:
+                now = time.time()
+                conn.executemany('UPDATE catalog_cache SET last_access = ? WHERE namespace = ? AND entity_id = ?',
+                                 [(now, namespace, entity_id) for entity_id in found])
+            self._hits[namespace] += len(found)
+            self._misses[namespace] += len(unique_ids) - len(found)
+        return found
+
+    def get(self, namespace:str, entity_id:str) -> Optional[Any]:
+        '''Returns the cached response for a single id, or None if it is not cached'''
+        return self.get_many(namespace, [entity_id]).get(entity_id)
+
+    def put_many(self, namespace:str, entries:Dict[str, Any]) -> None:
+        '''Stores responses keyed by entity id, then evicts the least recently used entries if the cache is over its size limit'''
+        if not entries:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN')
+            n_existing = 0
+            entity_id_list = list(entries)
+            for i in range(0, len(entity_id_list), 500):
+                chunk = entity_id_list[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                n_existing += conn.execute(f'SELECT COUNT(*) FROM catalog_cache WHERE namespace = ? AND entity_id IN ({placeholders})',
+                                           [namespace, *chunk]).fetchone()[0]
+            conn.executemany('INSERT OR REPLACE INTO catalog_cache (namespace, entity_id, payload, stored_at, last_access) VALUES (?, ?, ?, ?, ?)',
+                             [(namespace, entity_id, json.dumps(payload), now, now) for entity_id, payload in entries.items()])
+            self._n_entries += len(entries) - n_existing
+            n_over = self._n_entries - self.max_entries
+            if n_over > 0:
+                conn.execute('''
+                    DELETE FROM catalog_cache WHERE rowid IN (
+                        SELECT rowid FROM catalog_cache ORDER BY last_access LIMIT ?
+                    )''', (n_over,))
+                self._n_entries -= n_over
+                self._evictions += n_over
+            conn.execute('COMMIT')
+
+    def put(self, namespace:str, entity_id:str, payload:Any) -> None:
+        self.put_many(namespace, {entity_id: payload})
+
+    def get_metrics(self) -> Dict[str, Any]:
+        '''Returns the hit and miss counts for each namespace along with the size of the cache'''
+        with self._lock:
+            namespaces = sorted(set(self._hits) | set(self._misses))
+            return {
+                'entries': self._n_entries,
+                'max_entries': self.max_entries,
+                'evictions': self._evictions,
+                'hits': {namespace: self._hits[namespace] for namespace in namespaces},
+                'misses': {namespace: self._misses[namespace] for namespace in namespaces},
+            }
+
+# How long each type of response stays valid. Audio features never change, while popularity and
+# preview urls do, so artists and tracks are refreshed daily
+CATALOG_CACHE_TTL_SECONDS = {
+    'audio_features': 30 * 24 * 60 * 60,
+    'artists': 24 * 60 * 60,
+    'tracks': 24 * 60 * 60,
+}
+DEFAULT_CATALOG_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.cache', 'spotify_catalog.sqlite')
+
+# Shared by every SpotifyAPI instance in the server process
+catalog_cache = CatalogCache(path=os.environ.get('SPOTIFY_CATALOG_CACHE_PATH', DEFAULT_CATALOG_CACHE_PATH),
+                             ttl_seconds=CATALOG_CACHE_TTL_SECONDS,
+                             max_entries=int(os.environ.get('SPOTIFY_CATALOG_CACHE_MAX_ENTRIES', 200000)))
@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+
+from typing import Dict, Any
+
+class TokenBucketRateLimiter:
+    '''Thread safe token bucket used to pace requests to the spotify api. Tokens refill at a fixed rate up to
+    capacity, and every request has to take a token before it is sent. A 429 response pauses every caller
+    until the Retry-After time has passed instead of only the request that got the 429.'''
+    def __init__(self, rate:float, capacity:int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+        # Counters reported by get_metrics
+        self._n_requests = 0
+        self._n_throttled = 0
+        self._n_rate_limited = 0
+        self._total_wait_seconds = 0.0
+
+    def _refill(self, now:float) -> None:
+        '''Add the tokens earned since the last refill. Must be called with the lock held'''
+        # no tokens are earned while a pause is in effect
+        if now <= self._last_refill:
+            return
+        elapsed = now - self._last_refill
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._last_refill = now
+
+    def acquire(self) -> float:
+        '''Blocks until a token is available and any global pause is over. Returns the number of seconds waited'''
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    self._n_requests += 1
+                    if waited > 0:
+                        self._n_throttled += 1
+                        self._total_wait_seconds += waited
+                    return waited
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            # sleep outside of the lock so other threads can still check the bucket
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds:float) -> None:
+        '''Stop handing out tokens to any caller for the given number of seconds. Called when spotify responds with a 429'''
+        with self._lock:
+            self._n_rate_limited += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            # Empty the bucket so requests ramp back up at the refill rate after the pause rather than all at once
+            self._tokens = 0.0
+            self._last_refill = self._paused_until
+
+    def get_metrics(self) -> Dict[str, Any]:
+        '''Returns the current throttle state of the limiter'''
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                'rate_per_second': self.rate,
+                'capacity': self.capacity,
+                'available_tokens': round(self._tokens, 2),
+                'paused_seconds_remaining': round(max(0.0, self._paused_until - now), 2),
+                'requests': self._n_requests,
+                'throttled_requests': self._n_throttled,
+                'rate_limit_responses': self._n_rate_limited,
+                'total_wait_seconds': round(self._total_wait_seconds, 2),
+            }
+
+# Module level limiter so that every SpotifyAPI instance in the server process (one per streamlit session)
+# shares the same budget for the app's client id
+spotify_rate_limiter = TokenBucketRateLimiter(rate=float(os.environ.get('SPOTIFY_RATE_LIMIT_PER_SECOND', 10)),
+                                              capacity=int(os.environ.get('SPOTIFY_RATE_LIMIT_BURST', 20)))
@@ -0,0 +1,187 @@
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Dict, Any, Optional
+from urllib.parse import urlparse
+
+from spotify_api.rate_limit import TokenBucketRateLimiter, spotify_rate_limiter
+
+class CircuitOpenError(Exception):
+    '''Raised when a request is attempted while the circuit breaker is open'''
+    pass
+
+class CircuitBreaker:
+    '''Stops sending requests after too many consecutive failures. Once the breaker is open every request fails
+    immediately until reset_timeout seconds have passed, then a single trial request is let through. If the trial
+    succeeds the breaker closes again, otherwise it stays open for another reset_timeout.'''
+    def __init__(self, failure_threshold:int, reset_timeout:float, name:str='the spotify api') -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now:float) -> str:
+        '''Must be called with the lock held'''
+        if self._opened_at is None:
+            return 'closed'
+        if now - self._opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def before_request(self) -> None:
+        '''Raises CircuitOpenError if a request should not be sent right now'''
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == 'open' or (state == 'half_open' and self._trial_in_progress):
+                raise CircuitOpenError(f'{self.name} has failed too many times in a row, not sending any requests for now')
+            if state == 'half_open':
+                self._trial_in_progress = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._consecutive_failures += 1
+            # a failed trial request reopens the breaker straight away
+            if self._trial_in_progress or self._consecutive_failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+class SpotifyTransport:
+    '''HTTP layer used by SpotifyAPI. Keeps a persistent pool of keep alive connections so each request
+    does not need a new TCP and TLS handshake, retries 5xx responses and connection errors with exponential
+    backoff and jitter, waits on the shared rate limiter for 429s and trips a circuit breaker during long outages.
+    There is one breaker per host, so an outage of the accounts service does not stop api requests and the other
+    way round.'''
+    def __init__(self, rate_limiter:Optional[TokenBucketRateLimiter]=None, max_retries:int=4, max_rate_limit_retries:int=5,
+                 backoff_base:float=0.5, backoff_max:float=30.0, timeout:float=10.0, pool_maxsize:int=32,
+                 failure_threshold:int=5, reset_timeout:float=30.0) -> None:
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # host -> CircuitBreaker
+        self.circuit_breakers = {}
+        self._circuit_breakers_lock = threading.Lock()
+
+        self.session = requests.Session()
+        # Retries are handled in request below so they go through the rate limiter and circuit breaker
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+
+    def _backoff(self, attempt:int) -> float:
+        '''Exponential backoff with full jitter so retrying threads do not all come back at the same moment'''
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def get_circuit_breaker(self, url:str) -> CircuitBreaker:
+        host = urlparse(url).netloc
+        with self._circuit_breakers_lock:
+            if host not in self.circuit_breakers:
+                self.circuit_breakers[host] = CircuitBreaker(failure_threshold=self.failure_threshold,
+                                                             reset_timeout=self.reset_timeout, name=host)
+            return self.circuit_breakers[host]
+
+    def request(self, method:str, url:str, rate_limit:bool=True, retry:bool=True, **kwargs) -> requests.Response:
+        '''Send a request, retrying as needed. Returns the last response received, so callers should still
+        call raise_for_status on it. Raises CircuitOpenError if the breaker for the host is open, and the underlying
+        requests exception if the connection keeps failing after all of the retries.
+
+        With retry=False the request is sent exactly once, for requests that must not be repeated such as
+        exchanging a single use authorization code.'''
+        circuit_breaker = self.get_circuit_breaker(url)
+        circuit_breaker.before_request()
+        # The breaker counts logical requests, not attempts, so a single request working through its retries
+        # records one failure rather than opening the breaker by itself. The outcome is recorded in the finally
+        # so any exception, not just connection errors, releases a half open trial.
+        succeeded = False
+        try:
+            response = self._send(method, url, rate_limit, retry, **kwargs)
+            # A 429 means the service is up, so it does not count against the circuit breaker
+            succeeded = response.status_code < 500
+            return response
+        finally:
+            if succeeded:
+                circuit_breaker.record_success()
+            else:
+                circuit_breaker.record_failure()
+
+    def _send(self, method:str, url:str, rate_limit:bool, retry:bool, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        max_retries = self.max_retries if retry else 0
+        max_rate_limit_retries = self.max_rate_limit_retries if retry else 0
+        error_retries = 0
+        rate_limit_retries = 0
+        while True:
+            if rate_limit and self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if error_retries >= max_retries:
+                    raise
+                time.sleep(self._backoff(error_retries))
+                error_retries += 1
+                continue
+
+            if response.status_code == 429:
+                if rate_limit_retries >= max_rate_limit_retries:
+                    return response
+                retry_after = int(response.headers.get('Retry-After', 1))
+                print(f'Rate limit exceeded. Retrying after {retry_after} seconds')
+                if self.rate_limiter:
+                    # Pause every request in the process, not just this one, since they all share the same quota
+                    self.rate_limiter.pause(retry_after)
+                else:
+                    time.sleep(retry_after)
+                rate_limit_retries += 1
+                continue
+
+            if response.status_code >= 500:
+                if error_retries >= max_retries:
+                    return response
+                print(f'Spotify responded with {response.status_code}. Retrying (attempt {error_retries + 1} of {max_retries})')
+                time.sleep(self._backoff(error_retries))
+                error_retries += 1
+                continue
+
+            return response
+
+    def get(self, url:str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url:str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        '''Returns the state of each host's circuit breaker along with the rate limiter metrics'''
+        with self._circuit_breakers_lock:
+            circuit_breakers = dict(self.circuit_breakers)
+        metrics = {'circuit_states': {host: circuit_breaker.state for host, circuit_breaker in circuit_breakers.items()}}
+        if self.rate_limiter:
+            metrics.update(self.rate_limiter.get_metrics())
+        return metrics
+
+# One transport for the whole server process so every SpotifyAPI instance reuses the same connection pool
+spotify_transport = SpotifyTransport(rate_limiter=spotify_rate_limiter,
+                                     max_retries=int(os.environ.get('SPOTIFY_MAX_RETRIES', 4)))
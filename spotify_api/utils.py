@@ -1,7 +1,8 @@
 # this is where all of the functions that format the data into useful forms for the database will go 
 import numpy as np 
 from datetime import datetime
-from typing import Dict, List, Optional
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
 
 def extract_playlist_details(user_playlists:List[Dict], app_user_id:str) -> Dict:
     '''takes in get current user playlists response and fills in
@@ -14,7 +15,8 @@ def extract_playlist_details(user_playlists:List[Dict], app_user_id:str) -> Dict
         'name':[playlist['name'] for playlist in user_playlists],
         'owner_id':[playlist['owner']['id'] for playlist in user_playlists],
         'is_collaborative':[playlist['collaborative'] for playlist in user_playlists],
-        'app_user_id':app_user_id_list
+        'app_user_id':app_user_id_list,
+        'snapshot_id':[playlist.get('snapshot_id') for playlist in user_playlists]
 
     }
     return playlists_data
@@ -31,6 +33,8 @@ def extract_liked_song_details(liked_songs:List[Dict], app_user_id:str) -> Dict:
 
 
 
+# Every song on an album shares its release date, so most lookups are repeats of a date that has already been parsed
+@lru_cache(maxsize=65536)
 def format_release_date(date_str:str) -> Optional[str]:
     '''Handle the different formats of input strings and fill in 1 if there is no value there. '''
     if not date_str:
@@ -56,28 +60,97 @@ def format_release_date(date_str:str) -> Optional[str]:
     # Return the date in 'YYYY-MM-DD' format
     return date.strftime('%Y-%m-%d')
 
-def extract_song_data(playlist_items:Dict) -> Dict[str, List]:
-    '''Format song data into a dictionary of lists'''
-    song_data = {
-        'song_id':[playlist_item['track']['id'] for playlist_item in playlist_items],
-        'title': [playlist_item['track']['name'] for playlist_item in playlist_items],
-        'album_name':[playlist_item['track']['album']['name'] for playlist_item in playlist_items],
-        'album_id':[playlist_item['track']['album']['id'] for playlist_item in playlist_items],
-        'duration_ms':[playlist_item['track']['duration_ms'] for playlist_item in playlist_items],
-        'release_date':[format_release_date(playlist_item['track']['album']['release_date']) for playlist_item in playlist_items],
-        'popularity':[playlist_item['track']['popularity'] for playlist_item in playlist_items],
-    }
-    return song_data
-    
-def extract_song_playlist_data(playlist_id:str, playlist_items:Dict)-> Dict[str, List]:
-    '''Foramt song playlist data into a dictionary of lists'''
-    song_playlist_data = {
-        'playlist_id':[playlist_id] * len(playlist_items),
-        'song_id':[playlist_item['track']['id'] for playlist_item in playlist_items],
-        'added_date':[datetime.strptime(playlist_item['added_at'], "%Y-%m-%dT%H:%M:%SZ") for playlist_item in playlist_items],
-        'added_by':[playlist_item['added_by']['id'] for playlist_item in playlist_items]
+# Fields of the paging object itself that are needed to paginate through a playlist
+PAGING_FIELDS = ['next', 'total', 'limit', 'offset']
+
+def build_fields_filter(item_fields:List[str], paging_fields:List[str]=PAGING_FIELDS) -> str:
+    '''Converts a list of dotted field paths into the syntax of the spotify fields query parameter.
+    For example ['track.id', 'track.album.name'] becomes items(track(id,album(name))) followed by the paging fields'''
+    field_tree = {}
+    for field in item_fields:
+        node = field_tree
+        for part in field.split('.'):
+            node = node.setdefault(part, {})
+
+    def render(tree:Dict) -> str:
+        return ','.join(f'{name}({render(children)})' if children else name for name, children in tree.items())
+
+    return ','.join([f'items({render(field_tree)})'] + paging_fields)
+
+def to_column(values:List, dtype:Any=object) -> np.ndarray:
+    '''Converts a list into a typed numpy array. Integer columns with missing or non integer values are kept as 
+    object arrays, so None is not turned into nan and tolist gives back exactly the values that went in'''
+    if dtype is np.int64 and not all(type(value) is int for value in values):
+        dtype = object
+    return np.array(values, dtype=dtype)
+
+def parse_added_at(added_at_list:List[str]) -> np.ndarray:
+    '''Parses the added_at timestamps of a playlist in one vectorized call. Spotify sends them as 2024-01-31T12:00:00Z'''
+    if None in added_at_list:
+        return to_column([datetime.strptime(added_at, "%Y-%m-%dT%H:%M:%SZ") if added_at else None for added_at in added_at_list])
+    # numpy does not accept the Z suffix, every timestamp is in utc anyway
+    return np.array([added_at.rstrip('Z') for added_at in added_at_list], dtype='datetime64[s]')
+
+# The fields of a playlist item that extract_playlist_items reads. This list must match what that function reads: it
+# becomes the fields filter sent to the playlist items endpoint, so a field read there but missing here never arrives
+PLAYLIST_ITEM_FIELDS = ['track.id', 'track.name', 'track.album.name', 'track.album.id', 'track.duration_ms', 
+                        'track.album.release_date', 'track.popularity', 'added_at', 'added_by.id', 
+                        'track.artists.id', 'track.artists.name']
+# Fields filter for the playlist items endpoint, covering every field read by extract_playlist_items
+PLAYLIST_ITEMS_FIELDS = build_fields_filter(PLAYLIST_ITEM_FIELDS)
+
+def extract_playlist_items(playlist_id:str, playlist_items:List[Dict]) -> Dict[str, Dict[str, np.ndarray]]:
+    '''Formats the items of a playlist into the columns of the songs, playlist songs and artist tables in a single pass 
+    over the items. Returns a dictionary of numpy arrays for each table, keyed by songs, playlist_songs and artists'''
+    song_id, title, album_name, album_id, duration_ms, release_date, popularity = [], [], [], [], [], [], []
+    added_at, added_by = [], []
+    artist_id, artist_name, artist_song_id = [], [], []
+    for playlist_item in playlist_items:
+        track = playlist_item['track']
+        album = track['album']
+        song_id.append(track['id'])
+        title.append(track['name'])
+        album_name.append(album['name'])
+        album_id.append(album['id'])
+        duration_ms.append(track['duration_ms'])
+        release_date.append(format_release_date(album['release_date']))
+        popularity.append(track['popularity'])
+        added_at.append(playlist_item['added_at'])
+        added_by.append(playlist_item['added_by']['id'])
+        # each track holds the artist array for a single song
+        for artist in track['artists']:
+            artist_id.append(artist['id'])
+            artist_name.append(artist['name'])
+            artist_song_id.append(track['id'])
+
+    song_id_column = to_column(song_id)
+    return {
+        'songs': {
+            'song_id': song_id_column,
+            'title': to_column(title),
+            'album_name': to_column(album_name),
+            'album_id': to_column(album_id),
+            'duration_ms': to_column(duration_ms, np.int64),
+            'release_date': to_column(release_date),
+            'popularity': to_column(popularity, np.int64),
+        },
+        'playlist_songs': {
+            'playlist_id': to_column([playlist_id] * len(song_id)),
+            'song_id': song_id_column,
+            'added_date': parse_added_at(added_at),
+            'added_by': to_column(added_by),
+        },
+        'artists': {
+            'artist_id': to_column(artist_id),
+            'name': to_column(artist_name),
+            'song_id': to_column(artist_song_id),
+        },
     }
-    return song_playlist_data
+
+def columns_to_lists(columns:Dict[str, np.ndarray]) -> Dict[str, List]:
+    '''Converts a table's numpy columns back into a dictionary of lists of plain python values, which is the format 
+    the load functions take. Database drivers do not know how to send numpy scalars'''
+    return {column_name: column.tolist() for column_name, column in columns.items()}
 
 def extract_song_features_data(audio_features_items:Dict)-> Dict[str, List]:
     '''Format the song features into a dictionary of lists'''
@@ -103,25 +176,6 @@ def extract_song_features_data(audio_features_items:Dict)-> Dict[str, List]:
     }
     return song_features_data
 
-def extract_artist_data(playlist_items) -> Dict[str, List]:
-    '''Formats artist data into a dictionary of lists'''
-    artist_data = {
-        'artist_id':[],
-        'name':[], 
-        'song_id':[]
-    }
-    # each item in this array holds the artist array for a single song
-    track_objects = [playlist_item['track'] for playlist_item in playlist_items]
-    for track_object in track_objects:
-        song_id = track_object['id']
-
-        artist_array = track_object['artists']
-        for artist in artist_array:
-            artist_data['artist_id'].append(artist['id'])
-            artist_data['name'].append(artist['name'])
-            artist_data['song_id'].append(song_id)
-    return artist_data
-
 def extract_artist_genre_popularity_data(artist_genres) -> Dict[str, List]:
     '''Formats artist genre data into a dictionary of lists'''
     artist_data = {
@@ -3,55 +3,80 @@ import pandas as pd
 import numpy as np 
 import os
 import json
-from sqlalchemy import text, create_engine
+import threading
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker, Session 
-import boto3
-from botocore.exceptions import ClientError
+from secrets_provider import secret_provider
+from database.backends import create_database_engine, DATABASE_BACKEND, DB_MAX_OVERFLOW
+from database.snapshots import UserSnapshot, load_user_snapshot
+from database.query_cache import cached_query, get_query_cache_metrics
 import requests
 from typing import Dict, Any, Tuple, Optional, List
 
 
 def get_secret(secret_name:str) -> Dict[str, Any]:
-    '''Retreives a secret from aws'''
-    region_name = "us-east-2"
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        # For a list of exceptions thrown, see
-        # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-        raise e
-    secret = get_secret_value_response['SecretString']
-    return json.loads(secret)
+    '''Retreives a secret. Secrets are read from aws by default and cached in the process, 
+    see secrets_provider.py for the other backends'''
+    return secret_provider.get(secret_name)
+
+_engine = None
+_session_factory = None
+_engine_lock = threading.Lock()
+
+def get_sqlalchemy_engine() -> Engine:
+    '''Returns the engine shared by the whole server process, creating it the first time it is needed. 
+    The database credentials are only looked up when the engine is created, not on every rerun. 
+    Which database is used is set by DATABASE_BACKEND, see database/backends.py'''
+    global _engine, _session_factory
+    if _engine is None:
+        with _engine_lock:
+            # check again now that we hold the lock, another thread may have created the engine while we waited
+            if _engine is None:
+                engine = create_database_engine(DATABASE_BACKEND)
+                _session_factory = sessionmaker(bind=engine)
+                _engine = engine
+    return _engine
+
 def create_sqlalchemy_session() -> Session:
-    '''Creates a sqlalchemy session by connecting to the aws database'''
-    database_secret_name = 'rds!db-60329a4c-380a-4809-bcf5-2689a1a604c0'
-    database_credentials = get_secret(database_secret_name)
-    username = database_credentials['username']
-    password = database_credentials['password']
-    dbname = 'spotify_db'
-    endpoint = 'streamlit-spotify-db.cv2w6ig8qy6y.us-east-2.rds.amazonaws.com'
-    engine = create_engine(f'mysql+pymysql://{username}:{password}@{endpoint}/{dbname}')
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    return session
-
-def get_playlist_df(session, current_user_id:str) -> pd.DataFrame:
-    '''Gets all playlists for the current app user'''
-    get_available_playlists_query = f'''
+    '''Creates a sqlalchemy session bound to the shared engine. The session borrows a connection from the pool 
+    when it first queries the database, and closing the session gives the connection back to the pool'''
+    get_sqlalchemy_engine()
+    return _session_factory()
+
+def get_engine_pool_metrics() -> Dict[str, Any]:
+    '''Returns how many connections of the shared pool are in use'''
+    pool = get_sqlalchemy_engine().pool
+    return {
+        'backend': DATABASE_BACKEND,
+        'pool_size': pool.size(),
+        'max_overflow': DB_MAX_OVERFLOW,
+        'checked_out': pool.checkedout(),
+        'checked_in': pool.checkedin(),
+        'overflow': pool.overflow(),
+    }
+
+# The queries run on every page load are kept at module level so that the check command in database/migrations.py
+# can EXPLAIN the same SQL the pages send
+USER_PLAYLISTS_QUERY = '''
     SELECT playlist_id, name, owner_id, is_collaborative
     FROM playlists
-    WHERE app_user_id = '{current_user_id}'
-    ORDER BY last_updated DESC;
-    '''
-    result = session.execute(text(get_available_playlists_query))
+    WHERE app_user_id = :app_user_id
+    ORDER BY last_updated DESC
+'''
+
+USER_EXISTS_QUERY = '''
+    SELECT DISTINCT app_user_id
+    FROM playlists
+    WHERE app_user_id = :app_user_id
+'''
+
+@cached_query(user_argument='current_user_id')
+def get_playlist_df(session, current_user_id:str, snapshot:Optional[UserSnapshot]=None) -> pd.DataFrame:
+    '''Gets all playlists for the current app user. Read from the user's snapshot instead of the database when one is given'''
+    if snapshot is not None:
+        return snapshot.get_playlist_df()
+    result = session.execute(text(USER_PLAYLISTS_QUERY), {'app_user_id': current_user_id})
     rows = result.fetchall()
     playlist_df = pd.DataFrame(rows, columns=result.keys())
     return playlist_df 
@@ -90,49 +115,34 @@ def display_playlist_selector(df:pd.DataFrame) -> Tuple[Tuple[Optional[str], str
     
     return (selected_playlist_id_1, selected_playlist_name_1), (selected_playlist_id_2, selected_playlist_name_2)
 
-def get_song_id_list(session:Session, playlist_id:str, current_user_id:str, exclude=False) -> List[str]:
-    '''Gets the song id for the given playlist id. If exclude is set to true then 
-    this returns the song id for all playlists except the one specified. This functionality is useful 
-    for when comparing one playlist to all other playlists'''
-    if exclude:
-        get_song_list_query = f'''
-        SELECT song_id, p.playlist_id, p.name AS playlist_name
-        FROM playlists AS p 
+def get_playlist_set_subquery(exclude:bool=False) -> str:
+    '''SQL for the distinct song ids of a set of the user's playlists, either the playlist :playlist_id or with exclude
+    every other playlist of the user :app_user_id. Pages put it inside their own query as song_id IN (...) so that
+    the database does the join and drops the songs that are on several playlists, rather than every song id making
+    a round trip through python and coming back as thousands of bound parameters'''
+    comparison = '!=' if exclude else '='
+    return f'''
+        SELECT DISTINCT ps.song_id
+        FROM playlists AS p
         JOIN playlist_songs AS ps ON p.playlist_id=ps.playlist_id
-        WHERE p.playlist_id != '{playlist_id}' AND p.app_user_id='{current_user_id}';
-        '''
-    else:
-        get_song_list_query = f'''
-        SELECT song_id, p.playlist_id, p.name AS playlist_name
-        FROM playlists AS p 
-        JOIN playlist_songs AS ps ON p.playlist_id=ps.playlist_id
-        WHERE p.playlist_id = '{playlist_id}' AND p.app_user_id='{current_user_id}';
-        '''
-    result = session.execute(text(get_song_list_query))
-    rows = result.fetchall()
-    song_id_list = [row[0] for row in rows]
-    return song_id_list
+        WHERE p.app_user_id = :app_user_id AND p.playlist_id {comparison} :playlist_id
+    '''
 
 def get_playlist_title(session:Session, playlist_id:str) -> str:
     '''Get the title of a specified playlist'''
-    get_playlist_title_query = f'''
+    get_playlist_title_query = '''
     SELECT name 
     FROM playlists
-    WHERE playlist_id = '{playlist_id}';
+    WHERE playlist_id = :playlist_id;
     '''
-    result = session.execute(text(get_playlist_title_query))
+    result = session.execute(text(get_playlist_title_query), {'playlist_id': playlist_id})
     rows = result.fetchall()
     return rows[0][0]
 
 def check_if_user_exists(session:Session, user_id:str) -> bool:
     '''Checks if the given user is found in the playlist table. 
     Returns true if the user is found in the database'''
-    find_user_query = f'''
-    SELECT DISTINCT app_user_id 
-    FROM playlists
-    WHERE app_user_id = '{user_id}';
-    '''
-    result = session.execute(text(find_user_query))
+    result = session.execute(text(USER_EXISTS_QUERY), {'app_user_id': user_id})
 
     user = result.fetchone()
     # if the query has returned nothing, this means the user is not in the DB and user will be set to None and we should return False
@@ -141,6 +151,21 @@ def check_if_user_exists(session:Session, user_id:str) -> bool:
     else:
         return True
 
+def get_user_exists(user_id:str) -> bool:
+    '''Checks if the given user is found in the database. The answer is cached in the session state so that 
+    reruns do not need a new database session. Call clear_user_exists whenever the user's data changes'''
+    cached = st.session_state.get('user_exists')
+    if cached and cached[0] == user_id:
+        return cached[1]
+    session = create_sqlalchemy_session()
+    user_exists = check_if_user_exists(session, user_id)
+    session.close()
+    st.session_state['user_exists'] = (user_id, user_exists)
+    return user_exists
+
+def clear_user_exists() -> None:
+    '''Clears the cached answer of get_user_exists'''
+    st.session_state.pop('user_exists', None)
 
 def display_feature_description(feature:str) -> None:
     '''Display a dropdown that can be expanded to show the definition of each feature'''